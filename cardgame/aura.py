@@ -0,0 +1,391 @@
+import operator
+from .enums import *
+from .entity import int_properties
+from .manager import CardManager, PlayerManager
+from .registry import ANY
+from .logic.lazynum import LazyNum, LazyBinaryOperation, LazyUnaryOperation, Count, OpAttr, \
+	fingerprint
+from .logic.conditions import Exists
+from .logic.selector import *
+from .logic.actions import IfThen, Refresh, AuraBuff
+
+
+class Untracked(Exception):
+	"""Raised when a script reads state that the registry does not track"""
+	pass
+
+
+#------------------------------------------------------------------------------
+# Dependency analysis
+#------------------------------------------------------------------------------
+
+def _tag_keys(tag, keys):
+	"""Add the version keys that reading a tag depends on"""
+	if isinstance(tag, str):
+		attrs = [tag]
+	else:
+		attrs = [CardManager.map.get(tag), PlayerManager.map.get(tag)]
+	for attr in attrs:
+		if attr is None or attr == "type":
+			# Read from the card data or fixed at creation
+			continue
+		if attr not in int_properties:
+			raise Untracked(attr)
+		keys.add(("attr", attr))
+		# Buffs entering or leaving play change computed values
+		keys.add(("zone", ANY, CardType.EFFECT))
+
+
+def _intersect(a, b):
+	if a is ANY:
+		return b
+	if b is ANY:
+		return a
+	return a & b
+
+
+def _union(a, b):
+	if a is ANY or b is ANY:
+		return ANY
+	return a | b
+
+
+def _domain(selector, keys):
+	"""
+	Return the (zones, types) an entity must be in to be selected by
+	selector, where either can be ANY, and add the version keys for any
+	tags it reads.
+	"""
+	if isinstance(selector, SetOpSelector):
+		left = _domain(selector.left, keys)
+		right = _domain(selector.right, keys)
+		if selector.op is operator.and_:
+			return (_intersect(left[0], right[0]), _intersect(left[1], right[1]))
+		elif selector.op is operator.or_:
+			return (_union(left[0], right[0]), _union(left[1], right[1]))
+		elif selector.op is operator.sub:
+			return left
+	elif isinstance(selector, EnumSelector):
+		value = selector.tag_enum
+		if isinstance(value, Zone):
+			return (frozenset([value]), ANY)
+		elif isinstance(value, CardType):
+			return (ANY, frozenset([value]))
+		elif isinstance(value, GameTag):
+			_tag_keys(value, keys)
+			return (ANY, ANY)
+		elif isinstance(value, Tribe):
+			return (ANY, ANY)
+	elif isinstance(selector, ComparisonSelector):
+		left = selector.left
+		right = selector.right
+		if not isinstance(left, AttrValue):
+			raise Untracked(selector)
+		if isinstance(right, LazyNum):
+			_value_keys(right, keys)
+		if left.tag == "type":
+			if selector.op is operator.eq and isinstance(right, CardType):
+				return (ANY, frozenset([right]))
+			return (ANY, ANY)
+		elif left.tag == "controller":
+			# Controllers only change along with zones
+			return (ANY, ANY)
+		_tag_keys(left.tag, keys)
+		return (ANY, ANY)
+	elif selector is SELF or selector is OWNER:
+		return (ANY, ANY)
+	raise Untracked(selector)
+
+
+def _selector_keys(selector, keys):
+	if selector is SELF or selector is OWNER:
+		# Always selects the source (or its owner), wherever it is.
+		return
+	zones, types = _domain(selector, keys)
+	for zone in (zones if zones is not ANY else [ANY]):
+		for type in (types if types is not ANY else [ANY]):
+			keys.add(("zone", zone, type))
+	if types is not ANY and CardType.EFFECT in types:
+		# Buffs are only listed while their owner is in play.
+		keys.add(("zone", Zone.PLAY, ANY))
+
+
+def _value_keys(value, keys):
+	"""Add the version keys that evaluating a lazy value depends on"""
+	if isinstance(value, Selector):
+		_selector_keys(value, keys)
+	elif isinstance(value, Controller):
+		return
+	elif isinstance(value, (Count, Exists, LazyBinaryOperation, LazyUnaryOperation)):
+		for arg in value._args:
+			_value_keys(arg, keys)
+	elif isinstance(value, OpAttr):
+		_selector_keys(value.selector, keys)
+		_tag_keys(value.tag, keys)
+	elif isinstance(value, LazyNum):
+		raise Untracked(value)
+	elif isinstance(value, (list, tuple)):
+		for item in value:
+			_value_keys(item, keys)
+	elif value is not None and not isinstance(value, (int, str)):
+		raise Untracked(value)
+
+
+def _script_keys(script, keys):
+	"""Add the version keys that an update script depends on"""
+	if isinstance(script, Refresh):
+		_selector_keys(script.selector, keys)
+		for value in (script.tags or {}).values():
+			if not callable(value):
+				_value_keys(value, keys)
+		for value in script.kwargs.values():
+			_value_keys(value, keys)
+	elif isinstance(script, IfThen) and not script.callback and script.times == 1:
+		condition, then_actions = script._args
+		_value_keys(condition, keys)
+		for action in (then_actions if isinstance(then_actions, (list, tuple)) else [then_actions]):
+			_script_keys(action, keys)
+	else:
+		# Other actions may have side effects that must happen every tick.
+		raise Untracked(script)
+
+
+def script_dependencies(script):
+	"""
+	Return the registry version keys an update script reads, or None if
+	the script must be re-evaluated on every aura refresh.
+	The result is cached on the script.
+	"""
+	try:
+		return script._dependencies
+	except AttributeError:
+		pass
+	keys = set()
+	try:
+		_script_keys(script, keys)
+		keys = frozenset(keys)
+	except Untracked:
+		keys = None
+	script._dependencies = keys
+	return keys
+
+
+#------------------------------------------------------------------------------
+# Evaluation cache
+#------------------------------------------------------------------------------
+
+# What the value of an expression depends on besides the game state
+STATE = 0
+CONTROLLER = 1
+SOURCE = 2
+
+
+def _source_dependence(value):
+	"""Return the most specific part of the source that a value reads"""
+	if value is SELF or value is OWNER:
+		return SOURCE
+	elif isinstance(value, Controller):
+		return CONTROLLER
+	elif isinstance(value, (SetOpSelector, ComparisonSelector)):
+		return max(_source_dependence(value.left), _source_dependence(value.right))
+	elif isinstance(value, OpAttr):
+		return _source_dependence(value.selector)
+	elif isinstance(value, LazyNum) and not isinstance(value, Selector):
+		return max([_source_dependence(arg) for arg in value._args], default=STATE)
+	elif isinstance(value, (list, tuple)):
+		return max([_source_dependence(item) for item in value], default=STATE)
+	return STATE
+
+
+def cache_plan(expression):
+	"""
+	Return (fingerprint, source dependence, version keys) for a selector or
+	LazyNum whose value only depends on state tracked by the registry, or
+	None if it cannot be cached. The result is cached on the expression.
+	"""
+	try:
+		return expression._cache_plan
+	except AttributeError:
+		pass
+	keys = set()
+	try:
+		_value_keys(expression, keys)
+		plan = (fingerprint(expression), _source_dependence(expression), frozenset(keys))
+	except Untracked:
+		plan = None
+	expression._cache_plan = plan
+	return plan
+
+
+class EvaluationCache:
+	"""
+	Values of the selectors and LazyNums evaluated during an aura refresh.
+
+	Values are keyed by the fingerprint of the expression, so identical
+	expressions of different cards share them, and by the source or its
+	controller if the expression reads them (eg. SELF or ALLIED). A value
+	is reused until one of the registry version keys the expression
+	depends on changes.
+	"""
+
+	def __init__(self, registry):
+		self.registry = registry
+		self.values = {}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, expression, source, compute):
+		"""Return the value of expression for source, calling compute() if
+		it is not cached"""
+		plan = cache_plan(expression)
+		if plan is None:
+			return compute()
+		expression_fingerprint, dependence, keys = plan
+		if dependence == SOURCE:
+			key = (expression_fingerprint, source)
+		elif dependence == CONTROLLER:
+			key = (expression_fingerprint, source.controller)
+		else:
+			key = (expression_fingerprint, None)
+		registry = self.registry
+		entry = self.values.get(key)
+		if entry is not None and not registry.changed_since(keys, entry[0]):
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		version = registry.version
+		value = compute()
+		self.values[key] = (version, value)
+		return value
+
+
+#------------------------------------------------------------------------------
+# Aura engine
+#------------------------------------------------------------------------------
+
+class AuraRecord:
+	"""The result of evaluating the update scripts of one aura source"""
+
+	def __init__(self, version, dependencies):
+		self.version = version
+		self.dependencies = dependencies
+		self.buffs = {}
+
+	def is_alive(self, buff):
+		if isinstance(buff, AuraBuff):
+			return buff in buff.entity.slots
+		return buff.zone == Zone.PLAY
+
+	def changed(self, registry):
+		"""Return True if the aura must be re-evaluated"""
+		if self.dependencies is None:
+			return True
+		if registry.changed_since(self.dependencies, self.version):
+			return True
+		# Buffs removed by something else need to be re-applied.
+		for buff in self.buffs:
+			if not self.is_alive(buff):
+				return True
+		return False
+
+
+class AuraEngine:
+	"""
+	Incrementally refreshes the auras (update scripts) of entities in play.
+
+	Each aura source remembers the registry version it was last evaluated
+	at, the version keys its scripts read and the buffs they refreshed.
+	An aura is only re-evaluated when one of those keys changed since.
+	Buffs an aura stops refreshing (or whose source left play) are
+	destroyed, exactly as a full refresh would.
+	"""
+
+	def __init__(self, game):
+		self.game = game
+		self.records = {}
+		self.current = None
+		self.loose = {}
+		self.full_refresh = False
+		# Evaluation cache of the refresh in progress
+		self.cache = None
+
+	def _fork(self, forker):
+		# The evaluation cache belongs to a refresh of the original game.
+		ret = forker.copy_object(self, exclude=("cache", ))
+		ret.cache = None
+		return ret
+
+	def collect(self, buff):
+		"""Called for every buff that is refreshed by an aura"""
+		if self.current is not None:
+			self.current.buffs[buff] = None
+			self.loose.pop(buff, None)
+		else:
+			self.loose[buff] = None
+
+	def reset(self):
+		"""
+		Forget every aura record, after the game state was restored.
+		All auras are re-evaluated on the next refresh, and the aura buffs
+		they no longer refresh expire as usual.
+		"""
+		self.records = {}
+		self.loose = dict.fromkeys(self.game.active_aura_buffs)
+
+	def refresh(self):
+		game = self.game
+		registry = game.registry
+		records = self.records
+		visited = {}
+		stale = []
+
+		self.cache = EvaluationCache(registry)
+		try:
+			for entity in game.entities:
+				scripts = tuple(entity.update_scripts)
+				if not scripts:
+					continue
+				visited[entity] = None
+				record = records.get(entity)
+				if record is not None and not self.full_refresh and \
+						not record.changed(registry):
+					continue
+
+				dependencies = set()
+				for script in scripts:
+					keys = script_dependencies(script)
+					if keys is None:
+						dependencies = None
+						break
+					dependencies |= keys
+				new_record = AuraRecord(registry.version, dependencies)
+				self.current = new_record
+				try:
+					# Run right away, even from within an action
+					game.run_actions(entity, scripts)
+				finally:
+					self.current = None
+				records[entity] = new_record
+				if record is not None:
+					stale += [b for b in record.buffs if b not in new_record.buffs]
+		finally:
+			self.cache = None
+
+		# Auras whose source left play stop refreshing their buffs.
+		for entity in [e for e in records if e not in visited]:
+			stale += records.pop(entity).buffs
+
+		# Buffs refreshed outside of an aura pass expire like any other.
+		loose = self.loose
+		self.loose = {}
+		stale += loose
+
+		tick = game.tick
+		for buff in stale:
+			if buff.tick < tick:
+				if buff in game.active_aura_buffs:
+					buff.remove()
+			elif buff in loose:
+				self.loose[buff] = None
+
+		game.tick += 1
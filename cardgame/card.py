@@ -12,6 +12,15 @@ from .logging import *
 MAX_HAND_SIZE = 6
 
 class BaseCard(Entity):
+	# Every tag of CardManager.map can be set on any card, eg. when a
+	# serialized state is loaded, so each mapped attribute is either a slot
+	# or a property. Subclasses add slots for the mapped attributes that
+	# they do not define as properties.
+	__slots__ = ("data", "name", "id", "type", "controller", "owner", "_zone",
+		"token", "play_counter", "creator", "parent_card", "targets",
+		"morale", "supply", "fury", "max_hand_size", "territory", "extra_corrupts",
+		"declared_attack", "declared_intercept")
+
 	Manager = CardManager
 
 	def __init__(self, data):
@@ -21,11 +30,11 @@ class BaseCard(Entity):
 		#self.requirements = data.requirements.copy()
 		self.id = data.id
 		self.controller = None
+		self.owner = None
 		self._zone = Zone.INVALID
 		self._events = data.scripts.events
-		self.tags.update(data.tags)
+		self.Manager.update(self, data.tags)
 		self.type = data.type
-		self.owner = None
 		self.token = False
 
 	def get_all_actions(self, name):
@@ -85,19 +94,34 @@ class BaseCard(Entity):
 			action_log.log("Aura from %r buffs %r with %r", source, self, buff_id)
 			buff = source.buff(self, buff_id, **kwargs)
 			buff.tick = source.game.tick
+			source.game.journal.save(source.game.active_aura_buffs)
 			source.game.active_aura_buffs.append(buff)
+		source.game.auras.collect(buff)
 
 	def refresh_tags(self, source, tags):
 		for slot in self.slots:
 			if slot.source is source:
 				slot.update_tags(tags)
+				buff = slot
 				break
 		else:
 			buff = AuraBuff(source, self)
 			action_log.log("Creating %r", buff)
 			buff.update_tags(tags)
+			journal = source.game.journal
+			journal.save(self.slots)
+			journal.save(source.game.active_aura_buffs)
 			self.slots.append(buff)
+			self.invalidate_stats()
 			source.game.active_aura_buffs.append(buff)
+		source.game.auras.collect(buff)
+
+	def __setattr__(self, name, value):
+		super().__setattr__(name, value)
+		if name == "controller" and value is not None:
+			game = value.game
+			if game is not None:
+				game.registry.controller_changed(self)
 
 	def __str__(self):
 		return self.data.name
@@ -109,6 +133,17 @@ class BaseCard(Entity):
 	def game(self):
 		return self.controller.game
 
+	@property
+	def journal(self):
+		controller = getattr(self, "controller", None)
+		if controller is not None:
+			return controller.journal
+
+	def _attr_changed(self, attr):
+		controller = self.controller
+		if controller is not None and controller.game is not None:
+			controller.game.registry.attr_changed(attr)
+
 	@property
 	def zone(self):
 		return self._zone
@@ -121,6 +156,9 @@ class BaseCard(Entity):
 		old = self.zone
 		self._zone = value
 
+		# Zone lists may have been reordered even if the zone is unchanged.
+		self.game.registry.move(self, old, value)
+
 		if old == value:
 			return
 
@@ -130,12 +168,23 @@ class BaseCard(Entity):
 			Zone.DISCARD: self.controller.discarded,
 		}
 
+		journal = self.game.journal
 		if caches.get(old) is not None:
+			journal.save(caches[old])
 			caches[old].remove(self)
 		if caches.get(value) is not None:
+			journal.save(caches[value])
 			caches[value].append(self)
 		self._zone = value
 
+		self.game.manager.zone_change(self, old, value)
+
+		# Entities only listen to events while they are in play.
+		if value == Zone.PLAY:
+			self.game.listeners.subscribe(self)
+		elif old == Zone.PLAY:
+			self.game.listeners.unsubscribe(self)
+
 		if value == Zone.PLAY:
 			self.play_counter = self.game.play_counter
 			self.game.play_counter += 1
@@ -193,6 +242,9 @@ class BaseCard(Entity):
 
 
 class LiveEntity(BaseCard):
+	__slots__ = ("_power", "_max_health", "_damage", "_verdict", "_to_be_destroyed",
+		"attacker", "defender")
+
 	power		= int_property("power")
 	#power = 0
 	max_health	= int_property("max_health")
@@ -213,6 +265,18 @@ class LiveEntity(BaseCard):
 	@to_be_destroyed.setter
 	def to_be_destroyed(self, value):
 		self._to_be_destroyed = value
+		self._health_changed()
+
+	def _attr_changed(self, attr):
+		super()._attr_changed(attr)
+		if attr == "damage" or attr == "max_health":
+			self._health_changed()
+
+	def _health_changed(self):
+		"""Mark this entity to be checked by the next Game.process_deaths"""
+		controller = self.controller
+		if controller is not None and controller.game is not None:
+			controller.game.pending_deaths[self] = None
 
 	@property
 	def damaged(self):
@@ -247,7 +311,7 @@ class LiveEntity(BaseCard):
 
 	@property
 	def corrupts(self):
-		return self.tags.get(GameTag.CORRUPT, 0) == 1
+		return self.Manager.get(self, GameTag.CORRUPT, 0) == 1
 
 	@property
 	def corrupt_actions(self):
@@ -270,6 +334,8 @@ class LiveEntity(BaseCard):
 # Unit
 #------------------------------------------------------------------------------
 class Unit(LiveEntity):
+	__slots__ = ("_inspire", "_spy", "_inform", "flipped")
+
 	inspire		= int_property("inspire")
 	spy			= int_property("spy")
 	inform		= int_property("inform")
@@ -326,10 +392,13 @@ class Unit(LiveEntity):
 			#if self._summon_index is not None:
 			#	self.controller.field.insert(self._summon_index, self)
 			#else:
+			self.game.journal.save(self.controller.field)
 			self.controller.field.append(self)
+			self._health_changed()
 
 		if self.zone == Zone.PLAY:
 			action_log.log("%r is removed from the field", self)
+			self.game.journal.save(self.controller.field)
 			self.controller.field.remove(self)
 			if self.damage:
 				self.damage = 0
@@ -359,6 +428,8 @@ class Unit(LiveEntity):
 # Spell
 #------------------------------------------------------------------------------
 class Spell(BaseCard):
+	__slots__ = ("power", "max_health", "damage", "inspire", "spy", "inform", "verdict")
+
 	def __init__(self, data):
 		#self.immune_to_spellpower = False
 		#self.receives_double_spelldamage_bonus = False
@@ -366,7 +437,7 @@ class Spell(BaseCard):
 
 	@property
 	def corrupts(self):
-		return self.tags.get(GameTag.CORRUPT, 0) == 1
+		return self.Manager.get(self, GameTag.CORRUPT, 0) == 1
 
 	#def get_damage(self, amount, target):
 	#	amount = super().get_damage(amount, target)
@@ -381,6 +452,10 @@ class Spell(BaseCard):
 # Effect
 #------------------------------------------------------------------------------
 class Effect(BaseCard):
+	__slots__ = ("_power", "_max_health", "_max_hand_size", "_inspire", "_spy",
+		"_inform", "_verdict", "damage", "source", "tick", "one_turn_effect",
+		"additional_deathrattles")
+
 	power = int_property("power")
 	#cost = int_property("cost")
 	#has_deathrattle = boolean_property("has_deathrattle")
@@ -393,9 +468,6 @@ class Effect(BaseCard):
 	inform	= int_property("inform")
 	verdict	= int_property("verdict")
 
-	buffs = []
-	slots = []
-
 	def __init__(self, data):
 		self.one_turn_effect = False
 		self.additional_deathrattles = []
@@ -422,16 +494,31 @@ class Effect(BaseCard):
 	def delayed_destruction(self):
 		return False
 
+	def _attr_changed(self, attr):
+		super()._attr_changed(attr)
+		if self.owner is not None:
+			self.owner.invalidate_stats(attr)
+			if attr == "max_health":
+				self.owner._health_changed()
+
 	def _set_zone(self, zone):
 		if zone == Zone.PLAY:
+			self.game.journal.save(self.owner.buffs)
 			self.owner.buffs.append(self)
+			self.owner.invalidate_stats()
+			self.owner._health_changed()
 		elif zone == Zone.REMOVED_FROM_GAME:
 			if self.zone == zone:
 				# Can happen if a Destroy is queued after a bounce, for example
-				action_log.logger.warning("Trying to remove %r which is already gone", self)
+				action_log.warning("Trying to remove %r which is already gone", self)
 				return
+			journal = self.game.journal
+			journal.save(self.owner.buffs)
 			self.owner.buffs.remove(self)
+			self.owner.invalidate_stats()
+			self.owner._health_changed()
 			if self in self.game.active_aura_buffs:
+				journal.save(self.game.active_aura_buffs)
 				self.game.active_aura_buffs.remove(self)
 		super()._set_zone(zone)
 
@@ -17,10 +17,17 @@ class CardScripts:
 	pass
 
 class CardDatabase(dict):
+	scriptnames = [
+		"update", "emerge", "aftermath", "corrupt", "corrupt_fail",
+		"play", "draw", "events"
+	]
+
 	def __init__(self):
 		self.initialized = False
+		# Whether the actions of card scripts are compiled, see compile()
+		self.compiled = False
 
-	def initialize(self):
+	def initialize(self, compile_scripts=False):
 		print("Initializing card database")
 		self.initialized = True
 
@@ -38,6 +45,20 @@ class CardDatabase(dict):
 					self.create_card(name, obj)
 					#print(name)
 
+		if compile_scripts:
+			self.compile()
+
+	def compile(self):
+		"""
+		Compile the actions of every card script instead of interpreting
+		them, see compile_action(). Actions that card scripts create while
+		they run are still interpreted.
+		"""
+		for card in self.values():
+			for script in self.scriptnames:
+				precompile(getattr(card.scripts, script, None), actions=True)
+		self.compiled = True
+
 	def create_card(self, id, card_class):
 		#card = card_class()
 		card = CardData(card_class.__name__)
@@ -54,10 +75,7 @@ class CardDatabase(dict):
 		# Create the scripts object
 		card.scripts = type(card_class.__name__, (card_class, ), {})
 
-		scriptnames = [
-			"update", "emerge", "aftermath", "corrupt", "corrupt_fail",
-			"play", "draw", "events"
-		]
+		scriptnames = self.scriptnames
 
 		# Convert card members to tags.
 		members = [attr for attr in dir(card_info) if not callable(getattr(card_info, attr)) and not attr.startswith("__") and not attr == "tags" and not attr in scriptnames]
@@ -133,6 +151,10 @@ class CardDatabase(dict):
 			card.choose_cards = []
 
 
+		for script in scriptnames:
+			precompile(getattr(card.scripts, script, None))
+		precompile(getattr(card, "play_targets", None))
+
 		db[id] = card
 		#print(card.name)
 
@@ -0,0 +1,32 @@
+# Deck lists of (count, card id) entries
+
+test_deck = [
+	# Aard
+	(1, "PackExile"),
+	(1, "RagepackGrowler"),
+	(1, "RedmawBerserker"),
+	(1, "BlackbloodBruiser"),
+	(1, "BonehoarderBrute"),
+	(1, "WarpackChieftan"),
+	(1, "RageheartThug"),
+	(1, "WarlordHeir"),
+	(1, "RipperPack"),
+	(1, "RageheartScreamer"),
+	(1, "WarpackHowler"),
+	#(1, "RaidpackRally"),
+	(1, "Overrun"),
+
+	# Octopi
+	(1, "OctopiExile"),
+	(1, "InfestedWhale"),
+	(1, "EchoingFiend"),
+	(1, "ServantOfElagalth"),
+	(1, "StarvingCephalopod"),
+	(1, "AgileSquirmer"),
+	(1, "NecrolightPriestess"),
+	(1, "NoxiousTentacle"),
+	#(1, "ElegalthsChosen"),
+	#(1, "AbyssalSummoning"),
+	#(1, "PotentAfterlife"),
+	#(1, "ExtremePressure"),
+]
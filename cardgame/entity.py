@@ -8,19 +8,25 @@ import sys
 
 
 class BaseEntity(object):
+	"""
+	Cards, players and their buffs are slotted; their tags are read and
+	written through the class-level Manager of their class, eg.
+	entity.Manager.get(entity, GameTag.POWER).
+	"""
+	__slots__ = ("entity_id", "_events", "buffs", "source_of_death", "_uuid")
+
 	logger = logging.log
 	type = CardType.INVALID
+	Manager = Manager
+
+	# Undo log that records the writes to this entity
+	journal = None
 
 	def __init__(self):
-		self.manager = self.Manager(self)
-		#self.tags = {}
-		self.tags = self.Manager(self)
+		self.entity_id = None
 		self._events = []
 		self.buffs = []
-		self.uuid = uuid.uuid4()
 		self.source_of_death = None
-		self.event_args = None
-		self.event_outputs = None
 
 	#def _getattr(self, attr, i):
 		#return getattr(self, attr)
@@ -30,6 +36,21 @@ class BaseEntity(object):
 	def __repr__(self):
 		return "%s" % (self.__class__.__name__)
 
+	@property
+	def uuid(self):
+		"""A unique identifier, generated on first use"""
+		try:
+			return self._uuid
+		except AttributeError:
+			self._uuid = uuid.uuid4()
+			return self._uuid
+
+	def __setattr__(self, name, value):
+		journal = self.journal
+		if journal is not None and journal.savepoints:
+			journal.record(self, name)
+		object.__setattr__(self, name, value)
+
 	def __int__(self):
 		"""Casting to an int will return the entity id"""
 		return self.entity_id
@@ -60,6 +81,10 @@ class BaseEntity(object):
 			return []
 		return actions
 
+	def _attr_changed(self, attr):
+		"""Called after an int_property attribute is written"""
+		pass
+
 	def log(self, message, *args):
 		self.logger.info(message, *args)
 
@@ -85,10 +110,16 @@ class BaseEntity(object):
 				actions.append(action)
 		ret = source.game.trigger(self, actions, args)
 		if event.once:
-			self._events.remove(event)
+			source.game.defer(self.remove_event, event)
 
 		return ret
 
+	def remove_event(self, event):
+		"""Remove an event listener that only triggers once"""
+		self.game.journal.save(self._events)
+		self._events.remove(event)
+		self.game.listeners.discard(self, event)
+
 	@property
 	def get_damage(self, amount: int, target):
 		if target.immune:
@@ -97,10 +128,13 @@ class BaseEntity(object):
 
 
 class BuffableEntity(BaseEntity):
+	__slots__ = ("slots", "_stats")
+
 	def __init__(self):
 		super().__init__()
 		self.buffs = []
 		self.slots = []
+		self._stats = {}
 
 	# Get an attribute value with buffs
 	def _getattr(self, attr, value):
@@ -114,6 +148,13 @@ class BuffableEntity(BaseEntity):
 		return value;
 		#return getattr(self.data.scripts, attr, lambda s, x: x)(self, value)
 
+	def invalidate_stats(self, attr=None):
+		"""Forget the memoized value of \a attr (or of every attribute)"""
+		if attr is None:
+			self._stats.clear()
+		else:
+			self._stats.pop(attr, None)
+
 	def clear_buffs(self):
 		if self.buffs:
 			self.log("Clearing buffs from %r", self)
@@ -121,25 +162,37 @@ class BuffableEntity(BaseEntity):
 				buff.remove()
 
 class Entity(BuffableEntity):
+	__slots__ = ()
+
 	base_events = []
 	type = CardType.INVALID
-	Manager = Manager
 
 	def __init__(self):
 		super().__init__()
 		self._events = []
 
 
+# Names of all attributes declared with int_property
+int_properties = set()
+
 def int_property(attr):
 	@property
 	def func(self):
-		ret = self._getattr(attr, 0)
-		return max(0, ret)
+		# Computed values are memoized until the attribute or a buff changes
+		stats = self._stats
+		if attr in stats:
+			return stats[attr]
+		ret = max(0, self._getattr(attr, 0))
+		stats[attr] = ret
+		return ret
 
 	@func.setter
 	def func(self, value):
 		setattr(self, "_" + attr, value)
+		self._stats.pop(attr, None)
+		self._attr_changed(attr)
 
+	int_properties.add(attr)
 	return func
 
 def slot_property(attr, f=any):
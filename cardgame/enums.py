@@ -200,6 +200,8 @@ TAG_TYPES = {
 
 	GameTag.CONTROLLER: Type.PLAYER,
 	GameTag.OWNER: Type.PLAYER,
+	GameTag.TURN_PLAYER: Type.PLAYER,
+	GameTag.STEP_PLAYER: Type.PLAYER,
 
 	GameTag.DECLARED_ATTACK: Type.ENTITY,
 	GameTag.DECLARED_INTERCEPT: Type.ENTITY,
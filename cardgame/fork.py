@@ -0,0 +1,178 @@
+import random
+import types
+from collections import defaultdict
+from .entity import BaseEntity
+from .manager import Manager
+from .utils import slots_of
+from .registry import EntityRegistry
+from .aura import AuraEngine, AuraRecord
+from .logic.events import ListenerIndex
+from .journal import Journal
+from .replay import Recording
+from .logic.actions import ActionContext, AuraBuff, Choose, Frame
+
+
+class Forker:
+	"""
+	Copies the mutable state of a game.
+
+	Entities, aura slots, the game's manager and bookkeeping objects
+	are copied, along with any list, dict, set or tuple that refers to
+	them. Everything else (card data, scripts, actions, selectors, enums,
+	strings and numbers) is shared by reference.
+	References between copied objects are remapped to their copies.
+	"""
+
+	# Classes whose instances are copied rather than shared
+	copied_types = (
+		BaseEntity, AuraBuff, Manager, EntityRegistry, ListenerIndex,
+		AuraEngine, AuraRecord, Journal, Recording, Choose,
+		ActionContext, Frame,
+	)
+
+	# Types that are known to be shared, checked inline for speed
+	shared = {type(None), bool, int, float, str}
+
+	# Copy functions by type, filled in as new types are seen
+	copiers = {}
+
+	# Slot names by type, filled in by _slots()
+	slots = {}
+
+	def __init__(self):
+		self.memo = {}
+
+	def copy(self, value):
+		"""Return the copy of value, or value itself if it is shared"""
+		cls = type(value)
+		if cls in self.shared:
+			return value
+		try:
+			return self.memo[id(value)]
+		except KeyError:
+			pass
+		copier = self.copiers.get(cls)
+		if copier is None:
+			copier = self._copier(cls)
+			if copier is None:
+				self.shared.add(cls)
+				return value
+			self.copiers[cls] = copier
+		return copier(self, value)
+
+	@classmethod
+	def _copier(cls, type):
+		if issubclass(type, cls.copied_types):
+			if hasattr(type, "_fork"):
+				return lambda self, value: value._fork(self)
+			return cls.copy_object
+		for base, copier in (
+				(random.Random, cls._copy_random),
+				(list, cls._copy_list),
+				(dict, cls._copy_dict),
+				(set, cls._copy_set),
+				(tuple, cls._copy_tuple),
+				(frozenset, cls._copy_tuple),
+				(types.MethodType, cls._copy_method)):
+			if issubclass(type, base):
+				return copier
+		return None
+
+	def copy_object(self, value, exclude=()):
+		"""
+		Copy an object and the state it refers to. Attributes named in
+		exclude are left unset on the copy.
+		"""
+		cls = type(value)
+		ret = cls.__new__(cls)
+		self.memo[id(value)] = ret
+		shared = self.shared
+		memo = self.memo
+		copy = self.copy
+		if hasattr(value, "__dict__"):
+			state = ret.__dict__
+			for k, v in value.__dict__.items():
+				if type(v) in shared:
+					state[k] = v
+				elif k not in exclude:
+					state[k] = memo.get(id(v)) or copy(v)
+		setattr = object.__setattr__
+		for k, member in self._slots(cls):
+			if k in exclude:
+				continue
+			try:
+				v = member.__get__(value)
+			except AttributeError:
+				continue
+			setattr(ret, k, v if type(v) in shared else memo.get(id(v)) or copy(v))
+		return ret
+
+	@classmethod
+	def _slots(cls, type):
+		"""
+		Return the (name, member descriptor) pairs of the slots of a class
+		and its bases
+		"""
+		try:
+			return cls.slots[type]
+		except KeyError:
+			pass
+		ret = slots_of(type)
+		cls.slots[type] = ret
+		return ret
+
+	def _copy_list(self, value):
+		ret = type(value)()
+		self.memo[id(value)] = ret
+		shared = self.shared
+		memo = self.memo
+		copy = self.copy
+		ret.extend([v if type(v) in shared else memo.get(id(v)) or copy(v)
+			for v in value])
+		return ret
+
+	def _copy_dict(self, value):
+		if isinstance(value, defaultdict):
+			ret = type(value)(value.default_factory)
+		else:
+			ret = type(value)()
+		self.memo[id(value)] = ret
+		shared = self.shared
+		memo = self.memo
+		copy = self.copy
+		ret.update([(
+			k if type(k) in shared else memo.get(id(k)) or copy(k),
+			v if type(v) in shared else memo.get(id(v)) or copy(v))
+			for k, v in value.items()])
+		return ret
+
+	def _copy_set(self, value):
+		ret = type(value)()
+		self.memo[id(value)] = ret
+		ret.update(map(self.copy, value))
+		return ret
+
+	def _copy_random(self, value):
+		# The copy draws the same numbers as the original from here on.
+		ret = type(value)()
+		ret.setstate(value.getstate())
+		self.memo[id(value)] = ret
+		return ret
+
+	def _copy_method(self, value):
+		# Eg. a call deferred by the action stack; methods of copied
+		# objects are bound to their copies
+		obj = self.copy(value.__self__)
+		if obj is value.__self__:
+			return value
+		return types.MethodType(value.__func__, obj)
+
+	def _copy_tuple(self, value):
+		# Immutable, so only rebuilt when an item was copied
+		shared = self.shared
+		copy = self.copy
+		items = [item if type(item) in shared else copy(item) for item in value]
+		for old, new in zip(value, items):
+			if old is not new:
+				return type(value)(items)
+		return value
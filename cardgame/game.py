@@ -5,7 +5,15 @@ from .player import Player
 from .entity import Entity
 from .card import Unit, Spell, Effect
 from .manager import GameManager
-from .utils import CardList
+from .registry import EntityRegistry
+from .logic.events import ListenerIndex
+from .aura import AuraEngine
+from .fork import Forker
+from .journal import Journal
+from .replay import Recording, recorded, new_seed, ENTITY, ENTITIES
+from .logging import game_log
+from . import snapshot
+from .utils import CardList, CardView
 from .enums import *
 from .logic.actions import *
 from .cards import *
@@ -15,13 +23,28 @@ import json
 class Game(Entity):
 	Manager = GameManager
 
-	def __init__(self):
+	def __init__(self, seed=None, record=False):
+		"""
+		Random events are drawn from a generator seeded with \a seed, or
+		from the random module if no seed is given. If \a record is true,
+		the inputs of the game are recorded in self.recording, so that it
+		can be replayed.
+		"""
 		super().__init__()
+		self.manager = GameManager(self)
+		self.journal = Journal(self)
+		if record and seed is None:
+			seed = new_seed()
+		self.seed = seed
+		self.random = random.Random(seed) if seed is not None else random
+		self.recording = Recording(seed) if record else None
 		self.controller = None
 		self.zone = Zone.PLAY
 		self.type = CardType.GAME
 		self.data = None
 		self.removed_entities = []
+		self.registry = EntityRegistry()
+		self.listeners = ListenerIndex()
 
 		players = [
 			self.create_card("PlayerCard"),
@@ -33,6 +56,16 @@ class Game(Entity):
 		self.play_counter = 0
 		self.tick = 0
 		self.active_aura_buffs = CardList()
+		self.auras = AuraEngine(self)
+		self.pending_deaths = {}
+		# Frames of the actions being triggered, innermost last, and the
+		# height of the stack when the current step of each run_frames()
+		# began
+		self.action_stack = []
+		self.frame_marks = []
+		# Frames set aside until the pending choice is made
+		self.suspended_actions = []
+		self.choice = None
 
 		self.players = players
 		self.player1 = self.players[0]
@@ -43,10 +76,13 @@ class Game(Entity):
 		self.player2.opponent = self.player1
 		self.manager.new_entity(self)
 		self.game = self
+		self.registry.add(self)
 		for player in players:
 			player.controller = player
 			player.game = self
 			self.manager.new_entity(player)
+			self.registry.add(player)
+			self.listeners.subscribe(player)
 
 		self.current_player = players[0] # Player whose turn it is.
 		self.step_player = players[0] # Player who controls the current step
@@ -68,12 +104,62 @@ class Game(Entity):
 	def __repr__(self):
 		return "%s" % (self.__class__.__name__)
 
+	def fork(self):
+		"""
+		Return an independent copy of the game, for searching or trying
+		out actions. Card data and scripts are shared with the original;
+		observers of the game are not copied. Neither is its history: the
+		fork starts with an empty journal and is not recorded.
+		"""
+		return Forker().copy(self)
+
+	@recorded()
+	def begin_transaction(self):
+		"""
+		Open a savepoint that the game can be rolled back to.
+		Transactions can be nested.
+		"""
+		self.journal.begin()
+
+	@recorded()
+	def commit(self):
+		"""Keep the changes made since the last begin_transaction()"""
+		self.journal.commit()
+
+	@recorded()
+	def rollback(self):
+		"""Undo the changes made since the last begin_transaction()"""
+		self.journal.rollback()
+
+	@recorded()
+	def enable_turn_rollback(self):
+		"""
+		Open a savepoint at the beginning of every turn from now on, so
+		that the current player's turn can be rolled back with
+		rollback_turn(). Every change made during a turn is then recorded
+		in the journal.
+		"""
+		self.journal.turns = True
+
+	@recorded()
+	def rollback_turn(self):
+		"""
+		Roll the game back to the beginning of the current player's turn,
+		closing the transactions begun since. The savepoint is taken before
+		BeginTurn, so the start of the turn is performed again.
+		"""
+		self.journal.rollback_turn()
+		self.begin_turn(self.current_player)
+		if self.step == Step.UNFLIP:
+			# Finish the start of the turn that end_step() was performing
+			self.end_step()
+
 	def serialize_state(self):
 		state = {}
 		for entity in self:
 			entity_state = {}
 			state[entity.entity_id] = entity_state
-			for tag, value in entity.tags.items():
+			for tag, value in entity.Manager.items(entity):
 				type = tag.type
 				if isinstance(value, str):
 					entity_state[tag] = value
@@ -102,8 +188,7 @@ class Game(Entity):
 			else:
 				card_id = tags[GameTag.CARD_ID]
 				entity = self.create_card(card_id)
-				self.game.manager.new_entity(entity)
-				entity.entity_id = entity_id
+				self.game.manager.new_entity(entity, entity_id)
 			if entity:
 				entities[entity_id] = entity
 
@@ -111,14 +196,22 @@ class Game(Entity):
 		for entity_id, tags in state.items():
 			entity = entities[entity_id]
 
-			entity.controller = tags.get(GameTag.CONTROLLER, None)
+			entity.controller = entities.get(tags.get(GameTag.CONTROLLER, None))
 
 			for tag, value in tags.items():
 				type = tag.type
 				if type == Type.ENTITY or type == Type.PLAYER:
 					value = entities.get(value, None)
-				entity.tags[tag] = value
+				entity.Manager.set(entity, tag, value)
+
+
+	def dump_snapshot(self):
+		"""Return the state of the game as a compact binary snapshot"""
+		return snapshot.dumps(self)
 
+	def load_snapshot(self, data):
+		"""Load the state of a game from a binary snapshot"""
+		self.deserialize_state(snapshot.loads(data))
 
 	# Function to create a card instance of the correct class.
 	def create_card(self, id):
@@ -132,6 +225,7 @@ class Game(Entity):
 		card = subclass(data)
 		return card
 
+	@recorded(card=ENTITY, targets=ENTITIES)
 	def play_card(self, card, targets=[]):
 		type = BlockType.PLAY
 		player = card.controller
@@ -148,43 +242,70 @@ class Game(Entity):
 
 	# Iterate over all entities
 	def __iter__(self):
-		return chain(self.entities, self.hands, self.decks, self.discarded)
+		return iter(self.registry.view("all", self._all_entities))
 
+	def _all_entities(self):
+		return CardView(chain(self.entities, self.hands, self.decks, self.discarded))
+
+	# The views below are read-only snapshots that are cached by the
+	# registry until an entity changes zones.
 	@property
 	def entities(self):
-		#return CardList(chain(self.players[0].entities, self.players[1].entities))
-		return CardList(chain([self], self.players[0].entities, self.players[1].entities))
+		return self.registry.view("entities", self._entities)
+
+	def _entities(self):
+		return CardView(chain([self], self.players[0].entities, self.players[1].entities))
+
+	@property
+	def entity_positions(self):
+		"""Map of each entity in self.entities to its position"""
+		return self.registry.view("entity_positions", self._entity_positions)
+
+	def _entity_positions(self):
+		return {entity: i for i, entity in enumerate(self.entities)}
 
 	@property
 	def live_entities(self):
-		return CardList(chain(self.players[0].live_entities, self.players[1].live_entities))
+		return self.board
 
 	@property
 	def board(self):
-		return CardList(chain(self.players[0].field, self.players[1].field))
+		return self.registry.view("board", self._board)
+
+	def _board(self):
+		return CardView(chain(self.players[0].field, self.players[1].field))
 
 	@property
 	def decks(self):
-		return CardList(chain(self.players[0].deck, self.players[1].deck))
+		return self.registry.view("decks", self._decks)
+
+	def _decks(self):
+		return CardView(chain(self.players[0].deck, self.players[1].deck))
 
 	@property
 	def discarded(self):
-		return CardList(chain(self.players[0].discarded, self.players[1].discarded))
+		return self.registry.view("discarded", self._discarded)
+
+	def _discarded(self):
+		return CardView(chain(self.players[0].discarded, self.players[1].discarded))
 
 	@property
 	def hands(self):
-		return CardList(chain(self.players[0].hand, self.players[1].hand))
+		return self.registry.view("hands", self._hands)
+
+	def _hands(self):
+		return CardView(chain(self.players[0].hand, self.players[1].hand))
 
 	def print_state(self):
-		print("GAME STATE:")
+		game_log.info("GAME STATE:")
 		for entity in self:
-			print(" %3d. %r" %(entity.entity_id, entity))
+			game_log.info(" %3d. %r", entity.entity_id, entity)
 		for player in self.players:
-			print("  %r" %(player))
+			game_log.info("  %r", player)
 			#for entity in player.entities:
-			#	print("   %3d. %r" %(entity.entity_id, entity))
+			#	game_log.info("   %3d. %r", entity.entity_id, entity)
 			for unit in player.field:
-				print("   %3d. %d/%d %s" %(unit.entity_id, unit.power, unit.health, unit.name))
+				game_log.info("   %3d. %d/%d %s", unit.entity_id, unit.power, unit.health, unit.name)
 
 	def action_start(self, type, source, index, targets):
 		self.manager.action_start(type, source, index, targets)
@@ -205,36 +326,118 @@ class Game(Entity):
 		self.process_deaths()
 
 	def action_block(self, source, actions, type, index=-1, targets=None, event_args=None):
-		self.action_start(type, source, index, targets)
-		if actions:
-			ret = self.queue_actions(source, actions, event_args)
-		else:
-			ret = []
-		self.action_end(type, source)
-		return ret
+		context = ActionContext(source, event_args)
+		return self.queue_frame(BlockFrame(context, actions, type, index, targets))
 
 	def queue_actions(self, source, actions, event_args=None, event_outputs=None):
+		"""
+		Queue \a actions to trigger from \a source in order (see
+		queue_frame()) and return their results. The actions see
+		\a event_args and \a event_outputs as Action.FOO arguments and
+		Choose.CHOICE. Actions queue the actions they trigger with
+		ActionContext.queue() instead, so that they see the arguments of
+		their own context.
+		"""
 		if not isinstance(actions, list):
 			actions = [actions]
-		prev_event_args = source.event_args
-		prev_event_outputs = source.event_outputs
-		if event_args:
-			source.event_args = event_args
-		if event_outputs:
-			source.event_outputs = event_outputs
-		result = self.trigger_actions(source, actions)
-		source.event_outputs = prev_event_outputs
-		source.event_args = prev_event_args
-		return result
-
-	def trigger_actions(self, source, actions):
-		result = []
-		for action in actions:
-			if isinstance(action, EventListener):
-				raise NotImplementedError
-			else:
-				result.append(action.trigger(source))
-		return result
+		context = ActionContext(source, event_args, event_outputs)
+		return self.queue_frame(ActionFrame(context, actions))
+
+	def run_actions(self, source, actions, context=None):
+		"""
+		Trigger \a actions from \a source in \a context (or a new one)
+		right away, even from within an action, and return their results
+		"""
+		if context is None or context.source is not source:
+			context = ActionContext(source)
+		frame = ActionFrame(context, list(actions))
+		self.run_frames([frame])
+		return frame.results
+
+	def queue_frame(self, frame):
+		"""
+		Queue \a frame to run once the current step of run_frames() is
+		done, before the frame being stepped goes on, or run it right away
+		if no frame is being run. Return the results of the frame, which
+		are complete once it has run.
+		"""
+		if self.frame_marks:
+			self.action_stack.append(frame)
+		else:
+			self.run_frames([frame])
+		return frame.results
+
+	def defer(self, function, *args):
+		"""
+		Call function(*args) once the frames queued by the current step of
+		run_frames() have run, or right away if there are none
+		"""
+		marks = self.frame_marks
+		if marks and len(self.action_stack) > marks[-1]:
+			self.action_stack.append(CallFrame(function, args))
+		else:
+			function(*args)
+
+	def run_frames(self, frames):
+		"""
+		Run \a frames, innermost last, until they and the frames they queue
+		are done. Frames are stepped from the top of the action stack, and
+		the frames a step queues are pushed on top of it in reverse, so
+		they run in the order they were queued before the frame that
+		queued them goes on; actions triggered from actions do not recurse.
+		If a step starts a choice, the frames left are suspended until the
+		choice is made (see resume_actions()).
+		"""
+		stack = self.action_stack
+		marks = self.frame_marks
+		depth = len(stack)
+		mark = len(self.suspended_actions)
+		stack += frames
+		marks.append(depth)
+		try:
+			while len(stack) > depth:
+				frame = stack[-1]
+				top = marks[-1] = len(stack)
+				choice = self.choice
+				done = frame.step(self)
+				if len(stack) > top:
+					queued = stack[top:]
+					queued.reverse()
+					del stack[top - 1 if done else top:]
+					stack += queued
+				elif done:
+					stack.pop()
+				if self.choice is not choice and self.choice is not None:
+					self.suspend_actions(stack[depth:], mark)
+					del stack[depth:]
+		finally:
+			marks.pop()
+			del stack[depth:]
+
+	def suspend_actions(self, frames, mark):
+		"""
+		Set \a frames aside until the pending choice is made. They are
+		inserted at \a mark, before the frames suspended by the
+		run_frames() they started, which will be resumed first.
+		"""
+		game_log.debug("Suspending %r until %r is made", frames, self.choice)
+		suspended = self.suspended_actions
+		self.journal.save(suspended)
+		suspended[mark:mark] = frames
+
+	def resume_actions(self):
+		"""
+		Run the suspended frames, the most recently suspended first, until
+		they are all done or another choice is started.
+		"""
+		suspended = self.suspended_actions
+		if not suspended or self.choice is not None:
+			return
+		self.journal.save(suspended)
+		frames = [frame.resumed() for frame in suspended]
+		del suspended[:]
+		game_log.debug("Resuming %r", frames)
+		self.run_frames(frames)
 
 	def trigger(self, source, actions, event_args):
 		"""
@@ -250,28 +453,31 @@ class Game(Entity):
 		return self.trigger(source, actions, event_args=None)
 
 	def find_entity(self, id):
-		entity = [e for e in self.game if e.entity_id == id]
-		if len(entity) > 0:
-			return entity[0]
-		return None
+		return self.manager.find_entity(id)
 
 	def find_removed_entity(self, id):
-		entity = [e for e in self.removed_entities if e.entity_id == id]
-		if len(entity) > 0:
-			return entity[0]
-		return None
+		return self.manager.find_removed_entity(id)
 
 	def remove_entity(self, entity):
 		"""Remove an entity from the game, changing its zone to
 		REMOVED_FROM_GAME"""
 		entity.zone = Zone.REMOVED_FROM_GAME
+		self.journal.save(self.removed_entities)
 		self.removed_entities.append(entity)
 
 	def process_deaths(self):
-		cards = []
-		for card in self.live_entities:
-			if card.to_be_destroyed:
-				cards.append(card)
+		if not self.pending_deaths:
+			return
+
+		# Only units whose health or destruction flag changed since the
+		# last pass can have died.
+		pending = self.pending_deaths
+		self.pending_deaths = {}
+		positions = self.entity_positions
+		cards = sorted((card for card in pending
+				if card.type == CardType.UNIT and card.zone == Zone.PLAY and
+				card.to_be_destroyed),
+			key=positions.__getitem__)
 
 		actions = []
 		if len(cards) > 0:
@@ -284,30 +490,13 @@ class Game(Entity):
 			self.trigger(self, actions, event_args=None)
 
 	def refresh_auras(self):
-		refresh_queue = []
-		for entity in self.entities:
-			for script in entity.update_scripts:
-				refresh_queue.append((entity, script))
-
-		#for entity in self.hands:
-		#	for script in entity.data.scripts.Hand.update:
-		#		refresh_queue.append((entity, script))
-
-		# Sort the refresh queue by refresh priority (used by eg. Lightspawn)
-		#refresh_queue.sort(key=lambda e: getattr(e[1], "priority", 50))
-		for entity, action in refresh_queue:
-			action.trigger(entity)
-
-		buffs_to_destroy = []
-		for buff in self.active_aura_buffs:
-			if buff.tick < self.tick:
-				buffs_to_destroy.append(buff)
-		for buff in buffs_to_destroy:
-			buff.remove()
-
-		self.tick += 1
+		self.auras.refresh()
 
+	@recorded(player=ENTITY)
 	def begin_turn(self, player):
+		# Players can roll back to the beginning of their turn, if turn
+		# rollback is enabled.
+		self.journal.checkpoint()
 		ret = self.queue_actions(self, [BeginTurn(player)])
 		self.process_deaths()
 		self.manager.turn(player)
@@ -317,18 +506,19 @@ class Game(Entity):
 		self.queue_actions(self, [EndTurn(player)])
 		self.process_deaths()
 
+	@recorded()
 	def end_step(self):
 		if self.step == Step.DECLARE:
 			self.step = Step.RESPONSE
 			self.choosing_player = self.current_player.opponent
 			self.step_player = self.current_player.opponent
-			print("Entering response step for %s" %(self.current_player.opponent))
+			game_log.debug("Entering response step for %s", self.current_player.opponent)
 
 		elif self.step == Step.RESPONSE:
 			self.step = Step.COMBAT
 			self.choosing_player = None
 			self.step_player = None
-			print("Entering combat step for %s" %(self.current_player))
+			game_log.debug("Entering combat step for %s", self.current_player)
 
 		# Combat step happens automatically
 		if self.step == Step.COMBAT:
@@ -337,7 +527,7 @@ class Game(Entity):
 			self.step = Step.PLAY
 			self.choosing_player = self.current_player
 			self.step_player = self.current_player
-			print("Entering play step for %s" %(self.current_player))
+			game_log.debug("Entering play step for %s", self.current_player)
 
 		elif self.step == Step.PLAY:
 			self.end_turn(self.current_player)
@@ -347,7 +537,7 @@ class Game(Entity):
 			self.choosing_player = None
 			self.step_player = None
 			self.turn += 1
-			print("Entering unflip step for %s" %(self.current_player))
+			game_log.debug("Entering unflip step for %s", self.current_player)
 			self.begin_turn(self.current_player)
 
 		# Unflip step happens automatically
@@ -357,7 +547,7 @@ class Game(Entity):
 			self.step = Step.RESOURCE
 			self.choosing_player = self.current_player
 			self.step_player = self.current_player
-			print("Entering resource step for %s" %(self.current_player))
+			game_log.debug("Entering resource step for %s", self.current_player)
 			self.step_player.morale += 1
 			self.step_player.supply += 1
 			self.step_player.draw(1)
@@ -367,7 +557,17 @@ class Game(Entity):
 			self.step = Step.DECLARE
 			self.choosing_player = self.current_player
 			self.step_player = self.current_player
-			print("Entering declare step for %s" %(self.current_player))
+			game_log.debug("Entering declare step for %s", self.current_player)
+
+	@recorded(attacker=ENTITY, defender=ENTITY)
+	def declare_attack(self, attacker, defender):
+		"""Declare an attack of \a attacker on \a defender, or cancel it if None"""
+		attacker.declared_attack = defender
+
+	@recorded(interceptor=ENTITY, attacker=ENTITY)
+	def declare_intercept(self, interceptor, attacker):
+		"""Declare that \a interceptor intercepts \a attacker, or cancel it if None"""
+		interceptor.declared_intercept = attacker
 
 	def unflip_units(self, player):
 		for unit in player.field:
@@ -375,7 +575,7 @@ class Game(Entity):
 				unit.unflip()
 
 	def resolve_combat(self):
-		print("Resolving all combat")
+		game_log.debug("Resolving all combat")
 		attacks = []
 
 		# Gather a list of attacker/defender pairs
@@ -0,0 +1,263 @@
+import random
+from .enums import *
+from .entity import BaseEntity
+from .exceptions import InvalidAction
+from .logic.actions import AuraBuff
+from .utils import slots_of
+
+# Old value of an attribute that did not exist before it was written
+MISSING = object()
+
+# State of the objects that have no __dict__
+_no_state = {}
+
+
+class Savepoint:
+	"""
+	A position in the undo log that the game can be rolled back to, with
+	the state of the game's random generator if it has its own. \a turn is
+	True for the savepoints opened at the beginning of a turn.
+	"""
+
+	def __init__(self, position, pending_deaths, random_state=None, turn=False):
+		self.position = position
+		self.pending_deaths = pending_deaths
+		self.random_state = random_state
+		self.turn = turn
+		# ids of the lists already saved since this savepoint
+		self.saved = set()
+
+
+class Journal:
+	"""
+	Undo log of the changes made to a game.
+
+	While a transaction is open, every attribute written on an entity or an
+	aura slot (including writes through their tag managers) is recorded
+	with its previous value, and every zone, buff and slot list is saved
+	before it is first changed. Rolling back replays the log backwards, so
+	it costs O(changes) rather than O(state). The indexes derived from that
+	state (entity ids, registry, listeners, auras) are then repaired for
+	the entities that changed.
+
+	Transactions can be nested: each begin() opens a savepoint that is
+	closed by a matching commit() or rollback(). Nothing is recorded while
+	no savepoint is open.
+
+	If \a turns is true, checkpoint() also opens a savepoint at the
+	beginning of every turn, which rollback_turn() rolls back to. It
+	replaces the savepoint of the previous turn and is kept apart from
+	the transactions: commit() and rollback() close the innermost
+	savepoint opened by begin(), along with the turn savepoints opened
+	after it.
+
+	Entities and aura slots are slotted, so attributes are read and
+	restored through the member descriptors of their slots, or through
+	__dict__ for the attributes that are not slots.
+	"""
+
+	# Slot member descriptors by class, then by attribute name
+	members = {}
+
+	def __init__(self, game):
+		self.game = game
+		self.entries = []
+		self.savepoints = []
+		# Whether a savepoint is opened at the beginning of each turn
+		self.turns = False
+
+	def _fork(self, forker):
+		"""
+		Return an empty journal for a forked game: the history of the
+		original is not copied, so the fork has no savepoints to roll back
+		to until it opens its own
+		"""
+		ret = Journal(forker.copy(self.game))
+		ret.turns = self.turns
+		return ret
+
+	@classmethod
+	def _member(cls, obj, name):
+		"""Return the member descriptor of the slot \a name of obj, or None"""
+		members = cls.members.get(type(obj))
+		if members is None:
+			members = cls.members[type(obj)] = dict(slots_of(type(obj)))
+		return members.get(name)
+
+	def record(self, obj, name):
+		"""Record the value of an attribute before it is written"""
+		try:
+			member = self.members[type(obj)].get(name)
+		except KeyError:
+			member = self._member(obj, name)
+		if member is not None:
+			try:
+				old = member.__get__(obj)
+			except AttributeError:
+				old = MISSING
+		else:
+			old = getattr(obj, "__dict__", _no_state).get(name, MISSING)
+		self.entries.append((obj, name, old))
+
+	def save(self, items):
+		"""Record the contents of a list before it is changed"""
+		if not self.savepoints:
+			return
+		saved = self.savepoints[-1].saved
+		if id(items) not in saved:
+			saved.add(id(items))
+			self.entries.append((items, None, items[:]))
+
+	def begin(self, turn=False):
+		"""Open a savepoint"""
+		game = self.game
+		random_state = None
+		if isinstance(game.random, random.Random):
+			random_state = game.random.getstate()
+		savepoint = Savepoint(len(self.entries), dict(game.pending_deaths),
+			random_state, turn)
+		self.savepoints.append(savepoint)
+
+	def commit(self):
+		"""Close the innermost transaction, keeping its changes"""
+		index = self._innermost(False)
+		if index is None:
+			raise InvalidAction("No transaction to commit")
+		self._close(index)
+
+	def checkpoint(self):
+		"""
+		Open the savepoint of the turn that begins, if turn savepoints are
+		kept, in place of that of the previous turn
+		"""
+		if not self.turns:
+			return
+		index = self._innermost(True)
+		if index is not None:
+			self._close(index)
+		self.begin(turn=True)
+
+	@property
+	def turn_savepoint(self):
+		"""The savepoint of the current turn, or None"""
+		index = self._innermost(True)
+		return self.savepoints[index] if index is not None else None
+
+	def _innermost(self, turn):
+		"""Return the index of the innermost savepoint of a kind, or None"""
+		for index in range(len(self.savepoints) - 1, -1, -1):
+			if self.savepoints[index].turn == turn:
+				return index
+		return None
+
+	def _close(self, index):
+		"""Close the savepoint at \a index, keeping its changes"""
+		savepoints = self.savepoints
+		savepoint = savepoints.pop(index)
+		if index > 0:
+			savepoints[index - 1].saved |= savepoint.saved
+		elif savepoints:
+			# The changes before the outermost savepoint can be forgotten.
+			position = savepoints[0].position
+			del self.entries[:position]
+			for savepoint in savepoints:
+				savepoint.position -= position
+		else:
+			self.entries.clear()
+
+	def rollback(self):
+		"""
+		Undo every change since the innermost transaction began and close
+		it, along with any turn savepoint opened since
+		"""
+		index = self._innermost(False)
+		if index is None:
+			raise InvalidAction("No transaction to roll back")
+		self._rollback(index)
+
+	def rollback_turn(self):
+		"""Undo every change since the current turn began"""
+		index = self._innermost(True)
+		if index is None:
+			raise InvalidAction("No turn to roll back")
+		self._rollback(index)
+
+	def _rollback(self, index):
+		"""Undo every change since the savepoint at \a index and close it"""
+		savepoint = self.savepoints[index]
+		del self.savepoints[index:]
+		entries = self.entries[savepoint.position:]
+		del self.entries[savepoint.position:]
+
+		changed = {}
+		reordered = False
+		for obj, name, old in entries:
+			if name is None:
+				reordered = True
+			else:
+				changed[obj] = None
+		for obj in changed:
+			self._forget(obj)
+
+		for obj, name, old in reversed(entries):
+			if name is None:
+				obj[:] = old
+				continue
+			member = self._member(obj, name)
+			if member is not None:
+				if old is not MISSING:
+					member.__set__(obj, old)
+				else:
+					try:
+						member.__delete__(obj)
+					except AttributeError:
+						pass
+			elif old is not MISSING:
+				obj.__dict__[name] = old
+			elif hasattr(obj, "__dict__"):
+				obj.__dict__.pop(name, None)
+
+		game = self.game
+		for obj in changed:
+			self._restore(obj)
+		if reordered:
+			for zone in (Zone.PLAY, Zone.HAND, Zone.DECK, Zone.DISCARD):
+				game.registry.touch(zone)
+		game.pending_deaths = dict(savepoint.pending_deaths)
+		if savepoint.random_state is not None:
+			game.random.setstate(savepoint.random_state)
+		game.auras.reset()
+
+	def _forget(self, obj):
+		"""Drop an entity from the indexes before its state is restored"""
+		if isinstance(obj, BaseEntity):
+			self.game.manager.forget(obj)
+			self._invalidate(obj)
+		elif isinstance(obj, AuraBuff):
+			self._invalidate(obj)
+
+	def _restore(self, obj):
+		"""Index an entity again after its state was restored"""
+		if isinstance(obj, AuraBuff):
+			self._invalidate(obj)
+			return
+		if not isinstance(obj, BaseEntity):
+			return
+		game = self.game
+		game.registry.discard(obj)
+		game.listeners.unsubscribe(obj)
+		if obj.entity_id is not None:
+			game.manager.index(obj)
+			game.registry.add(obj)
+			if obj.zone == Zone.PLAY:
+				game.listeners.subscribe(obj)
+		self._invalidate(obj)
+
+	def _invalidate(self, obj):
+		"""Drop the memoized stats that depend on an entity or aura slot"""
+		if isinstance(obj, BaseEntity):
+			obj.invalidate_stats()
+		for name in ("owner", "entity"):
+			owner = getattr(obj, name, None)
+			if owner is not None:
+				owner.invalidate_stats()
@@ -1,28 +1,168 @@
+import contextlib
+import os
+
+# Log levels
+TRACE = 5
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+
+def _discard(message, *args):
+	pass
+
 
 class Logger:
+	"""
+	A named log with a minimum level.
+
+	Messages are formatted lazily (`log.info("%r plays %r", player, card)`)
+	and only once the level check passed, so a disabled call never pays for
+	repr() or I/O. The methods of levels below the minimum are replaced by
+	a no-op on the instance, which compiles those calls out entirely.
+	"""
 
-	def __init__(self, name):
+	def __init__(self, name, level=TRACE):
 		self.name = name
-		self.enabled = True
+		self.set_level(level)
+		loggers[name] = self
+
+	def set_level(self, level):
+		self.level = level
+		self.enabled = level <= TRACE
+		state = self.__dict__
+		for name, method_level in (
+				("log", TRACE), ("trace", TRACE), ("debug", DEBUG),
+				("info", INFO), ("warning", WARNING), ("error", ERROR)):
+			if method_level < level:
+				state[name] = _discard
+			else:
+				state.pop(name, None)
+
+	def is_enabled_for(self, level):
+		return level >= self.level
+
+	def emit(self, level, message, args):
+		sink.write(self.name, level, message, args)
+
+	def trace(self, message, *args):
+		self.emit(TRACE, message, args)
+
+	# Action tracing
+	log = trace
+
+	def debug(self, message, *args):
+		self.emit(DEBUG, message, args)
 
 	def info(self, message, *args):
-		print(message % args)
+		self.emit(INFO, message, args)
+
+	def warning(self, message, *args):
+		self.emit(WARNING, message, args)
 
-	def log(self, message, *args):
-		if self.enabled:
-			print("%s: %s" %(self.name, message % args))
+	def error(self, message, *args):
+		self.emit(ERROR, message, args)
 
 	def disable(self):
-		self.enabled = False
+		self.set_level(OFF)
 
 	def enable(self):
-		self.enabled = True
+		self.set_level(TRACE)
+
+
+class ConsoleSink:
+	"""
+	Writes log records to stdout as they are emitted.
+
+	A sink receives the unformatted records of every logger through
+	write(). Sinks that keep the recent records in memory also implement
+	dump(), which is called when the game crashes.
+	"""
+
+	def write(self, name, level, message, args):
+		if args:
+			message = message % args
+		print("%s: %s" %(name, message))
+
+	def dump(self, reason=None):
+		pass
+
+	def close(self):
+		pass
 
-log = Logger("Default Log")
 
+sink = ConsoleSink()
 
+
+def set_sink(new_sink):
+	"""Route the records of every logger to new_sink and return the previous sink"""
+	global sink
+	old_sink = sink
+	sink = new_sink
+	return old_sink
+
+
+def dump_recent(reason=None):
+	"""Dump the records kept in memory by the sink, if any"""
+	sink.dump(reason)
+
+
+# Every logger by name
+loggers = {}
+
+log = Logger("Default Log")
+game_log = Logger("Game Log")
 action_log = Logger("Action Log")
 #entity = Logger("Entity Log")
 #event = Logger("Event Log")
 #protocol = Logger("Protocol Log")
 
+
+# Minimum levels of each logger, by profile. Loggers that are not listed
+# use the "*" level.
+profiles = {
+	# Everything, including action traces
+	"debug": {"*": TRACE},
+	# Only warnings and errors, with action tracing compiled out, for
+	# production servers and simulations
+	"headless": {"*": WARNING, "Action Log": OFF},
+}
+
+profile = os.environ.get("CARDGAME_LOG_PROFILE", "debug")
+
+
+def profile_level(name):
+	levels = profiles[profile]
+	return levels.get(name, levels["*"])
+
+
+def configure(name):
+	"""Set the level of every logger from the profile called name"""
+	global profile
+	profile = name
+	for logger in loggers.values():
+		logger.set_level(profile_level(logger.name))
+
+
+@contextlib.contextmanager
+def using(name):
+	"""Use the profile called name for the duration of a with block"""
+	previous = profile
+	configure(name)
+	try:
+		yield
+	finally:
+		configure(previous)
+
+
+def get_logger(name):
+	"""Return the logger called name, creating it at the profile's level"""
+	logger = loggers.get(name)
+	if logger is None:
+		logger = Logger(name, profile_level(name))
+	return logger
+
+
+configure(profile)
@@ -1,3 +1,4 @@
+import copy
 from collections import OrderedDict
 from abc import ABCMeta, abstractmethod
 from .events import EventListener
@@ -10,7 +11,7 @@ from ..logging import action_log
 from ..manager import Manager, CardManager
 from ..utils import listify
 
-def _eval_card(source, card):
+def _eval_card(context, card):
 	"""
 	Return a Card instance from \a card
 	The card argument can be:
@@ -18,10 +19,11 @@ def _eval_card(source, card):
 	- The string ID of the card (the card is created)
 	- A LazyNum (the card is dynamically created)
 	"""
+	source = context.source
 	if isinstance(card, LazyNum):
-		card = card.eval(source)
+		card = card.eval(source, context)
 	elif isinstance(card, Action):
-		card = card.trigger(source)[0]
+		card = source.game.run_actions(source, [card], context)[0]
 
 	if not isinstance(card, list):
 		cards = [card]
@@ -40,7 +42,10 @@ def _eval_card(source, card):
 
 class ActionMeta(type):
 	def __new__(metacls, name, parents, namespace):
-		cls = type.__new__(metacls, name, parents, dict(namespace))
+		namespace = dict(namespace)
+		# Actions only have the attributes their classes declare
+		namespace.setdefault("__slots__", ())
+		cls = type.__new__(metacls, name, parents, namespace)
 		# Compile the argument list
 		argslist = []
 		for key, value in namespace.items():
@@ -63,39 +68,45 @@ class ActionArg(LazyNum):
 		self.name = name
 		self.owner = owner
 
+	contextual = True
+
 	def __repr__(self):
 		return "<%s.%s>" % (self.owner.__name__, self.name)
 
-	def evaluate(self, source):
+	def eval(self, source, context=None):
 		"""Returns the value of this argument that was passed in to the
 		previous action, when referenced as Action.FOO from a predicate action.
 		Example:
 		Summon(CONTROLLER, "Card").then(Damage(Summon.CARD, 2))"""
 
 		# This is used when an event listener triggers and the callback
-		# Action has arguments of the type Action.FOO
-		# XXX we rely on source.event_args to be set, but it's very racey.
-		# If multiple events happen on an entity at once, stuff will go wrong.
-		assert source.event_args
-		return source.event_args[self.index]
+		# Action has arguments of the type Action.FOO. The arguments are
+		# the event arguments of the context the action is triggered in.
+		assert context is not None and context.event_args
+		return context.event_args[self.index]
 
 class CardArg(ActionArg):
 	# Type hint
 	pass
 
 class IntArg(ActionArg, LazyNum):
-	def evaluate(self, source):
-		ret = super().evaluate(source)
+	def eval(self, source, context=None):
+		ret = super().eval(source, context)
 		return self.num(ret)
 
 class Action(metaclass=ActionMeta):
+	__slots__ = ("_args", "_kwargs", "callback", "times", "name",
+		"_dependencies", "compiled")
+
 	def __init__(self, *args, **kwargs):
 		self._args = args
 		self._kwargs = kwargs
 		self.callback = ()
 		self.times = 1
-		self.event_queue = []
 		self.name = None
+		# The CompiledArguments of the action if its card script was
+		# compiled (see compile_action()), or None to interpret it
+		self.compiled = None
 
 	def __repr__(self):
 		if self.name != None:
@@ -131,40 +142,37 @@ class Action(metaclass=ActionMeta):
 
 	# Notify a single entity
 	def notify(self, entity, source, at, *args):
-		for event in entity.events:
-			if event.at != at:
-				continue
-			if isinstance(event.trigger, self.__class__) and event.trigger.matches(entity, args):
-				action_log.log("%r triggers %s %r from %r", entity, "on" if at == EventListener.ON else "after", self, source)
-				entity.trigger_event(source, event, args)
+		listeners = source.game.listeners.get(self.__class__, at)
+		if listeners:
+			self._notify([(entity, listeners.get(entity, ()))], source, at, args)
+
+	def _notify(self, subscribers, source, at, args):
+		# The listeners trigger one after the other, see NotifyFrame
+		source.game.queue_frame(NotifyFrame(self, subscribers, source, at, args))
 
 	# Broadcast an event to all entities
 	def broadcast(self, source, at, *args):
-		# Notify all entities in play
-		for entity in source.game.entities:
-			self.notify(entity, source, at, *args)
+		game = source.game
+		listeners = game.listeners.get(self.__class__, at)
+		if not listeners:
+			return
+		# Notify the listening entities in play, in the order of game.entities
+		positions = game.entity_positions
+		subscribers = sorted(
+			(item for item in listeners.items() if item[0] in positions),
+			key=lambda item: positions[item[0]])
+		if subscribers:
+			self._notify(subscribers, source, at, args)
 		# TODO: notify entities in other places
-		#for entity in source.game.board:
-		#	self.notify(entity, source, at, *args)
-
-	def queue_broadcast(self, obj, args):
-		self.event_queue.append((obj, args))
 
-	def resolve_broadcasts(self):
-		for obj, args in self.event_queue:
-			obj.broadcast(*args)
-		self.event_queue = []
-
-	def get_args(self, source):
-		return self._args
-
-	def get_args(self, source):
+	def get_args(self, context):
+		source = context.source
 		args = []
 		for value in self._args:
 			if isinstance(value, Selector):
-				args.append(value.select(source.game, source))
+				args.append(value.select(source.game, source, context))
 			elif isinstance(value, LazyNum):
-				args.append(value.eval(source))
+				args.append(value.eval(source, context))
 			else:
 				args.append(value)
 		return args
@@ -186,9 +194,7 @@ class Action(metaclass=ActionMeta):
 				if not res:
 					return False
 			elif isinstance(match, Selector):
-				# this stuff is stupidslow
-				res = match.select([arg], source)
-				if not res or res[0] is not arg:
+				if not match.contains(arg, source):
 					return False
 			else:
 				raise NotImplementedError
@@ -196,23 +202,27 @@ class Action(metaclass=ActionMeta):
 		return True
 
 class GameAction(Action):
-	def trigger(self, source):
-		args = self.get_args(source)
-		self.invoke(source, *args, **self._kwargs.copy())
+	def trigger(self, context):
+		if self.compiled is None:
+			args = self.get_args(context)
+		else:
+			args = self.compiled.args(context)
+		self.invoke(context, *args, **self._kwargs.copy())
 
 		for action in self.callback:
 			action_log.log("%r queues up callback %r", self, action)
 			#action_log.log("%r queues up callback %r with args %r", self, action, str([target] + target_args))
-			source.game.queue_actions(source, [action], event_args=args)
+			context.queue([action], event_args=args)
 
 
 class TargetedAction(Action):
+	__slots__ = ("source", )
+
 	TARGET = ActionArg()
 
 	def __init__(self, *args, **kwargs):
 		self.source = kwargs.pop("source", None)
 		super().__init__(*args, **kwargs)
-		self.trigger_index = 0
 
 	#def __repr__(self):
 	#	args = ["%s=%r" % (k, v) for k, v in zip(self.ARGS[1:], self._args[1:])]
@@ -222,19 +232,19 @@ class TargetedAction(Action):
 		self.times = value
 		return self
 
-	def get_target_args(self, source, target):
+	def get_target_args(self, context, target):
 		ret = []
 		for k, v in zip(self.ARGS[1:], self._args[1:]):
 			if isinstance(v, LazyNum):
-				v = v.eval(source)
+				v = v.eval(context.source, context)
 			elif isinstance(k, CardArg):
-				v = _eval_card(source, v)
+				v = _eval_card(context, v)
 			ret.append(v)
 		return ret
 
-	def get_targets(self, source, t):
+	def get_targets(self, context, t):
 		if isinstance(t, LazyNum):
-			ret = t.eval(source)
+			ret = t.eval(context.source, context)
 		elif t == None:
 			return [None]
 		else:
@@ -243,37 +253,26 @@ class TargetedAction(Action):
 			return []
 		return listify(ret)
 
-	def trigger(self, source):
-		ret = []
-
+	def trigger(self, context):
 		if self.source is not None:
-			source = self.source.eval(source)
+			source = self.source.eval(context.source, context)
 			assert len(source) == 1
-			source = source[0]
+			context = context.derive(source[0], context.event_args,
+				context.event_outputs)
+		source = context.source
 
 		times = self.times
 		if isinstance(times, LazyNum):
-			times = times.eval(source)
+			times = times.eval(source, context)
 		#elif isinstance(times, Action):
-		#	times = times.trigger(source)[0]
-
-		for i in range(times):
-			self.trigger_index = i
-			args = self.get_args(source)
-			targets = self.get_targets(source, args[0])
-			args = args[1:]
-			action_log.log("%r triggering %r targeting %r", source, self, targets)
-			for target in targets:
-				target_args = self.get_target_args(source, target)
-				ret.append(self.invoke(source, target, *target_args, **self._kwargs.copy()))
+		#	times = times.trigger(context)[0]
 
-				for action in self.callback:
-					action_log.log("%r queues up callback %r with args %r", self, action, str([target] + target_args))
-					ret += source.game.queue_actions(source, [action], event_args=[target] + target_args)
-
-		#self.resolve_broadcasts()
-
-		return ret
+		# The first target is invoked right away; the frame is only queued
+		# if there is more to do after the actions that invoke queued.
+		frame = TriggerFrame(self, context, times)
+		if not frame.step(context.game):
+			context.game.queue_frame(frame)
+		return frame.results
 
 #==============================================================================
 # Actions
@@ -288,14 +287,21 @@ class Attack(TargetedAction):
 
 	text = "{attacker} attacks {defender}"
 
-	def invoke(self, source, attacker, defender):
+	def invoke(self, context, attacker, defender):
+		source = context.source
 		if isinstance(defender, list):
 			defender = defender[0]
 		action_log.log("%r attacks %r", attacker, defender)
 		attacker.defender = defender
 		defender.attacker = attacker
+		game = context.game
 		self.broadcast(source, EventListener.ON, attacker, defender)
+		game.defer(self.resolve, context, attacker, defender)
+		game.defer(self.broadcast, source, EventListener.AFTER, attacker, defender)
+		game.defer(self.disengage, attacker, defender)
 
+	def resolve(self, context, attacker, defender):
+		"""Hit the defender, once the ON listeners of the attack have run"""
 		defender_power = defender.power
 		attacker_power = attacker.power
 
@@ -308,14 +314,13 @@ class Attack(TargetedAction):
 			if attacker.spy > 0:
 				defender.controller.morale -= 1
 			if attacker.inform > 0:
-				source.game.queue_actions(attacker, [Draw(attacker.controller)])
+				context.queue([Draw(attacker.controller)], source=attacker)
 		else:
-			source.game.queue_actions(attacker, [Hit(defender, attacker.power)])
+			context.queue([Hit(defender, attacker.power)], source=attacker)
 			if defender_power > 0:
-				source.game.queue_actions(defender, [Hit(attacker, defender_power)])
-
-		self.broadcast(source, EventListener.AFTER, attacker, defender)
+				context.queue([Hit(attacker, defender_power)], source=defender)
 
+	def disengage(self, attacker, defender):
 		attacker.defender = None
 		defender.attacker = None
 
@@ -326,9 +331,9 @@ class Hit(TargetedAction):
 	TARGET = ActionArg()
 	AMOUNT = IntArg()
 
-	def invoke(self, source, target, amount):
+	def invoke(self, context, target, amount):
 		action_log.log("Hitting %r for %d damage", target, amount)
-		source.game.queue_actions(source, [Damage(target, amount)])
+		context.queue([Damage(target, amount)])
 
 class Damage(TargetedAction):
 	"""
@@ -337,7 +342,8 @@ class Damage(TargetedAction):
 	TARGET = ActionArg()
 	AMOUNT = IntArg()
 
-	def invoke(self, source, target, amount):
+	def invoke(self, context, target, amount):
+		source = context.source
 		action_log.log("Damaging %r by %d", target, amount)
 		target.hit(source, amount)
 		self.broadcast(source, EventListener.ON, target, amount, source)
@@ -347,7 +353,8 @@ class Destroy(TargetedAction):
 	Destroy \a targets.
 	"""
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
+		source = context.source
 		if target.delayed_destruction:
 			#  If the card is in PLAY, it is instead scheduled to be destroyed
 			# It will be moved to the graveyard on the next Death event
@@ -363,25 +370,28 @@ class Deaths(GameAction):
 	"""
 	Process all deaths in the PLAY Zone.
 	"""
-	def invoke(self, source):
-		source.game.process_deaths()
+	def invoke(self, context):
+		context.game.process_deaths()
 
 class Death(GameAction):
 	ENTITY = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		action_log.log("Processing Death for %r", target)
-		self.broadcast(source, EventListener.ON, target)
+		self.broadcast(context.source, EventListener.ON, target)
+		context.game.defer(self.aftermath, context, target)
+
+	def aftermath(self, context, target):
 		if target.aftermaths:
-			source.game.queue_actions(source, [Aftermath(target)])
+			context.queue([Aftermath(target)])
 
 class Discard(TargetedAction):
 	"""
 	Discard card targets in a player's hand.
 	"""
-	def invoke(self, source, target):
-		self.broadcast(source, EventListener.ON, target)
-		target.discard()
+	def invoke(self, context, target):
+		self.broadcast(context.source, EventListener.ON, target)
+		context.game.defer(target.discard)
 
 class Summon(TargetedAction):
 	"""
@@ -390,34 +400,39 @@ class Summon(TargetedAction):
 	TARGET = ActionArg()
 	CARD = CardArg()
 
-	def invoke(self, source, target, cards, token=False):
+	def invoke(self, context, target, cards, token=False):
 		#log.info("%s summons %r", target, cards)
-		cards = _eval_card(source, cards)
+		source = context.source
+		cards = _eval_card(context, cards)
 		if isinstance(target, AttrValue):
-			target = target.eval(source)
+			target = target.eval(source, context)
 
 		#summon_as_token = self._kwargs.get("token", False)
 
+		# Each card is summoned after the listeners of the one before
 		for card in cards:
-			action_log.log("Summoning %r for %s", card, target)
+			context.game.defer(self.summon, source, target, card, token)
+
+		return cards
 
-			# Set the card's controller
-			if card.controller != target:
-				card.controller = target
+	def summon(self, source, target, card, token):
+		action_log.log("Summoning %r for %s", card, target)
 
-			# Move the card into play
-			if card.zone != Zone.PLAY:
-				card.zone = Zone.PLAY
+		# Set the card's controller
+		if card.controller != target:
+			card.controller = target
 
-			#if summon_as_token:
-			if token:
-				card.token = True
+		# Move the card into play
+		if card.zone != Zone.PLAY:
+			card.zone = Zone.PLAY
 
-			# Broadcast the summon event.
-			self.queue_broadcast(self, (source, EventListener.ON, target, card))
-			self.broadcast(source, EventListener.AFTER, target, card)
+		#if summon_as_token:
+		if token:
+			card.token = True
 
-		return cards
+		# Broadcast the summon event.
+		self.broadcast(source, EventListener.ON, target, card)
+		source.game.defer(self.broadcast, source, EventListener.AFTER, target, card)
 
 class Play(GameAction):
 	"""
@@ -427,13 +442,13 @@ class Play(GameAction):
 	CARD	= CardArg()
 	TARGETS	= ActionArg()
 
-	def invoke(self, source, card, targets):
+	def invoke(self, context, card, targets):
 		#log.info("%s summons %r", targets, cards)
-		player = source
+		player = context.source
 		if len(targets) == 0:
 			action_log.log("%s plays %r", player, card)
 		else:
-			action_log.log("%s plays %r, targeting %s", player, card, str(targets))
+			action_log.log("%s plays %r, targeting %s", player, card, targets)
 
 		player.pay_cost(card, card.morale, card.supply)
 
@@ -448,8 +463,13 @@ class Play(GameAction):
 
 		# Broad cast the "On Play" event
 		self.broadcast(player, EventListener.ON, player, card)
-		self.resolve_broadcasts()
+		context.game.defer(self.resolve, context, card, targets)
+
+		# Broadcast the "After Play" event
+		context.game.defer(self.broadcast, player, EventListener.AFTER, player, card)
 
+	def resolve(self, context, card, targets):
+		"""Queue the emerge and corrupt actions of the card"""
 		# Trigger the card's emerge
 		emerge_actions = []
 		if card.type == CardType.UNIT:
@@ -461,7 +481,7 @@ class Play(GameAction):
 		if card.corrupts:
 			if targets[0] != None:
 				# Success: Perform the corrupt action
-				source.game.queue_actions(card, [Corrupt(card, card.targets)])
+				context.queue([Corrupt(card, card.targets)], source=card)
 			else:
 				# Failure: append the corrupt failure actions to the beggining
 				# of the  emerge actions
@@ -470,10 +490,7 @@ class Play(GameAction):
 
 		# Trigger the card's emerge actions.
 		if len(emerge_actions) > 0:
-			source.game.queue_actions(card, [Emerge(card, card.targets)])
-
-		# Broadcast the "After Play" event
-		self.broadcast(player, EventListener.AFTER, player, card)
+			context.queue([Emerge(card, card.targets)], source=card)
 
 
 class Draw(TargetedAction):
@@ -484,27 +501,28 @@ class Draw(TargetedAction):
 	CARD = CardArg()
 
 	# Return the topmost card from the target's dack
-	def get_target_args(self, source, target):
+	def get_target_args(self, context, target):
 		if target.deck.empty():
 			card = None
 		else:
 			card = target.deck[-1]
 		return [card]
 
-	def invoke(self, source, target, card):
+	def invoke(self, context, target, card):
 		if card is None:
 			action_log.log("%r cannot draw (deck is empty)", target)
 			return []
 		#action_log.log("%r draws a card", target)
 		card.draw()
-		self.broadcast(source, EventListener.ON, target)
+		context.game.defer(self.broadcast, context.source, EventListener.ON, target)
 		return [card]
 
 
 class BeginTurn(GameAction):
 	PLAYER = ActionArg()
 
-	def invoke(self, source, player):
+	def invoke(self, context, player):
+		source = context.source
 		#source.manager.step(source.next_step, Step.MAIN_READY)
 		source.turn += 1
 		action_log.log("%s begins turn %i", player, source.turn)
@@ -519,7 +537,8 @@ class BeginTurn(GameAction):
 class EndTurn(GameAction):
 	PLAYER = ActionArg()
 
-	def invoke(self, source, player):
+	def invoke(self, context, player):
+		source = context.source
 		action_log.log("%s ends turn %i", player, source.turn)
 		self.broadcast(source, EventListener.ON, player)
 
@@ -527,7 +546,7 @@ class EndTurn(GameAction):
 class Aftermath(TargetedAction):
 	TARGET = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		action_log.log("Triggering aftermath for %r", target)
 
 		for aftermath in target.aftermaths:
@@ -536,13 +555,13 @@ class Aftermath(TargetedAction):
 			else:
 				actions = aftermath
 			actions = aftermath
-			source.game.queue_actions(target, actions)
+			context.queue(actions, source=target)
 
 # Emerge = Triggered upon playing the card.
 class Emerge(TargetedAction):
 	TARGET = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		action_log.log("Triggering emerge for %r", target)
 
 		emerge_actions = []
@@ -562,43 +581,51 @@ class Emerge(TargetedAction):
 			else:
 				actions = emerge
 			actions = emerge
-			source.game.queue_actions(target, actions)
+			context.queue(actions, source=target)
 
 # Wisdom = Gain an effect only if you have 5 or more cards in your hand when
 #          you play this card
 class Wisdom(TargetedAction):
 	TARGET = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		action_log.log("Triggering wisdom for %r", target)
 		for emerge in target.wisdoms:
 			actions = wisdom
-			source.game.queue_actions(target, actions)
+			context.queue(actions, source=target)
 
 # Corrupt = Destroy an allied unit to trigger an effect.
 class Corrupt(TargetedAction):
 	CORRUPTOR = ActionArg()
 	#TARGET = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		corrupt_target = target.targets[0]
 		action_log.log("%r corrupts %r", target, corrupt_target)
 
 		# Destroy the corrupt target.
-		source.game.queue_actions(target, [Destroy(corrupt_target)])
+		context.queue([Destroy(corrupt_target)], source=target)
 
 		# Perform the corrupt actions.
+		context.game.defer(self.perform, context, target)
+
+	def perform(self, context, target):
 		corrupt_actions = target.get_actions("corrupt")
 		for action in corrupt_actions:
-			if callable(action):
-				actions = action(target)
-			else:
-				actions = action
-			source.game.queue_actions(target, action)
+			context.game.defer(self.perform_action, context, target, action)
 
-			if target.controller.extra_corrupts:
-				action_log.log("Triggering corrupt action for %r again", target)
-				source.game.queue_actions(target, actions)
+	def perform_action(self, context, target, action):
+		if callable(action):
+			actions = action(target)
+		else:
+			actions = action
+		context.queue(action, source=target)
+		context.game.defer(self.repeat, context, target, actions)
+
+	def repeat(self, context, target, actions):
+		if target.controller.extra_corrupts:
+			action_log.log("Triggering corrupt action for %r again", target)
+			context.queue(actions, source=target)
 
 # Inspire = Gain X Morale when this unit attacks a player
 class Inspire(TargetedAction):
@@ -607,7 +634,7 @@ class Inspire(TargetedAction):
 	"""
 	TARGET = ActionArg()
 
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		action_log.log("Triggering inspire for %r", target)
 		#target.tags["inspire"]
 
@@ -664,12 +691,12 @@ class Buff(TargetedAction):
 	TARGET = ActionArg()
 	BUFF = CardArg()
 
-	def invoke(self, source, target, buffs, **kwargs):
+	def invoke(self, context, target, buffs, **kwargs):
 		ret = []
 		for buff in buffs:
 			for k, v in kwargs.items():
 				if isinstance(v, LazyNum):
-					v = v.eval(source)
+					v = v.eval(context.source, context)
 				setattr(buff, k, v)
 			ret.append(buff.apply(target))
 		return ret
@@ -683,18 +710,18 @@ class GiveMorale(TargetedAction):
 	TARGET = ActionArg()
 	AMOUNT = IntArg()
 
-	def invoke(self, source, target, amount):
-		print("Giving %d morale to %r" %(amount, target))
+	def invoke(self, context, target, amount):
+		action_log.log("Giving %d morale to %r", amount, target)
 		target.morale += amount
 
 class Bounce(TargetedAction):
 	"""
 	Move a unit on the field back into their controller's hand.
 	"""
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		if len(target.controller.hand) >= target.controller.max_hand_size:
 			action_log.log("%r is bounced to a full hand and gets destroyed", target)
-			return source.game.queue_actions(source, [Destroy(target)])
+			return context.queue([Destroy(target)])
 		else:
 			action_log.log("%r is bounced back to %s's hand", target, target.controller)
 			target.zone = Zone.HAND
@@ -703,7 +730,7 @@ class Toxic(TargetedAction):
 	"""
 	Reduces \a targets to 1 health.
 	"""
-	def invoke(self, source, target):
+	def invoke(self, context, target):
 		if not target.dead:
 			action_log.log("Reducing %r to 1 health", target)
 			target.damage = target.max_health - 1
@@ -712,21 +739,45 @@ class Toxic(TargetedAction):
 
 
 class AuraBuff:
+	"""
+	The tags an aura sets on an entity (its slot on the entity). Tags are
+	set with update_tags() and read as attributes, by the int_property and
+	slot_property attributes of the entity. Only those attributes are
+	slots; other tags have no effect through an aura slot and are ignored.
+	"""
+	__slots__ = ("source", "entity", "tick",
+		"power", "max_health", "damage", "verdict", "inspire", "spy", "inform",
+		"morale", "supply", "territory", "max_hand_size", "extra_corrupts")
+
 	def __init__(self, source, entity):
 		self.source = source
 		self.entity = entity
-		self.tags = CardManager(self)
 
 	def __repr__(self):
 		return "<AuraBuff %r -> %r>" % (self.source, self.entity)
 
+	def __setattr__(self, name, value):
+		source = getattr(self, "source", None)
+		journal = source.journal if source is not None else None
+		if journal is not None and journal.savepoints:
+			journal.record(self, name)
+		object.__setattr__(self, name, value)
+
 	def update_tags(self, tags):
-		self.tags.update(tags)
+		attrs = AuraBuff.attrs
+		for tag, value in tags.items():
+			attr = attrs.get(tag)
+			if attr is not None:
+				setattr(self, attr, value)
 		self.tick = self.source.game.tick
 
 	def remove(self):
 		action_log.log("Destroying %r", self)
+		journal = self.source.game.journal
+		journal.save(self.entity.slots)
+		journal.save(self.source.game.active_aura_buffs)
 		self.entity.slots.remove(self)
+		self.entity.invalidate_stats()
 		self.source.game.active_aura_buffs.remove(self)
 
 	def _getattr(self, attr, i):
@@ -736,6 +787,11 @@ class AuraBuff:
 		return i + value
 
 
+# Attributes of the tags that can be set on aura slots
+AuraBuff.attrs = {tag: attr for tag, attr in CardManager.map.items()
+	if attr in AuraBuff.__slots__}
+
+
 class Refresh:
 	"""
 	Refresh a buff or a set of tags on an entity
@@ -746,19 +802,20 @@ class Refresh:
 		self.buff = buff
 		self.kwargs = kwargs
 
-	def trigger(self, source):
-		entities = self.selector.select(source.game, source)
+	def trigger(self, context):
+		source = context.source
+		entities = self.selector.select(source.game, source, context)
 		for entity in entities:
 			if self.buff:
 				buff_attributes = {}
 				for key, value in self.kwargs.items():
-					buff_attributes[key] = lazynum.evaluate(value, source)
+					buff_attributes[key] = lazynum.evaluate(value, source, context)
 				entity.refresh_buff(source, self.buff, **buff_attributes)
 			else:
 				tags = {}
 				for tag, value in self.tags.items():
 					if not isinstance(value, int) and not callable(value):
-						value = value.eval(source)
+						value = value.eval(source, context)
 					tags[tag] = value
 
 				entity.refresh_tags(source, tags)
@@ -768,21 +825,268 @@ class Refresh:
 
 
 
+class ActionContext:
+	"""
+	What actions are triggered with: their source, and the event arguments
+	and outputs they see as Action.FOO arguments and Choose.CHOICE.
+	Contexts are immutable, so the frames and choices they are passed to
+	share them.
+	"""
+	__slots__ = ("source", "event_args", "event_outputs")
+
+	def __init__(self, source, event_args=None, event_outputs=None):
+		self.source = source
+		self.event_args = event_args
+		self.event_outputs = event_outputs
+
+	def __repr__(self):
+		return "<ActionContext %r: %r>" % (self.source, self.event_args)
+
+	@property
+	def game(self):
+		return self.source.game
+
+	def derive(self, source=None, event_args=None, event_outputs=None):
+		"""
+		Return the context of actions triggered from \a source (the source
+		of this context by default). They see the event arguments and
+		outputs of this context if they are not given and the source is
+		the same.
+		"""
+		if source is None or source is self.source:
+			source = self.source
+			event_args = event_args or self.event_args
+			event_outputs = event_outputs or self.event_outputs
+		return ActionContext(source, event_args, event_outputs)
+
+	def queue(self, actions, source=None, event_args=None, event_outputs=None):
+		"""
+		Queue \a actions to trigger in the context derive() returns, see
+		Game.queue_frame(), and return their results
+		"""
+		if not isinstance(actions, list):
+			actions = [actions]
+		context = self.derive(source, event_args, event_outputs)
+		return self.game.queue_frame(ActionFrame(context, actions))
+
+
+class Frame:
+	"""
+	Work on the action stack of a game, see Game.run_frames(). step()
+	does the next part of the work and returns True once it is all done.
+	The frames queued by a step run before the next one, so a frame
+	suspended by a choice resumes exactly where it stopped.
+	"""
+	results = ()
+
+	def step(self, game):
+		raise NotImplementedError
+
+	def resumed(self):
+		"""
+		Return the frame to run when resuming the frame after a choice. It
+		is a copy, so that the suspended frame can be resumed again after
+		rolling back to before the choice was made.
+		"""
+		return copy.copy(self)
+
+
+class ActionFrame(Frame):
+	"""
+	A list of actions queued by Game.queue_actions(), the context they are
+	triggered in, the position of the next one to trigger and the results
+	of those already triggered.
+	"""
+
+	def __init__(self, context, actions, results=None):
+		self.context = context
+		self.actions = actions
+		self.index = 0
+		self.results = [] if results is None else results
+
+	def __repr__(self):
+		return "<ActionFrame %r: %r>" % (self.context.source, self.actions[self.index:])
+
+	def step(self, game):
+		actions = self.actions
+		if self.index < len(actions):
+			action = actions[self.index]
+			self.index += 1
+			if isinstance(action, EventListener):
+				raise NotImplementedError
+			self.results.append(action.trigger(self.context))
+		return self.index >= len(actions)
+
+
+class TriggerFrame(Frame):
+	"""
+	The invocations of a TargetedAction that remain: \a times iterations
+	over its targets, each invocation followed by the callbacks of the
+	action. One invocation or callback is run per step. The targets and
+	their arguments are evaluated by the compiled functions of the action,
+	if it has them (see compile_action()).
+	"""
+
+	def __init__(self, action, context, times):
+		self.action = action
+		self.context = context
+		self.times = times
+		self.iteration = 0
+		self.targets = ()
+		self.position = 0
+		self.callbacks = ()
+		self.event_args = None
+		self.results = []
+
+	def __repr__(self):
+		return "<TriggerFrame %r: %r>" % (self.context.source, self.action)
+
+	def step(self, game):
+		action = self.action
+		context = self.context
+		if self.callbacks:
+			callback = self.callbacks[0]
+			self.callbacks = self.callbacks[1:]
+			action_log.log("%r queues up callback %r with args %r", action, callback, self.event_args)
+			game.queue_frame(ActionFrame(context.derive(event_args=self.event_args),
+				[callback], self.results))
+			return self.done()
+
+		compiled = action.compiled
+		while self.position >= len(self.targets):
+			if self.iteration >= self.times:
+				return True
+			self.iteration += 1
+			if compiled is None or compiled.targets is None:
+				args = action.get_args(context)
+				self.targets = action.get_targets(context, args[0])
+			else:
+				self.targets = compiled.targets(context)
+			self.position = 0
+			action_log.log("%r triggering %r targeting %r", context.source, action, self.targets)
+
+		target = self.targets[self.position]
+		self.position += 1
+		if compiled is None or compiled.target_args is None:
+			target_args = action.get_target_args(context, target)
+		else:
+			target_args = compiled.target_args(context)
+		self.results.append(action.invoke(context, target, *target_args, **action._kwargs.copy()))
+		if action.callback:
+			self.callbacks = action.callback
+			self.event_args = [target] + target_args
+		return self.done()
+
+	def done(self):
+		return not self.callbacks and self.iteration >= self.times and \
+			self.position >= len(self.targets)
+
+
+class BlockFrame(Frame):
+	"""
+	An action block, see Game.action_block(): action_start(), then the
+	actions and action_end() once they are done
+	"""
+
+	def __init__(self, context, actions, type, index, targets):
+		self.context = context
+		self.actions = actions
+		self.type = type
+		self.index = index
+		self.targets = targets
+		self.started = False
+		self.results = []
+
+	def __repr__(self):
+		return "<BlockFrame %r: %r>" % (self.context.source, self.type)
+
+	def step(self, game):
+		source = self.context.source
+		if not self.started:
+			self.started = True
+			game.action_start(self.type, source, self.index, self.targets)
+			if self.actions:
+				game.queue_frame(ActionFrame(self.context, listify(self.actions),
+					self.results))
+				return False
+		game.action_end(self.type, source)
+		return True
+
+
+class NotifyFrame(Frame):
+	"""
+	The listeners an action notifies of an event: \a subscribers are
+	(entity, listeners) pairs. Each listener is matched against the event
+	after the ones before it have triggered.
+	"""
+
+	def __init__(self, action, subscribers, source, at, args):
+		self.action = action
+		self.subscribers = subscribers
+		self.source = source
+		self.at = at
+		self.args = args
+		self.index = 0
+		self.position = 0
+
+	def __repr__(self):
+		return "<NotifyFrame %r: %r>" % (self.source, self.action)
+
+	def step(self, game):
+		subscribers = self.subscribers
+		while self.index < len(subscribers):
+			entity, events = subscribers[self.index]
+			if self.position >= len(events):
+				self.index += 1
+				self.position = 0
+				continue
+			event = events[self.position]
+			self.position += 1
+			if event.trigger.matches(entity, self.args):
+				action_log.log("%r triggers %s %r from %r", entity,
+					"on" if self.at == EventListener.ON else "after", self.action, self.source)
+				entity.trigger_event(self.source, event, self.args)
+				return False
+		return True
+
+
+class CallFrame(Frame):
+	"""A call deferred by Game.defer()"""
+
+	def __init__(self, function, args):
+		self.function = function
+		self.args = args
+
+	def __repr__(self):
+		return "<CallFrame %r>" % (self.function, )
+
+	def step(self, game):
+		self.function(*self.args)
+		return True
+
+	def resumed(self):
+		return self
+
+
 class ActionOutput(LazyNum):
+	contextual = True
+
 	def __repr__(self):
 		return "<%s>" %(self.__class__.__name__)
 		#return "<%s.%s>" % (self.owner.__name__, self.name)
 
-	def evaluate(self, source):
-		#assert source.event_args
-		#return source.event_outputs[self.index]
-		return source.event_outputs[0]
+	def eval(self, source, context=None):
+		assert context is not None and context.event_outputs
+		return context.event_outputs[0]
 
 class Choose(GameAction):
 	"""
 	Initiate a choice for \a player, provided a set of \a cards to choose from.
 	This will halt the action queue until the player makes their choice.
 	"""
+	# Pending choices are copies that hold the state of the choice
+	__slots__ = ("__dict__", )
+
 	PLAYER = ActionArg()
 	CARDS = ActionArg()
 	CHOICE = ActionOutput()
@@ -803,24 +1107,25 @@ class Choose(GameAction):
 		ret.times = self.times
 		return ret
 
-	def get_args(self, source):
+	def get_args(self, context):
+		source = context.source
 		# Evaluate the player argument.
 		player = self._args[0]
 		if isinstance(player, Selector):
 			#player = player.eval(source.game.players, source) TODO: bring back entities arg
-			player = player.eval(source)
+			player = player.eval(source, context)
 			assert len(player) == 1
 			player = player[0]
 		elif isinstance(player, LazyNum):
-			player = player.eval(source)
+			player = player.eval(source, context)
 			assert player != None
 
 		# Evaluate the choice list argument.
 		cards = self._args[1]
 		if isinstance(cards, Selector):
-			cards = cards.eval(source)
+			cards = cards.eval(source, context)
 		elif isinstance(cards, LazyNum):
-			cards = cards.eval(source)
+			cards = cards.eval(source, context)
 
 		count = 1
 		if len(self._args) >= 3:
@@ -834,18 +1139,24 @@ class Choose(GameAction):
 				# Cards in the choice must be set aside.
 				#card.zone = Zone.SET_ASIDE
 
-		action_log.log("%r begins choice between %r" %(player, cards))
+		action_log.log("%r begins choice between %r", player, cards)
 		return player, cards, count
 
-	def invoke(self, source, player, cards, count):
-		self.source = source
-		self.player = player
-		self.source.game.choosing_player = player
-		self.cards = cards
-		self.min_count = count
-		self.max_count = count
-		self.source.game.choice = self
-		self.player.choice = self # The player enters a choosing state.
+	def invoke(self, context, player, cards, count):
+		# The pending choice is a copy of the action, which card scripts
+		# share between every game.
+		source = context.source
+		choice = copy.copy(self)
+		choice.action = self
+		choice.source = source
+		choice.context = context
+		choice.player = player
+		source.game.choosing_player = player
+		choice.cards = cards
+		choice.min_count = count
+		choice.max_count = count
+		source.game.choice = choice
+		player.choice = choice # The player enters a choosing state.
 
 	def choose(self, cards):
 		"""
@@ -864,7 +1175,7 @@ class Choose(GameAction):
 			if card not in self.cards:
 				raise InvalidAction("%r is not a valid choice (one of %r)" % (card, self.cards))
 
-		action_log.log("%r chooses %r" %(self.player, cards))
+		action_log.log("%r chooses %r", self.player, cards)
 
 		# TODO: need to discard certain choice cards
 
@@ -874,7 +1185,13 @@ class Choose(GameAction):
 		for action in self.choice_callback:
 			action_log.log("Choice queues up callback %r", action)
 			#action_log.log("%r queues up callback %r with args %r", self, action, str([target] + target_args))
-			self.source.game.queue_actions(self.source, [action], event_args=self._args, event_outputs=[cards])
+		# In one frame, so that a choice started by one suspends the others
+		if self.choice_callback:
+			self.context.queue(list(self.choice_callback), event_args=self._args,
+				event_outputs=[cards])
+
+		# Then the actions that were waiting for the choice
+		self.source.game.resume_actions()
 
 #------------------------------------------------------------------------------
 # General Actions
@@ -887,9 +1204,9 @@ class IfThen(GameAction):
 	CONDITION = ActionArg()
 	THEN_ACTIONS = ActionArg()
 
-	def invoke(self, source, condition, then_actions):
+	def invoke(self, context, condition, then_actions):
 		if condition:
-			source.game.queue_actions(source, listify(then_actions), source.event_args)
+			context.queue(listify(then_actions))
 
 class IfThenElse(GameAction):
 	"""
@@ -900,11 +1217,11 @@ class IfThenElse(GameAction):
 	THEN_ACTIONS = ActionArg()
 	ELSE_ACTIONS = ActionArg()
 
-	def invoke(self, source, condition, then_actions):
+	def invoke(self, context, condition, then_actions):
 		if condition:
-			source.game.queue_actions(source, then_actions)
+			context.queue(then_actions)
 		else:
-			source.game.queue_actions(source, else_actions)
+			context.queue(else_actions)
 
 
 #------------------------------------------------------------------------------
@@ -940,3 +1257,173 @@ TURN_BEGIN = BeginTurn(ALL_PLAYERS)
 OWN_TURN_END = EndTurn(CONTROLLER)
 TURN_END = EndTurn(ALL_PLAYERS)
 
+
+#------------------------------------------------------------------------------
+# Precompilation
+#------------------------------------------------------------------------------
+
+def precompile(script, seen=None, actions=False):
+	"""
+	Compile the selectors and LazyNums reachable from a card script (an
+	action, event listener or list of them), so that they are compiled once
+	when the card database is initialized rather than during play.
+	If \a actions is true, the actions are compiled too (see
+	compile_action()).
+	"""
+	if seen is None:
+		seen = set()
+	if id(script) in seen:
+		return
+	seen.add(id(script))
+
+	if isinstance(script, Selector):
+		script.compiled()
+		children = [getattr(script, name, None) for name in ("left", "right")]
+	elif isinstance(script, LazyNum):
+		if hasattr(script, "_args") and (type(script).eval is LazyNum.eval
+				or isinstance(script, Count)):
+			script.evaluator()
+		children = list(getattr(script, "_args", ()))
+		children.append(getattr(script, "selector", None))
+	elif isinstance(script, Action):
+		if actions:
+			script.compiled = compile_action(script)
+		children = list(script._args) + list(script._kwargs.values())
+		children += [script.callback, getattr(script, "choice_callback", ()),
+			script.times, getattr(script, "source", None)]
+	elif isinstance(script, EventListener):
+		# The trigger of a listener is only matched against events
+		precompile(script.trigger, seen)
+		children = [script.actions]
+	elif isinstance(script, Refresh):
+		children = [script.selector, list(script.kwargs.values())]
+		if script.tags:
+			children.append(list(script.tags.values()))
+	elif isinstance(script, (list, tuple)):
+		children = script
+	else:
+		return
+	for child in children:
+		precompile(child, seen, actions)
+
+
+#------------------------------------------------------------------------------
+# Action compilation
+#------------------------------------------------------------------------------
+
+class CompiledArguments:
+	"""
+	How the arguments of an action from a card script are evaluated,
+	lowered by compile_action(). Each function takes the ActionContext
+	the action is triggered in and returns what the interpreter would:
+	args() the arguments of a GameAction (Action.get_args()), targets()
+	the targets of one iteration of a TargetedAction (get_args() and
+	get_targets()) and target_args() the arguments it invokes a target
+	with (get_target_args()). A function is None if the action overrides
+	how that is evaluated; that part is interpreted.
+	"""
+	__slots__ = ("args", "targets", "target_args")
+
+	def __init__(self, args=None, targets=None, target_args=None):
+		self.args = args
+		self.targets = targets
+		self.target_args = target_args
+
+
+def _argument(value, select=True):
+	"""
+	Return (fn, value) where fn(source, context) evaluates an action
+	argument like Action.get_args() does, or like get_target_args() if
+	\a select is false (selectors are evaluated with eval() there). fn is
+	None if the argument is the constant \a value, which evaluating a
+	constant LazyNum gives (see compile_lazy()).
+	"""
+	if select and isinstance(value, Selector):
+		select_from = value.select
+		return (lambda source, context: select_from(source.game, source, context)), value
+	elif isinstance(value, LazyNum):
+		fn, constant = compile_lazy(value)
+		if constant:
+			return None, fn(None, None)
+		return fn, value
+	return None, value
+
+
+def _card_argument(card):
+	return lambda source, context: _eval_card(context, card)
+
+
+def _arguments(arguments):
+	"""
+	Return a function fn(context) that returns the list of the values of
+	\a arguments, (fn, value) pairs from _argument(). If they are all
+	constants, the list is built once and shared, as nothing changes it.
+	"""
+	if not any(fn for fn, value in arguments):
+		constants = [value for fn, value in arguments]
+		return lambda context: constants
+
+	def evaluate(context):
+		source = context.source
+		return [value if fn is None else fn(source, context)
+			for fn, value in arguments]
+	return evaluate
+
+
+def _targets(action):
+	"""Return the CompiledArguments.targets() function of \a action"""
+	values = action._args
+	target, value = _argument(values[0])
+	# get_args() evaluates the other arguments too, although only the
+	# target is used
+	others = [fn for fn, other in map(_argument, values[1:]) if fn is not None]
+	get_targets = action.get_targets
+	if target is None and not others and not isinstance(value, LazyNum):
+		targets = get_targets(None, value)
+		return lambda context: targets
+
+	def evaluate(context):
+		source = context.source
+		t = value if target is None else target(source, context)
+		for fn in others:
+			fn(source, context)
+		return get_targets(context, t)
+	return evaluate
+
+
+def _target_args(action):
+	"""Return the CompiledArguments.target_args() function of \a action"""
+	arguments = []
+	for arg, value in zip(action.ARGS[1:], action._args[1:]):
+		if isinstance(value, LazyNum):
+			arguments.append(_argument(value, select=False))
+		elif isinstance(arg, CardArg):
+			arguments.append((_card_argument(value), value))
+		else:
+			arguments.append((None, value))
+	return _arguments(arguments)
+
+
+def compile_action(action):
+	"""
+	Lower how the arguments of \a action are evaluated into functions and
+	return them (see CompiledArguments), or None if the action evaluates
+	its arguments itself (eg. Choose) and must be interpreted.
+	The kind of each argument is resolved once, and constant arguments and
+	targets are hoisted out of the loops over the times and the targets of
+	the action, so that they are not evaluated again on every iteration.
+	"""
+	cls = type(action)
+	if cls.get_args is not Action.get_args:
+		return None
+	if isinstance(action, GameAction):
+		return CompiledArguments(args=_arguments([_argument(value) for value in action._args]))
+	elif isinstance(action, TargetedAction) and action._args:
+		compiled = CompiledArguments()
+		if cls.get_targets is TargetedAction.get_targets:
+			compiled.targets = _targets(action)
+		if cls.get_target_args is TargetedAction.get_target_args:
+			compiled.target_args = _target_args(action)
+		return compiled
+	return None
+
@@ -72,15 +72,16 @@ class Condition:
 		elif self._else:
 			return self._else
 
-	def trigger(self, source):
+	def trigger(self, context):
 		"""
-		Triggers all actions meant to trigger on the board state from `source`.
+		Triggers all actions meant to trigger on the board state from the
+		source of `context`.
 		"""
-		actions = self.evaluate(source)
+		actions = self.evaluate(context.source)
 		if actions:
 			if not hasattr(actions, "__iter__"):
 				actions = (actions, )
-			source.game.trigger_actions(source, actions)
+			context.queue(list(actions))
 
 #------------------------------------------------------------------------------
 # Conditions
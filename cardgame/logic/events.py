@@ -1,3 +1,4 @@
+from collections import defaultdict
 from ..enums import *
 
 
@@ -16,3 +17,48 @@ class EventListener:
 		#return "<EventListener %r>" % (self.trigger)
 
 
+class ListenerIndex:
+	"""
+	Index of the event listeners of entities in play, keyed by action class
+	and timing (EventListener.ON or EventListener.AFTER).
+
+	A listener whose trigger is an instance of an action class is indexed
+	under that class and all of its base classes, so that broadcasting an
+	action only has to look up its own class.
+	"""
+
+	def __init__(self):
+		self._listeners = defaultdict(dict)
+
+	def subscribe(self, entity):
+		"""Index all event listeners of an entity"""
+		for event in entity.events:
+			for cls in type(event.trigger).__mro__[:-1]:
+				events = self._listeners[(cls, event.at)]
+				events[entity] = events.get(entity, ()) + (event, )
+
+	def unsubscribe(self, entity):
+		"""Remove all event listeners of an entity from the index"""
+		for event in entity.events:
+			for cls in type(event.trigger).__mro__[:-1]:
+				self._listeners[(cls, event.at)].pop(entity, None)
+
+	def discard(self, entity, event):
+		"""Remove a single event listener of an entity from the index"""
+		for cls in type(event.trigger).__mro__[:-1]:
+			listeners = self._listeners[(cls, event.at)]
+			events = listeners.get(entity)
+			if events is None:
+				continue
+			events = tuple(e for e in events if e is not event)
+			if events:
+				listeners[entity] = events
+			else:
+				del listeners[entity]
+
+	def get(self, action_class, at):
+		"""
+		Return a mapping of entity -> event listeners for the listeners
+		that are triggered by actions of the given class at the given time.
+		"""
+		return self._listeners.get((action_class, at))
@@ -6,13 +6,14 @@ from typing import Any, Union, List, Callable, Iterable, Optional, Set
 
 
 
-def evaluate(value, source):
+def evaluate(value, source, context=None):
 	"""
-	If the value is a lazy value, then evaluate it with source,
-	otherwise just return the value
+	If the value is a lazy value, then evaluate it with source (and the
+	context of the action being triggered, if any), otherwise just return
+	the value
 	"""
 	if isinstance(value, LazyNum):
-		return value.eval(source)
+		return value.eval(source, context)
 	else:
 		return value
 
@@ -33,26 +34,61 @@ class LazyNum:
 	"""
 	Lazily evaluate something at runtime.
 	"""
+	# Whether the value is read from the context of the action being
+	# triggered, see depends_on_context()
+	contextual = False
+
 	def __init__(self, *args):
 		self._args = args
 
 	def evaluate(self, source) -> int:
 		raise NotImplementedError
 
-	def eval(self, source):
-		from .selector import Selector
-		# First, evaluate the arguments
-		args = []
-		for value in self._args:
-			if isinstance(value, Selector):
-				args.append(value.select(source.game, source))
-			elif isinstance(value, LazyNum):
-				args.append(value.eval(source))
-			else:
-				args.append(value)
-		# Now call the abstract evaluate this LazyNum, passing in the
-		# evaluated arguments
-		return self.evaluate(source, *args)
+	def eval(self, source, context=None):
+		"""
+		Evaluate the LazyNum from \a source. \a context is the
+		ActionContext of the action being triggered, which holds the values
+		of Action.FOO arguments, or None outside of actions.
+		"""
+		return self.evaluator()(source, context)
+
+	def evaluator(self):
+		"""
+		Return a function fn(source, context) that evaluates the arguments
+		and calls evaluate() with them, see compile_lazy(). It is built on
+		first use and cached.
+		"""
+		try:
+			return self._evaluator
+		except AttributeError:
+			self._evaluator, self._is_constant = self._compile()
+			return self._evaluator
+
+	def fingerprint(self):
+		"""
+		Return a hashable structural fingerprint of the LazyNum, equal for
+		LazyNums built the same way, see fingerprint(). It is cached.
+		"""
+		try:
+			return self._fingerprint
+		except AttributeError:
+			self._fingerprint = _structure(self)
+			return self._fingerprint
+
+	def _compile(self):
+		"""
+		Return (fn, constant) where fn(source, context) evaluates the
+		LazyNum and constant is True if it does not depend on source
+		"""
+		evaluate = self.evaluate
+		args = [compile_lazy(value)[0] for value in self._args]
+		if not args:
+			return (lambda source, context: evaluate(source)), False
+		elif len(args) == 1:
+			arg, = args
+			return (lambda source, context: evaluate(source, arg(source, context))), False
+		return (lambda source, context: evaluate(source,
+			*[arg(source, context) for arg in args])), False
 
 	def __repr__(self):
 		text = "%s(" %(self.__class__.__name__)
@@ -111,15 +147,16 @@ class LazyNum:
 	def __ror__(self, other):
 		return LazyBinaryOperation(_or, other, self)
 
-	def get_entities(self, source):
+	def get_entities(self, source, context=None):
 		from .selector import Selector
 		if isinstance(self.selector, Selector):
-			entities = self.selector.select(source.game, source)
+			entities = self.selector.select(source.game, source, context)
 		elif isinstance(self.selector, LazyNum):
-			entities = [self.selector.evaluate(source)]
+			entities = [self.selector.eval(source, context)]
 		else:
 			# TODO assert that self.selector is a TargetedAction
-			entities = sum(self.selector.trigger(source), [])
+			entities = sum(source.game.run_actions(source, [self.selector],
+				context), [])
 		return entities
 
 
@@ -148,6 +185,113 @@ operator_inversions = {
 	operator.ge: operator.lt,
 }
 
+#------------------------------------------------------------------------------
+# Structural fingerprints
+#------------------------------------------------------------------------------
+
+def fingerprint(value):
+	"""
+	Return a hashable value that identifies the structure of a lazy value.
+	LazyNums and selectors cannot be compared or hashed themselves, because
+	their comparison operators build new expressions; two of them built
+	the same way (same classes, operators and arguments) have equal
+	fingerprints. Other hashable values (numbers, enums, entities,
+	functions) stand for themselves.
+	"""
+	if isinstance(value, LazyNum):
+		return value.fingerprint()
+	try:
+		hash(value)
+		return value
+	except TypeError:
+		pass
+	if isinstance(value, (list, tuple)):
+		return tuple(fingerprint(item) for item in value)
+	elif isinstance(value, dict):
+		return tuple(sorted((key, fingerprint(item)) for key, item in value.items()))
+	elif hasattr(value, "__dict__"):
+		# Eg. AttrValue, whose comparisons build selectors
+		return _structure(value)
+	return ("id", id(value))
+
+
+def _structure(obj):
+	# Names are only descriptive; other private attributes are caches.
+	return (type(obj), ) + tuple((name, fingerprint(value))
+		for name, value in sorted(vars(obj).items())
+		if name == "_args" or not (name.startswith("_") or name == "name"))
+
+
+def depends_on_context(value):
+	"""
+	Return True if evaluating \a value reads the context of the action
+	being triggered (eg. an Action.FOO argument), so that its result can
+	differ between two evaluations from the same source
+	"""
+	if isinstance(value, LazyNum):
+		if value.contextual:
+			return True
+		children = vars(value).values()
+	elif isinstance(value, (list, tuple)):
+		children = value
+	else:
+		return False
+	return any(depends_on_context(child) for child in children)
+
+
+#------------------------------------------------------------------------------
+# Compilation
+#------------------------------------------------------------------------------
+
+def _constant(value):
+	return lambda source, context: value
+
+
+def compile_lazy(value):
+	"""
+	Return (fn, constant) where fn(source, context) evaluates \a value
+	like LazyNum.eval() evaluates its arguments: selectors select from the
+	game, LazyNums are evaluated and other values are constants.
+	constant is True if fn does not depend on source or context.
+	"""
+	from .selector import Selector
+	if isinstance(value, Selector):
+		return value.eval, False
+	elif isinstance(value, LazyNum):
+		if type(value).eval is not LazyNum.eval:
+			# Custom evaluation, eg. Count
+			return value.eval, False
+		value.evaluator()
+		return value._evaluator, value._is_constant
+	return _constant(value), True
+
+
+def _fold(op, *args):
+	"""
+	Fold an operation over compiled arguments: return (fn, constant) with
+	the result computed once if every argument is constant
+	"""
+	fns = [fn for fn, constant in args]
+	if all(constant for fn, constant in args):
+		try:
+			return _constant(op(*[fn(None, None) for fn in fns])), True
+		except Exception:
+			# Raise when evaluated, like before
+			pass
+	if len(fns) == 1:
+		value, = fns
+		return (lambda source, context: op(value(source, context))), False
+	(left, left_constant), (right, right_constant) = args
+	if right_constant:
+		right = right(None, None)
+		return (lambda source, context: op(left(source, context), right)), False
+	if left_constant:
+		left = left(None, None)
+		return (lambda source, context: op(left, right(source, context))), False
+	return (lambda source, context: op(left(source, context),
+		right(source, context))), False
+
+
 class LazyUnaryOperation(LazyNum):
 	"""
 	Lazily perform a unary operation.
@@ -161,6 +305,9 @@ class LazyUnaryOperation(LazyNum):
 	def evaluate(self, source, value):
 		return self.op(value)
 
+	def _compile(self):
+		return _fold(self.op, compile_lazy(self.value))
+
 	def __repr__(self):
 		symbol = operator_symbols.get(self.op.__name__,
 			"UNKNOWN_OP(%s)" %(self.op.__name__))
@@ -180,6 +327,9 @@ class LazyBinaryOperation(LazyNum):
 	def evaluate(self, source, left, right):
 		return self.op(left, right)
 
+	def _compile(self):
+		return _fold(self.op, compile_lazy(self.left), compile_lazy(self.right))
+
 	def __repr__(self):
 		infix = operator_symbols.get(self.op.__name__,
 			"UNKNOWN_OP(%s)" %(self.op.__name__))
@@ -196,8 +346,8 @@ class LazyBinaryOperation(LazyNum):
 		"""
 		inverted_op = operator_inversions.get(self.op, None)
 		if inverted_op != None:
-			self.op = inverted_op
-			return self
+			# A new node, as expressions compiled earlier may refer to this one
+			return LazyBinaryOperation(inverted_op, self.left, self.right)
 		return super().__invert__()
 
 
@@ -205,6 +355,13 @@ class Count(LazyNum):
 	"""
 	Lazily count the matches in a selector
 	"""
+	def eval(self, source, context=None):
+		members = _group_members(self._args[0], source)
+		if members is not None:
+			group, exclude = members
+			return len(group) - (exclude in group)
+		return super().eval(source, context)
+
 	def evaluate(self, source, selector):
 		return len(selector)
 
@@ -224,14 +381,17 @@ class OpAttr(LazyNum):
 	def __repr__(self):
 		return "%s(%r, %r)" % (self.__class__.__name__, self.selector, self.tag)
 
-	def evaluate(self, source):
-		entities = list(e for e in self.get_entities(source) if e)
+	def eval(self, source, context=None):
+		return self.evaluate(source, context)
+
+	def evaluate(self, source, context=None):
+		entities = list(e for e in self.get_entities(source, context) if e)
 		if entities:
 			if isinstance(self.tag, str):
 				ret = self.op(getattr(e, self.tag) for e in entities)
 			else:
 				# XXX: int() because of CardList counter tags
-				ret = self.op(int(e.tags[self.tag]) for e in entities)
+				ret = self.op(int(e.Manager.get(e, self.tag)) for e in entities)
 			return ret
 		else:
 			return None
@@ -244,5 +404,26 @@ class Attr(OpAttr):
 	def __init__(self, selector, tag):
 		super().__init__(selector, tag, sum)
 
-	def evaluate(self, source):
-		return super().evaluate(source) or 0
+	def evaluate(self, source, context=None):
+		members = _group_members(self.selector, source)
+		if members is not None:
+			group, exclude = members
+			if isinstance(self.tag, str):
+				return sum(getattr(e, self.tag) for e in group if e is not exclude)
+			return sum(int(e.Manager.get(e, self.tag)) for e in group if e is not exclude)
+		return super().evaluate(source, context) or 0
+
+
+def _group_members(selector, source):
+	"""
+	Return the registry group that \a selector selects from and the entity
+	to leave out of it, if the selector allows it (see
+	selector.plan_group()), or None
+	"""
+	from .selector import Selector
+	if not isinstance(selector, Selector):
+		return None
+	members = selector.group_plan()
+	if members is None:
+		return None
+	return members(source)
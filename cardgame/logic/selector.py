@@ -41,11 +41,41 @@ class Selector(LazyNum):
 	Medivh, where ordering matters)
 	"""
 
-	def select(self, entities: List[BaseEntity], source: BaseEntity) -> List[BaseEntity]:
+	def select(self, entities: List[BaseEntity], source: BaseEntity, context=None) -> List[BaseEntity]:
 		return entities
 
-	def eval(self, source):
-		return self.select(source.game, source)
+	def compiled(self):
+		"""
+		Return the selector lowered to a single-pass select function, see
+		compile_selector(). It is built on first use and cached.
+		"""
+		try:
+			return self._compiled
+		except AttributeError:
+			self._compiled = compile_selector(self)
+			return self._compiled
+
+	def contains(self, entity: BaseEntity, source: BaseEntity) -> bool:
+		"""
+		Return True if selecting from [\a entity] selects it, without
+		building any lists where possible, see compile_contains().
+		"""
+		try:
+			contains = self._contains
+		except AttributeError:
+			contains = self._contains = compile_contains(self)
+		return contains(entity, source)
+
+	def group_plan(self):
+		"""Return plan_group() for the selector, cached on first use"""
+		try:
+			return self._group_plan
+		except AttributeError:
+			self._group_plan = plan_group(self)
+			return self._group_plan
+
+	def eval(self, source, context=None):
+		return self.select(source.game, source, context)
 
 	def __add__(self, other: SelectorLike) -> "Selector":
 		return SetOpSelector(operator.and_, self, other)
@@ -84,7 +114,10 @@ class EnumSelector(Selector):
 		self.tag_enum = tag_enum
 		self.name = "<%s>" %(self.tag_enum.name)
 
-	def select(self, entities, source):
+	def select(self, entities, source, context=None):
+		return self.compiled()(entities, source, context)
+
+	def _select(self, entities, source, context=None):
 		if not self.tag_enum or not hasattr(self.tag_enum, "test"):
 			raise RuntimeError("Unsupported enum type {}".format(str(self.tag_enum)))
 		return [e for e in entities if self.tag_enum.test(e, source)]
@@ -126,12 +159,19 @@ class ComparisonSelector(Selector):
 		self.left = left
 		self.right = right
 
-	def select(self, entities, source):
-		right_value = (self.right.evaluate(source)
-		   if isinstance(self.right, LazyNum) else self.right)
+	def select(self, entities, source, context=None):
+		return self.compiled()(entities, source, context)
+
+	def _select(self, entities, source, context=None):
+		right_value = self.right_value(source, context)
 		return [e for e in entities if
 				self.op(self.left.value(e, source), right_value)]
 
+	def right_value(self, source, context=None):
+		"""Evaluate the value that entities are compared to"""
+		return (self.right.eval(source, context)
+		   if isinstance(self.right, LazyNum) else self.right)
+
 	def eval_name(self):
 		if self.op.__name__ == "eq":
 			infix = "=="
@@ -159,9 +199,12 @@ class SetOpSelector(Selector):
 	def _entity_id_set(entities: Iterable[BaseEntity]) -> Set[BaseEntity]:
 		return set(e.entity_id for e in entities if e)
 
-	def select(self, entities, source):
-		left_children = self.left.select(entities, source)
-		right_children = self.right.select(entities, source)
+	def select(self, entities, source, context=None):
+		return self.compiled()(entities, source, context)
+
+	def _select(self, entities, source, context=None):
+		left_children = self.left.select(entities, source, context)
+		right_children = self.right.select(entities, source, context)
 		result_entity_ids = self.op(self._entity_id_set(left_children),
 									self._entity_id_set(right_children))
 		# Preserve input ordering and multiplicity
@@ -200,7 +243,7 @@ class AttrValue(SelectorEntityValue):
 	def value(self, entity, source):
 		if isinstance(self.tag, str):
 			return getattr(entity, self.tag, 0)
-		return entity.tags.get(self.tag, 0)
+		return entity.Manager.get(entity, self.tag, 0)
 
 	def __call__(self, selector):
 		"""Convenience function to support uses like ARMOR(SELF)"""
@@ -209,6 +252,7 @@ class AttrValue(SelectorEntityValue):
 
 class Controller(LazyNum):
 	def __init__(self):
+		super().__init__()
 		self.name = "Controller"
 
 	def _get_entity_attr(self, entity):
@@ -238,11 +282,20 @@ class FuncSelector(Selector):
 		self.func = func
 		self.name = name if name else "<%s>" %(self.__class__.__name__)
 
-	def select(self, entities, source):
+	def select(self, entities, source, context=None):
 		return self.func(entities, source)
 
+class EntitySelector(FuncSelector):
+	"""Selects the single entity func(source), eg. SELF or ATTACKER"""
+	def __init__(self, func: Callable[[BaseEntity], BaseEntity], name=None):
+		super().__init__(lambda entities, source: [func(source)], name)
+		self.entity = func
+
+	def contains(self, entity, source):
+		return entity is self.entity(source)
+
 # Enum tests
-GameTag.test = lambda self, entity, *args: entity is not None and bool(entity.tags.get(self))
+GameTag.test = lambda self, entity, *args: entity is not None and bool(entity.Manager.get(entity, self))
 CardType.test = lambda self, entity, *args: entity is not None and self == entity.type
 Tribe.test = lambda self, entity, *args: entity is not None and self == getattr(entity, "tribe", Tribe.INVALID)
 #Rarity.test = lambda self, entity, *args: entity is not None and self == getattr(entity, "rarity", Rarity.INVALID)
@@ -250,15 +303,465 @@ Zone.test = lambda self, entity, *args: entity is not None and self == entity.zo
 #CardClass.test = lambda self, entity, *args: entity is not None and self == getattr(entity, "card_class", CardClass.INVALID)
 
 
+
+#------------------------------------------------------------------------------
+# Selector compilation
+#------------------------------------------------------------------------------
+
+def _attr_getter(tag):
+	"""Return a function reading AttrValue(tag) from an entity"""
+	if isinstance(tag, str):
+		return lambda e: getattr(e, tag, 0)
+	return lambda e: e.Manager.get(e, tag, 0)
+
+
+def _compare(op, get, right):
+	"""Return a predicate comparing get(entity) to \a right with op"""
+	if op is operator.eq:
+		return lambda e: get(e) == right
+	elif op is operator.ne:
+		return lambda e: get(e) != right
+	return lambda e: op(get(e), right)
+
+
+def _lower(selector):
+	"""
+	Lower a selector tree to a function bind(entities, source, context)
+	that returns a predicate on a single entity.
+	Returns (bind, static), where static is True if the predicate does
+	not depend on the arguments of bind, so it can be built once.
+	"""
+	if isinstance(selector, SetOpSelector):
+		left, left_static = _lower(selector.left)
+		right, right_static = _lower(selector.right)
+		op = selector.op
+		if op is operator.and_:
+			def combine(l, r):
+				return lambda e: l(e) and r(e)
+		elif op is operator.or_:
+			def combine(l, r):
+				return lambda e: l(e) or r(e)
+		elif op is operator.sub:
+			def combine(l, r):
+				return lambda e: l(e) and not r(e)
+		else:
+			return _lower_opaque(selector)
+		def bind(entities, source, context):
+			# Children are bound in the order they used to be evaluated.
+			l = left(entities, source, context)
+			return combine(l, right(entities, source, context))
+		return bind, left_static and right_static
+
+	elif isinstance(selector, EnumSelector):
+		value = selector.tag_enum
+		if not value or not hasattr(value, "test"):
+			return _lower_opaque(selector)
+		if isinstance(value, Zone):
+			predicate = lambda e: e is not None and value == e.zone
+		elif isinstance(value, CardType):
+			predicate = lambda e: e is not None and value == e.type
+		else:
+			test = value.test
+			predicate = lambda e: test(e)
+		return (lambda entities, source, context: predicate), True
+
+	elif isinstance(selector, ComparisonSelector):
+		op = selector.op
+		if type(selector.left) is not AttrValue:
+			def bind(entities, source, context):
+				value = selector.left.value
+				right = selector.right_value(source, context)
+				return lambda e: op(value(e, source), right)
+			return bind, False
+
+		get = _attr_getter(selector.left.tag)
+		if isinstance(selector.right, LazyNum):
+			def bind(entities, source, context):
+				return _compare(op, get, selector.right_value(source, context))
+			return bind, False
+		predicate = _compare(op, get, selector.right)
+		return (lambda entities, source, context: predicate), True
+
+	return _lower_opaque(selector)
+
+
+def _lower_opaque(selector):
+	"""
+	Selectors that do not test entities one by one are evaluated once per
+	selection, and their results matched by entity id, like set
+	operations always did.
+	"""
+	select = getattr(selector, "_select", selector.select)
+	def bind(entities, source, context):
+		ids = set(e.entity_id for e in select(entities, source, context) if e)
+		return lambda e: e.entity_id in ids
+	return bind, False
+
+
+#------------------------------------------------------------------------------
+# Scan planning
+#------------------------------------------------------------------------------
+
+# Lists holding the entities of a zone: (zone, card type) -> (attribute of
+# a player, attribute of the game). Entities are kept in the lists of their
+# controller, in the order the game iterates over them.
+_zone_lists = {
+	(Zone.HAND, None): ("hand", "hands"),
+	(Zone.DECK, None): ("deck", "decks"),
+	(Zone.DISCARD, None): ("discarded", "discarded"),
+	(Zone.PLAY, CardType.UNIT): ("field", "board"),
+}
+
+
+def _conjuncts(selector):
+	"""Yield selectors that every entity selected by selector matches"""
+	if isinstance(selector, SetOpSelector):
+		if selector.op is operator.and_:
+			yield from _conjuncts(selector.left)
+			yield from _conjuncts(selector.right)
+		elif selector.op is operator.sub:
+			yield from _conjuncts(selector.left)
+		return
+	yield selector
+
+
+def _controller_getter(value):
+	"""
+	Return a function source -> player for the value that controllers are
+	compared to, or None if it is not known to be a player
+	"""
+	if isinstance(value, Controller):
+		return value.evaluate
+	if not isinstance(value, LazyNum) and getattr(value, "type", None) == CardType.PLAYER:
+		return lambda source: value
+	return None
+
+
+def plan_scan(selector):
+	"""
+	Find the narrowest zone list that holds every entity selector can
+	select from a game, from the zone, card type and controller tests that
+	the selector is a conjunction of.
+	Returns a function scan(game, source) returning that list, or None if
+	the whole game has to be scanned.
+	"""
+	zone = card_type = controller = None
+	for conjunct in _conjuncts(selector):
+		if isinstance(conjunct, EnumSelector):
+			if isinstance(conjunct.tag_enum, Zone) and zone is None:
+				zone = conjunct.tag_enum
+		elif isinstance(conjunct, ComparisonSelector):
+			left = conjunct.left
+			if type(left) is not AttrValue or conjunct.op is not operator.eq:
+				continue
+			if left.tag == "type" and isinstance(conjunct.right, CardType) and card_type is None:
+				card_type = conjunct.right
+			elif left.tag == "controller" and controller is None:
+				controller = _controller_getter(conjunct.right)
+
+	lists = _zone_lists.get((zone, card_type)) or _zone_lists.get((zone, None))
+	if lists is None:
+		return None
+	player_list, game_list = lists
+	if controller is None:
+		return lambda game, source: getattr(game, game_list)
+
+	def scan(game, source):
+		player = controller(source)
+		if player is None:
+			return game
+		return getattr(player, player_list)
+	return scan
+
+
+def _and_terms(selector):
+	if isinstance(selector, SetOpSelector) and selector.op is operator.and_:
+		return _and_terms(selector.left) + _and_terms(selector.right)
+	return [selector]
+
+
+def plan_group(selector):
+	"""
+	Find the registry group (see EntityRegistry.group()) that holds exactly
+	the entities selector selects from a game. The selector must be a
+	conjunction of a zone, card type and controller test whose zone is kept
+	in a zone list, optionally minus SELF.
+	Returns a function members(source) returning the group and the entity
+	to leave out of it (or None), or None if the selector has another shape.
+	members() returns None if the controller is not a player.
+	"""
+	exclude_self = False
+	if isinstance(selector, SetOpSelector) and selector.op is operator.sub \
+			and selector.right is SELF:
+		exclude_self = True
+		selector = selector.left
+
+	zone = card_type = controller = None
+	for term in _and_terms(selector):
+		if isinstance(term, EnumSelector) and isinstance(term.tag_enum, Zone) \
+				and zone is None:
+			zone = term.tag_enum
+			continue
+		if not isinstance(term, ComparisonSelector) or type(term.left) is not AttrValue \
+				or term.op is not operator.eq:
+			return None
+		if term.left.tag == "type" and isinstance(term.right, CardType) and card_type is None:
+			card_type = term.right
+		elif term.left.tag == "controller" and controller is None:
+			controller = _controller_getter(term.right)
+			if controller is None:
+				return None
+		else:
+			return None
+	if (zone, card_type) not in _zone_lists and (zone, None) not in _zone_lists:
+		return None
+
+	def members(source):
+		player = None
+		if controller is not None:
+			player = controller(source)
+			if player is None:
+				return None
+		group = source.game.registry.group(zone, player, card_type)
+		return group, (source if exclude_self else None)
+	return members
+
+
+def _compile_predicates(selector):
+	"""Return the select function of the predicate engine"""
+	bind, static = _lower(selector)
+	scan = plan_scan(selector)
+	if static:
+		predicate = bind(None, None, None)
+		if scan is None:
+			return lambda entities, source, context: list(filter(predicate, entities))
+		def select(entities, source, context):
+			if entities is source.game:
+				entities = scan(entities, source)
+			return list(filter(predicate, entities))
+		return select
+	if scan is None:
+		return lambda entities, source, context: list(filter(
+			bind(entities, source, context), entities))
+	def select(entities, source, context):
+		predicate = bind(entities, source, context)
+		if entities is source.game:
+			entities = scan(entities, source)
+		return list(filter(predicate, entities))
+	return select
+
+
+#------------------------------------------------------------------------------
+# Bitset engine
+#------------------------------------------------------------------------------
+
+# Engine used by compiled selectors to select from a whole game, see
+# set_engine()
+engine = "predicate"
+
+
+def set_engine(name):
+	"""
+	Select from games with the "predicate" engine, which tests every entity
+	of the scanned zone list, or the "bitset" engine, which combines the
+	registry's bitsets for zones, controllers, card types and tribes with
+	integer operations and only tests the other conditions per entity.
+	Both give the same results.
+	"""
+	global engine
+	if name not in ("predicate", "bitset"):
+		raise ValueError("Unknown selector engine %r" % (name))
+	engine = name
+
+
+# Bitsets with up to this many entities are looked up by entity rather
+# than by slot
+_small_bitset = 8
+
+
+def _lower_bits(selector):
+	"""
+	Lower a selector tree to a function bits(registry, source) returning
+	the bitset of the registry slots it selects, or None if part of the
+	tree is not tracked by the registry
+	"""
+	if isinstance(selector, SetOpSelector):
+		left = _lower_bits(selector.left)
+		right = _lower_bits(selector.right)
+		if left is None or right is None:
+			return None
+		if selector.op is operator.and_:
+			return lambda registry, source: left(registry, source) & right(registry, source)
+		elif selector.op is operator.or_:
+			return lambda registry, source: left(registry, source) | right(registry, source)
+		elif selector.op is operator.sub:
+			return lambda registry, source: left(registry, source) & ~right(registry, source)
+		return None
+
+	elif isinstance(selector, EnumSelector):
+		value = selector.tag_enum
+		for kind, cls in (("zone", Zone), ("type", CardType), ("tribe", Tribe)):
+			if isinstance(value, cls):
+				return lambda registry, source: registry.bits(kind, value)
+		return None
+
+	elif isinstance(selector, ComparisonSelector):
+		if type(selector.left) is not AttrValue or selector.op is not operator.eq:
+			return None
+		tag, value = selector.left.tag, selector.right
+		if tag == "type" and isinstance(value, CardType):
+			return lambda registry, source: registry.bits("type", value)
+		if tag == "controller":
+			controller = _controller_getter(value)
+			if controller is not None:
+				return lambda registry, source: registry.bits("controller", controller(source))
+	return None
+
+
+def _compile_bitsets(selector):
+	"""
+	Return the select function of the bitset engine, or None if no
+	condition of the selector is tracked by the registry's bitsets.
+	The conjuncts of the selector that are not tracked are tested per
+	entity, on the entities of the bitset only.
+	"""
+	tracked = []
+	untracked = []
+	for term in _and_terms(selector):
+		bits = _lower_bits(term)
+		if bits is not None:
+			tracked.append(bits)
+		else:
+			untracked.append(_lower(term)[0])
+	if not tracked:
+		return None
+	scan = plan_scan(selector)
+
+	if len(tracked) == 1:
+		bitset = tracked[0]
+	else:
+		def bitset(registry, source):
+			bits = -1
+			for term in tracked:
+				bits &= term(registry, source)
+			return bits
+
+	def select(game, source, context):
+		predicates = [bind(game, source, context) for bind in untracked]
+		registry = game.registry
+		bits = bitset(registry, source)
+		if not bits:
+			return []
+		# Keep the order of the game's zone lists
+		entities = game if scan is None else scan(game, source)
+		if bits.bit_count() <= _small_bitset:
+			selected = registry.entities_in(bits)
+			ret = [e for e in entities if e in selected]
+		else:
+			slot = registry.slot
+			ret = [e for e in entities if bits >> slot(e) & 1]
+		for predicate in predicates:
+			ret = list(filter(predicate, ret))
+		return ret
+	return select
+
+
+def compile_selector(selector):
+	"""
+	Compile a tree of SetOpSelectors, ComparisonSelectors and
+	EnumSelectors into a function select(entities, source, context=None)
+	that tests each entity with one fused predicate, in a single pass over
+	entities.
+	Lazy values compared against are evaluated once per selection, in the
+	same order as when selecting recursively with _select().
+	When selecting from the whole game, only the zone list found by
+	plan_scan() is scanned, or the bitset engine is used if it is enabled
+	(see set_engine()), and results are cached during aura refreshes
+	(see aura.EvaluationCache) unless they depend on the context.
+	"""
+	predicates = _compile_predicates(selector)
+	bitsets = _compile_bitsets(selector)
+	cached = not depends_on_context(selector)
+
+	def select_from_game(game, source, context):
+		if bitsets is not None and engine == "bitset":
+			return bitsets(game, source, context)
+		return predicates(game, source, context)
+
+	def select(entities, source, context=None):
+		if entities is source.game:
+			# Selections made during an aura refresh are shared
+			cache = entities.auras.cache
+			if cache is not None and cached:
+				return list(cache.get(selector, source,
+					lambda: select_from_game(entities, source, context)))
+			return select_from_game(entities, source, context)
+		return predicates(entities, source, context)
+	return select
+
+
+#------------------------------------------------------------------------------
+# Membership tests
+#------------------------------------------------------------------------------
+
+def _select_contains(selector):
+	select = getattr(selector, "_select", selector.select)
+	def contains(entity, source):
+		res = select([entity], source, None)
+		return bool(res) and res[0] is entity
+	return contains
+
+
+def compile_contains(selector):
+	"""
+	Return a function contains(entity, source) telling whether selecting
+	from [entity] selects it, as event listeners match their arguments.
+	Set operations short-circuit on the membership of their children,
+	comparisons and enum tests run their predicate on the one entity, and
+	selectors that define contains() (eg. SELF or TARGET) are asked
+	directly. Anything else falls back to selecting from [entity].
+	"""
+	if isinstance(selector, SetOpSelector) and isinstance(selector.right, Selector):
+		left = compile_contains(selector.left)
+		right = compile_contains(selector.right)
+		op = selector.op
+		if op is operator.and_:
+			return lambda e, source: left(e, source) and right(e, source)
+		elif op is operator.or_:
+			return lambda e, source: left(e, source) or right(e, source)
+		elif op is operator.sub:
+			return lambda e, source: left(e, source) and not right(e, source)
+		return _select_contains(selector)
+
+	elif isinstance(selector, ComparisonSelector) and type(selector.left) is AttrValue \
+			and isinstance(selector.right, LazyNum):
+		# Compare directly rather than binding a predicate for one entity
+		op = selector.op
+		get = _attr_getter(selector.left.tag)
+		right = selector.right_value
+		return lambda e, source: bool(op(get(e), right(source)))
+
+	elif isinstance(selector, (EnumSelector, ComparisonSelector)):
+		bind, static = _lower(selector)
+		if static:
+			predicate = bind(None, None, None)
+			return lambda e, source: bool(predicate(e))
+		return lambda e, source: bool(bind([e], source, None)(e))
+
+	elif type(selector).contains is not Selector.contains:
+		return selector.contains
+	return _select_contains(selector)
+
+
 def TARGETS(index):
-	return FuncSelector(lambda entities, source: [source.targets[index]], name="TARGET[%d]" %(index))
+	return EntitySelector(lambda source: source.targets[index], name="TARGET[%d]" %(index))
 
 # Functions
-SELF			= FuncSelector(lambda entities, source: [source], name="SELF")
-ATTACKER		= FuncSelector(lambda entities, source: [source.attacker], name="ATTACKER")
-DEFENDER		= FuncSelector(lambda entities, source: [source.defender], name="DEFENDER")
-SOURCE_OF_DEATH	= FuncSelector(lambda entities, source: [source.source_of_death], name="SOURCE_OF_DEATH")
-OWNER			= FuncSelector(lambda entities, source: [source.owner], name="SOURCE_OF_DEATH")
+SELF			= EntitySelector(lambda source: source, name="SELF")
+ATTACKER		= EntitySelector(lambda source: source.attacker, name="ATTACKER")
+DEFENDER		= EntitySelector(lambda source: source.defender, name="DEFENDER")
+SOURCE_OF_DEATH	= EntitySelector(lambda source: source.source_of_death, name="SOURCE_OF_DEATH")
+OWNER			= EntitySelector(lambda source: source.owner, name="SOURCE_OF_DEATH")
 
 
 class Target(Selector):
@@ -266,13 +769,17 @@ class Target(Selector):
 		self.index = index
 		self.name = "TARGET[%d]" %(self.index)
 
-	def select(self, entities, source):
+	def select(self, entities, source, context=None):
 		return source.targets[self.index]
 
+	def contains(self, entity, source):
+		target = source.targets[self.index]
+		if isinstance(target, list):
+			return bool(target) and target[0] is entity
+		return entity is target
+
 	def __getitem__(self, index):
-		return FuncSelector(lambda entities, source:
-				[source.targets[index]],
-			name="TARGET[%d]" %(index))
+		return TARGETS(index)
 
 TARGET			= Target(0)
 CORRUPTED_UNIT	= Target(0)
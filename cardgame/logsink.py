@@ -0,0 +1,163 @@
+import atexit
+import collections
+import enum
+import os
+import queue
+import threading
+import time
+from . import logging
+
+level_names = {
+	logging.TRACE: "TRACE",
+	logging.DEBUG: "DEBUG",
+	logging.INFO: "INFO",
+	logging.WARNING: "WARNING",
+	logging.ERROR: "ERROR",
+}
+
+
+# Types of the arguments that can be formatted after they are logged
+immutable_types = (int, float, str, bytes, type(None), enum.Enum)
+
+
+def format_message(message, args):
+	"""Substitute \a args in \a message"""
+	if args:
+		try:
+			message = message % args
+		except Exception as e:
+			message = "%s (cannot format arguments: %s)" %(message, e)
+	return message
+
+
+def format_record(record):
+	"""Format a (time, logger name, level, message, args) record as a line"""
+	created, name, level, message, args = record
+	message = format_message(message, args)
+	return "%s.%03d %-7s %s: %s\n" %(
+		time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)),
+		int(created * 1000) % 1000, level_names.get(level, level), name, message)
+
+
+class BackgroundSink:
+	"""
+	Writes log records to rotating files from a background thread.
+
+	Logging a record only puts it on a queue and in a ring buffer of the
+	last \a capacity records. The writer thread formats the queued records
+	and writes them in batches of up to \a batch_size to \a path, which is
+	rotated to path.1 .. path.N (N = \a backup_count) once it would grow
+	past \a max_bytes.
+
+	Formatting is only deferred for records whose arguments are all
+	immutable (numbers, strings, enums); the others are formatted when
+	they are logged. Records therefore show their arguments as they were
+	when they were logged, and do not keep entities alive or have the
+	writer thread read them while the game changes them.
+
+	dump() writes the ring buffer to a crash file next to the log, so a
+	post-mortem has the full trace leading up to an error.
+	"""
+
+	def __init__(self, path, capacity=5000, max_bytes=10 * 1024 * 1024,
+			backup_count=5, batch_size=512):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.batch_size = batch_size
+		self.recent = collections.deque(maxlen=capacity)
+		self.queue = queue.Queue()
+		self.file = None
+		self.size = 0
+		self.closed = False
+
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.thread = threading.Thread(target=self.run, name="Log writer", daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def write(self, name, level, message, args):
+		if self.closed:
+			return
+		for arg in args:
+			if not isinstance(arg, immutable_types):
+				message = format_message(message, args)
+				args = ()
+				break
+		record = (time.time(), name, level, message, args)
+		self.recent.append(record)
+		self.queue.put(record)
+
+	def run(self):
+		"""Write the queued records until the sink is closed"""
+		get = self.queue.get
+		get_nowait = self.queue.get_nowait
+		while True:
+			records = [get()]
+			try:
+				while len(records) < self.batch_size:
+					records.append(get_nowait())
+			except queue.Empty:
+				pass
+			lines = [format_record(record).encode("utf-8")
+				for record in records if record is not None]
+			if lines:
+				self.write_lines(lines)
+			for record in records:
+				self.queue.task_done()
+			if None in records:
+				return
+
+	def write_lines(self, lines):
+		if self.file is None:
+			self.file = open(self.path, "ab")
+			self.size = self.file.tell()
+		batch = []
+		for line in lines:
+			if self.size and self.size + len(line) > self.max_bytes:
+				self.file.write(b"".join(batch))
+				batch = []
+				self.rotate()
+			batch.append(line)
+			self.size += len(line)
+		self.file.write(b"".join(batch))
+		self.file.flush()
+
+	def rotate(self):
+		self.file.close()
+		if self.backup_count > 0:
+			for i in range(self.backup_count - 1, 0, -1):
+				backup = "%s.%d" %(self.path, i)
+				if os.path.exists(backup):
+					os.replace(backup, "%s.%d" %(self.path, i + 1))
+			os.replace(self.path, self.path + ".1")
+		self.file = open(self.path, "wb")
+		self.size = 0
+
+	def flush(self):
+		"""Wait until every queued record is written"""
+		self.queue.join()
+
+	def dump(self, reason=None):
+		"""Write the most recent records to a crash file and return its path"""
+		records = list(self.recent)
+		path = "%s.crash-%d" %(self.path, int(time.time() * 1000))
+		with open(path, "w", encoding="utf-8") as file:
+			if reason:
+				file.write(reason.rstrip("\n") + "\n")
+			file.write("Last %d log records:\n" %(len(records)))
+			file.writelines(format_record(record) for record in records)
+		return path
+
+	def close(self):
+		"""Write the remaining records and stop the writer thread"""
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.thread.join()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
@@ -1,65 +1,64 @@
-from .enums import GameTag
+from .enums import GameTag, CardType, Zone
 from . import logging
 
 
 class Manager(object):
-	"""Maps tags to attributes of an entity"""
-
-	def __init__(self, obj):
-		self.obj = obj
-		self.observers = []
-
-	def __getitem__(self, tag):
-		"""Get the value of a tag. Raises KeyError if the tag is not defined """
-		if self.map.get(tag, None) != None:
-			return getattr(self.obj, self.map[tag], 0)
-		elif self.obj.data != None:
-			return self.obj.data.tags[tag]
-		else:
+	"""
+	Maps tags to attributes of entities.
+	Managers are stateless: their methods are class methods that take the
+	entity as an argument, and entities find theirs as entity.Manager. Only
+	the game has a manager instance (game.manager), which also indexes the
+	entities and notifies observers.
+	"""
+	map = {}
+
+	@classmethod
+	def get(cls, obj, tag, default=None):
+		"""Get the value of a tag of \a obj or return the default if it is not defined"""
+		map = cls.map
+		if tag in map:
+			attr = map[tag]
+			if attr is not None:
+				return getattr(obj, attr, 0)
+			elif obj.data != None:
+				return obj.data.tags[tag]
 			return None
+		elif obj.data != None:
+			return obj.data.tags.get(tag, default)
+		return default
 
-	def get(self, tag, default=None):
-		"""Get the value of a tag or return the default if it is not defined"""
-		if tag in self.map:
-			return self[tag]
-		elif self.obj.data != None:
-			return self.obj.data.tags.get(tag, default)
-		else:
-			return default
-
-	def __setitem__(self, tag, value):
-		"""Set the value of a tag"""
+	@classmethod
+	def set(cls, obj, tag, value):
+		"""Set the value of a tag of \a obj"""
 		try:
-			setattr(self.obj, self.map[tag], value)
+			setattr(obj, cls.map[tag], value)
 		except AttributeError:
-			print("Error: cannot set attribute %r to %r for %s" %(self.map[tag], value, self.obj.__class__.__name__))
+			print("Error: cannot set attribute %r to %r for %s" %(cls.map[tag], value, obj.__class__.__name__))
 			raise AttributeError
 
-	def __iter__(self):
-		"""Iterate non-zero tags"""
-		for k in self.map:
-			if self.map[k]:
-				yield k
+	@classmethod
+	def tags(cls):
+		"""Return the tags that are mapped to attributes"""
+		return [k for k, v in cls.map.items() if v]
 
-	def items(self):
-		"""Return a list of tag key/value pairs"""
-		for k, v in self.map.items():
+	@classmethod
+	def items(cls, obj):
+		"""Return a list of tag key/value pairs of \a obj"""
+		for k, v in cls.map.items():
 			if v is not None:
-				yield k, self[k]
-
-	def register(self, observer):
-		"""Register an observer"""
-		self.observers.append(observer)
+				yield k, getattr(obj, v, 0)
 
-	def update(self, tags):
-		"""Update tags with values from a dictionary"""
+	@classmethod
+	def update(cls, obj, tags):
+		"""Update the tags of \a obj with values from a dictionary"""
 		for k, v in tags.items():
-			if self.map.get(k) is not None:
-				self[k] = v
+			if cls.map.get(k) is not None:
+				cls.set(obj, k, v)
 
-	def keys(self):
+	@classmethod
+	def keys(cls):
 		"""Return the list of tags that are mapped to attributes"""
-		return self.map.keys()
+		return cls.map.keys()
 
 
 class GameManager(Manager):
@@ -77,11 +76,27 @@ class GameManager(Manager):
 		GameTag.ZONE: "zone",
 	}
 
+	# Zones whose entities are listed when iterating the game.
+	listed_zones = (Zone.PLAY, Zone.HAND, Zone.DECK, Zone.DISCARD)
+
 	def __init__(self, obj):
-		super().__init__(obj)
+		self.obj = obj
+		self.observers = []
 		self.counter = 0
+		self.entities = {}
+		self.removed_entities = {}
 		obj.entity_id = self.counter
 
+	def register(self, observer):
+		"""Register an observer"""
+		self.observers.append(observer)
+
+	def _fork(self, forker):
+		"""Copy the manager for a forked game, without its observers"""
+		ret = forker.copy_object(self, exclude=("observers", ))
+		ret.observers = []
+		return ret
+
 	def action_start(self, type, source, index, targets):
 		for observer in self.observers:
 			observer.action_start(type, source, index, targets)
@@ -90,13 +105,68 @@ class GameManager(Manager):
 		for observer in self.observers:
 			observer.action_end(type, source)
 
-	def new_entity(self, entity):
-		self.counter += 1
-		entity.entity_id = self.counter
+	def new_entity(self, entity, entity_id=None):
+		journal = self.obj.journal
+		if journal is not None and journal.savepoints:
+			journal.record(self, "counter")
+		if entity_id is None:
+			self.counter += 1
+			entity_id = self.counter
+		else:
+			self.counter = max(self.counter, entity_id)
+		self.entities.pop(entity.entity_id, None)
+		entity.entity_id = entity_id
+		self.index(entity)
 		#logging.entity.log("New entity ID %d (%s)", entity.entity_id, str(entity))
 		for observer in self.observers:
 			observer.new_entity(entity)
 
+	def index(self, entity):
+		"""Index an entity under its entity ID"""
+		if entity.zone == Zone.REMOVED_FROM_GAME:
+			self.removed_entities[entity.entity_id] = entity
+		else:
+			self.entities[entity.entity_id] = entity
+
+	def forget(self, entity):
+		"""Remove an entity from the index"""
+		entity_id = entity.entity_id
+		if self.entities.get(entity_id) is entity:
+			del self.entities[entity_id]
+		if self.removed_entities.get(entity_id) is entity:
+			del self.removed_entities[entity_id]
+
+	def zone_change(self, entity, old, new):
+		"""Keep the entity index in step with an entity's zone"""
+		entity_id = entity.entity_id
+		if entity_id is None:
+			# Not registered yet; new_entity() will index it.
+			return
+		if new == Zone.REMOVED_FROM_GAME:
+			if self.entities.pop(entity_id, None) is not None:
+				self.removed_entities[entity_id] = entity
+		elif old == Zone.REMOVED_FROM_GAME:
+			if self.removed_entities.pop(entity_id, None) is not None:
+				self.entities[entity_id] = entity
+
+	def find_entity(self, entity_id):
+		"""Return the entity with the given ID if it is listed in the game
+		(in play, in a hand, in a deck or discarded), or None"""
+		entity = self.entities.get(entity_id)
+		if entity is None or entity.zone not in self.listed_zones:
+			return None
+		if entity.type == CardType.EFFECT:
+			# Buffs are only listed while attached to something in play.
+			owner = entity.owner
+			if owner is None or owner.zone != Zone.PLAY:
+				return None
+		return entity
+
+	def find_removed_entity(self, entity_id):
+		"""Return the entity with the given ID if it was removed from the
+		game, or None"""
+		return self.removed_entities.get(entity_id)
+
 	def start_game(self):
 		for observer in self.observers:
 			observer.start_game()
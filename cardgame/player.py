@@ -1,16 +1,21 @@
 
 from .card import LiveEntity
-from .utils import CardList
+from .utils import CardList, CardView
 from .entity import Entity, int_property
 from .enums import *
 from .manager import PlayerManager
 from .logic.actions import *
-import random
+from .exceptions import InvalidAction
+from .replay import recorded, VALUE, ZONE, ENTITY, ENTITIES, CARD
 
 
 #class
 
 class Player(LiveEntity):
+	__slots__ = ("_morale", "_supply", "_territory", "_max_hand_size", "_game",
+		"deck", "hand", "discarded", "field", "last_card_played", "choice", "opponent",
+		"inspire", "spy", "inform")
+
 	Manager = PlayerManager
 
 	morale			= int_property("morale")
@@ -19,8 +24,6 @@ class Player(LiveEntity):
 	max_hand_size	= int_property("max_hand_size")
 	extra_corrupts	= slot_property("extra_corrupts")
 
-	name = "UNKNOWN"
-
 	def __init__(self, data):
 		#self.name = name
 		super().__init__(data)
@@ -42,6 +45,12 @@ class Player(LiveEntity):
 	def game(self, value):
 		self._game = value
 
+	@property
+	def journal(self):
+		game = getattr(self, "_game", None)
+		if game is not None:
+			return game.journal
+
 	def __str__(self):
 		return self.name
 
@@ -54,14 +63,19 @@ class Player(LiveEntity):
 
 	@property
 	def entities(self):
+		return self.game.registry.view(self, self._entities)
+
+	def _entities(self):
+		entities = []
 		for entity in self.field:
-			yield from entity.entities
-		yield from self.buffs
-		yield self
+			entities.extend(entity.entities)
+		entities.extend(self.buffs)
+		entities.append(self)
+		return CardView(entities)
 
 	@property
 	def live_entities(self):
-		yield from self.field
+		return self.field
 
 	@property
 	def actionable_entities(self):
@@ -73,6 +87,7 @@ class Player(LiveEntity):
 		return 100 # players don't have health
 
 	# Create a new card controlled by this player.
+	@recorded(id=VALUE, source=ENTITY, parent=ENTITY, zone=ZONE)
 	def card(self, id, source=None, parent=None, zone=Zone.SET_ASIDE):
 		card = self.game.create_card(id)
 		card.controller = self
@@ -86,23 +101,33 @@ class Player(LiveEntity):
 		self.game.manager.new_entity(card)
 		return card
 
+	@recorded(count=VALUE)
 	def draw(self, count=1):
 		self.game.queue_actions(self, [Draw(self) * count])
 
-	def prepare_for_game(self):
+	@recorded(deck=VALUE, hand_size=VALUE)
+	def prepare_for_game(self, deck, hand_size):
+		"""Create the cards of \a deck, shuffle them and draw a starting hand"""
 		#self.summon(self.starting_hero)
-		for id in self.starting_deck:
+		for id in deck:
 			self.card(id, zone=Zone.DECK)
 		self.shuffle_deck()
 		#self.playstate = PlayState.PLAYING
 
 		# Draw initial hand (but not any more than what we have in the deck)
-		hand_size = min(len(self.deck), self.start_hand_size)
-		starting_hand = random.sample(self.deck, hand_size)
+		hand_size = min(len(self.deck), hand_size)
+		starting_hand = self.game.random.sample(self.deck, hand_size)
 		# It's faster to move cards directly to the hand instead of drawing
 		for card in starting_hand:
 			card.zone = Zone.HAND
 
+	@recorded(cards=ENTITIES)
+	def choose(self, cards):
+		"""Make the choice the player is currently offered"""
+		if self.choice is None:
+			raise InvalidAction("There is no choice for %s" % (self))
+		self.choice.choose(cards)
+
 	def can_pay_cost(self, card):
 		return self.morale >= card.morale and \
 			self.supply >= card.supply
@@ -111,8 +136,11 @@ class Player(LiveEntity):
 		self.morale -= morale
 		self.supply -= supply
 
+	@recorded()
 	def shuffle_deck(self):
-		random.shuffle(self.deck)
+		self.game.journal.save(self.deck)
+		self.game.random.shuffle(self.deck)
+		self.game.registry.touch(Zone.DECK)
 
 	def summon(self, cards):
 		# If the card argument is a card ID, then create the card instance.
@@ -121,6 +149,7 @@ class Player(LiveEntity):
 		#self.game.cheat_action(self, )
 		game.queue_actions(self, actions.Summon(self, cards))
 
+	@recorded(card=CARD, zone=ZONE)
 	def give(self, card, zone=Zone.HAND):
 		if isinstance(card, str):
 			card = self.card(card, zone=zone)
@@ -0,0 +1,251 @@
+from collections import defaultdict
+from .enums import Tribe, Zone
+
+# Wildcard for version keys
+ANY = None
+
+class EntityRegistry:
+	"""
+	Tracks which zone, controller and card type every entity of a game
+	belongs to.
+
+	Membership is updated when an entity changes zones or controllers, and
+	is exposed as read-only set views. The entities of each zone are also
+	grouped by controller and card type, so they can be counted in O(1).
+
+	Every tracked entity that has not been removed from the game also holds
+	a dense slot number, and the entities of each zone, controller, card
+	type and tribe are kept as bitsets of slots (Python ints), so set
+	algebra over them is done with integer bit operations, see bits().
+	The slot of an entity is freed for reuse when it is removed from the
+	game.
+
+	The registry also caches read-only snapshots (views) of the game's
+	ordered zone lists, which are rebuilt only after an entity changes
+	zones.
+
+	Every change is stamped with an increasing version number, recorded
+	under the keys it affects:
+	  ("zone", zone, type)  entities of that type entered or left the zone
+	  ("attr", name)        an int_property attribute was written
+	where zone and type may be ANY. This lets readers check whether the
+	inputs they depend on changed since a given version.
+	"""
+
+	def __init__(self):
+		self.version = 0
+		self.versions = {}
+		self._zones = defaultdict(dict)
+		self._controllers = defaultdict(dict)
+		self._types = defaultdict(dict)
+		self._groups = defaultdict(dict)
+		self._placement = {}
+		self._views = {}
+		# Slot numbers by entity, entities by slot number (None if free)
+		self._slots = {}
+		self._slot_entities = []
+		self._free_slots = []
+		# Bitsets of slots by (kind, value), see bits()
+		self._bits = defaultdict(int)
+
+	def add(self, entity):
+		"""Start tracking an entity in its current zone"""
+		self.move(entity, None, entity.zone)
+
+	def move(self, entity, old, new):
+		"""Record that an entity moved from zone `old` to zone `new`"""
+		placement = self._placement.get(entity)
+		groups = self._groups
+		bits = self._bits
+		slot = self._slots.get(entity)
+		if placement is not None:
+			zone, controller = placement
+			del self._zones[zone][entity]
+			del self._controllers[controller][entity]
+			for key in self._group_keys(entity, zone, controller):
+				del groups[key][entity]
+			if slot is not None:
+				bit = 1 << slot
+				bits[("zone", zone)] &= ~bit
+				bits[("controller", controller)] &= ~bit
+		else:
+			self._types[entity.type][entity] = None
+		controller = entity.controller
+		self._placement[entity] = (new, controller)
+		self._zones[new][entity] = None
+		self._controllers[controller][entity] = None
+		for key in self._group_keys(entity, new, controller):
+			groups[key][entity] = None
+		if new == Zone.REMOVED_FROM_GAME:
+			if slot is not None:
+				self._free_slot(entity)
+		else:
+			if slot is None:
+				slot = self._allocate_slot(entity)
+			bit = 1 << slot
+			bits[("zone", new)] |= bit
+			bits[("controller", controller)] |= bit
+		self._stamp(entity.type, (old, new))
+
+	def controller_changed(self, entity):
+		"""Record that an entity may have changed controllers"""
+		placement = self._placement.get(entity)
+		if placement is not None and placement[1] is not entity.controller:
+			self.move(entity, placement[0], placement[0])
+
+	def discard(self, entity):
+		"""Stop tracking an entity"""
+		placement = self._placement.pop(entity, None)
+		if placement is None:
+			return
+		zone, controller = placement
+		del self._zones[zone][entity]
+		del self._controllers[controller][entity]
+		del self._types[entity.type][entity]
+		for key in self._group_keys(entity, zone, controller):
+			del self._groups[key][entity]
+		if entity in self._slots:
+			bit = 1 << self._slots[entity]
+			self._bits[("zone", zone)] &= ~bit
+			self._bits[("controller", controller)] &= ~bit
+			self._free_slot(entity)
+		self._stamp(entity.type, (zone, ))
+
+	def _allocate_slot(self, entity):
+		"""Give an entity a slot, in the bitsets of its card type and tribe"""
+		if self._free_slots:
+			slot = self._free_slots.pop()
+			self._slot_entities[slot] = entity
+		else:
+			slot = len(self._slot_entities)
+			self._slot_entities.append(entity)
+		self._slots[entity] = slot
+		bit = 1 << slot
+		self._bits[("type", entity.type)] |= bit
+		self._bits[("tribe", getattr(entity, "tribe", Tribe.INVALID))] |= bit
+		return slot
+
+	def _free_slot(self, entity):
+		"""
+		Free the slot of an entity, taking it out of the bitsets of its card
+		type and tribe (it must already be out of those of its zone and
+		controller)
+		"""
+		slot = self._slots.pop(entity)
+		self._slot_entities[slot] = None
+		self._free_slots.append(slot)
+		bit = ~(1 << slot)
+		self._bits[("type", entity.type)] &= bit
+		self._bits[("tribe", getattr(entity, "tribe", Tribe.INVALID))] &= bit
+
+	@staticmethod
+	def _group_keys(entity, zone, controller):
+		type = entity.type
+		if controller is ANY:
+			return ((zone, ANY, type), (zone, ANY, ANY))
+		return ((zone, controller, type), (zone, ANY, type),
+			(zone, controller, ANY), (zone, ANY, ANY))
+
+	def _stamp(self, type, zones):
+		"""Record that entities of a type entered or left zones"""
+		self.version += 1
+		version = self.version
+		versions = self.versions
+		for zone in zones:
+			versions[("zone", zone, type)] = version
+			versions[("zone", zone, ANY)] = version
+		versions[("zone", ANY, type)] = version
+		versions[("zone", ANY, ANY)] = version
+		if self._views:
+			self._views.clear()
+
+	def touch(self, zone):
+		"""Record that the order of a zone list changed"""
+		self.version += 1
+		for key in self.versions:
+			if key[0] == "zone" and key[1] in (zone, ANY):
+				self.versions[key] = self.version
+		self.versions[("zone", zone, ANY)] = self.version
+		if self._views:
+			self._views.clear()
+
+	def _fork(self, forker):
+		"""Copy the registry for a forked game, without its cached views"""
+		ret = forker.copy_object(self, exclude=("_views", ))
+		ret._views = {}
+		return ret
+
+	def attr_changed(self, name):
+		"""Record that an int_property attribute was written"""
+		self.version += 1
+		self.versions[("attr", name)] = self.version
+
+	def changed_since(self, keys, version):
+		"""Return True if anything recorded under keys changed after
+		version"""
+		versions = self.versions
+		for key in keys:
+			if versions.get(key, 0) > version:
+				return True
+		return False
+
+	def zone(self, zone):
+		"""Return a read-only set view of the entities in a zone"""
+		return self._zones[zone].keys()
+
+	def controlled_by(self, controller):
+		"""Return a read-only set view of the entities a player controls"""
+		return self._controllers[controller].keys()
+
+	def of_type(self, type):
+		"""Return a read-only set view of the entities of a card type"""
+		return self._types[type].keys()
+
+	def group(self, zone, controller=ANY, type=ANY):
+		"""
+		Return a read-only set view of the entities in a zone, of a
+		controller and card type if they are not ANY
+		"""
+		group = self._groups.get((zone, controller, type))
+		return group.keys() if group is not None else {}.keys()
+
+	def count(self, zone, controller=ANY, type=ANY):
+		"""Return the number of entities in group(zone, controller, type)"""
+		group = self._groups.get((zone, controller, type))
+		return len(group) if group is not None else 0
+
+	def bits(self, kind, value):
+		"""
+		Return the bitset of the slots of the entities with the given zone,
+		controller, card type or tribe (\a kind is "zone", "controller",
+		"type" or "tribe")
+		"""
+		return self._bits.get((kind, value), 0)
+
+	def slot(self, entity):
+		"""
+		Return the slot of an entity, or a slot that is in no bitset if it is
+		not tracked
+		"""
+		return self._slots.get(entity, len(self._slot_entities))
+
+	def entities_in(self, bits):
+		"""Return the set of the entities whose slots are in a bitset"""
+		entities = self._slot_entities
+		ret = set()
+		while bits:
+			low = bits & -bits
+			ret.add(entities[low.bit_length() - 1])
+			bits ^= low
+		return ret
+
+	def view(self, key, build):
+		"""
+		Return the cached snapshot stored under key, calling build() to
+		create it if the registry changed since it was last built.
+		"""
+		ret = self._views.get(key)
+		if ret is None:
+			ret = build()
+			self._views[key] = ret
+		return ret
@@ -0,0 +1,192 @@
+"""
+Recording and replaying games.
+
+A game created with Game(record=True) appends every top-level input
+(cards created during setup, plays, choices, declared attacks and
+intercepts, ending steps, rollbacks) to its Recording. Replaying the
+inputs on a new game seeded with the same seed reconstructs the game.
+
+Only the entry points decorated with recorded() are journaled, so state
+that is changed directly (eg. `player.morale += 100`) is not part of a
+recording.
+"""
+import functools
+import inspect
+import json
+import random
+from .enums import Zone
+from . import logging
+
+FORMAT_VERSION = 1
+
+
+#------------------------------------------------------------------------------
+# Argument kinds
+#------------------------------------------------------------------------------
+
+class Kind:
+	"""How an argument of an input is stored in a recording"""
+
+	def __init__(self, encode, decode):
+		self.encode = encode
+		self.decode = decode
+
+
+def _find(game, entity_id):
+	if entity_id is None:
+		return None
+	return game.find_entity(entity_id) or game.find_removed_entity(entity_id)
+
+
+def _card_id(card):
+	# Either a card id or an existing card
+	return card if isinstance(card, str) else card.entity_id
+
+
+def _find_card(game, card):
+	return card if isinstance(card, str) else _find(game, card)
+
+
+VALUE = Kind(lambda value: value, lambda game, value: value)
+ZONE = Kind(int, lambda game, value: Zone(value))
+ENTITY = Kind(lambda entity: None if entity is None else entity.entity_id, _find)
+ENTITIES = Kind(lambda entities: [entity.entity_id for entity in entities],
+	lambda game, ids: [_find(game, id) for id in ids])
+CARD = Kind(_card_id, _find_card)
+
+
+#------------------------------------------------------------------------------
+# Recording
+#------------------------------------------------------------------------------
+
+# Recorded entry points by input name: (undecorated method, argument kinds)
+entry_points = {}
+
+
+def recorded(**fields):
+	"""
+	Decorate a method of an entity as an entry point whose calls are
+	recorded as inputs. \a fields maps the names of the arguments to store
+	to their Kind.
+	Calls made while another input is being performed are part of that
+	input, so they are not recorded.
+	"""
+	def decorator(method):
+		name = method.__name__
+		assert name not in entry_points, "Duplicate entry point %r" % (name)
+		entry_points[name] = (method, tuple(fields.items()))
+		signature = inspect.signature(method)
+
+		@functools.wraps(method)
+		def wrapper(self, *args, **kwargs):
+			recording = self.game.recording
+			if recording is None or recording.depth:
+				return method(self, *args, **kwargs)
+			arguments = signature.bind(self, *args, **kwargs)
+			arguments.apply_defaults()
+			arguments = arguments.arguments
+			index = recording.append((name, self.entity_id) + tuple(
+				kind.encode(arguments[field]) for field, kind in fields.items()))
+			recording.depth += 1
+			try:
+				return method(self, *args, **kwargs)
+			except Exception:
+				recording.errors.append(index)
+				raise
+			finally:
+				recording.depth -= 1
+		return wrapper
+	return decorator
+
+
+class Recording:
+	"""
+	Append-only journal of the inputs of a game.
+
+	Each input is a tuple of the entry point's name, the id of the entity
+	it was called on and its stored arguments. \a errors holds the
+	indexes of the inputs that raised an exception when they were
+	recorded.
+	"""
+
+	def __init__(self, seed):
+		self.seed = seed
+		self.inputs = []
+		self.errors = []
+		# Nesting level of the input being performed
+		self.depth = 0
+
+	def __len__(self):
+		return len(self.inputs)
+
+	def _fork(self, forker):
+		# Forked games are not recorded.
+		return None
+
+	def append(self, input):
+		self.inputs.append(input)
+		return len(self.inputs) - 1
+
+	def dumps(self):
+		"""Encode the recording as JSON"""
+		return json.dumps({
+			"Version": FORMAT_VERSION,
+			"Seed": self.seed,
+			"Inputs": self.inputs,
+			"Errors": self.errors,
+		}, separators=(",", ":"))
+
+	@classmethod
+	def loads(cls, data):
+		"""Decode a recording encoded by dumps()"""
+		data = json.loads(data)
+		if data.get("Version") != FORMAT_VERSION:
+			raise ValueError("Unsupported recording version %r" % (data.get("Version")))
+		recording = cls(data["Seed"])
+		recording.inputs = [tuple(input) for input in data["Inputs"]]
+		recording.errors = data["Errors"]
+		return recording
+
+
+def new_seed():
+	return random.randrange(1 << 32)
+
+
+#------------------------------------------------------------------------------
+# Replay
+#------------------------------------------------------------------------------
+
+def perform(game, input):
+	"""Perform a recorded input on game"""
+	name, entity_id = input[:2]
+	method, fields = entry_points[name]
+	target = _find(game, entity_id)
+	arguments = {field: kind.decode(game, value)
+		for (field, kind), value in zip(fields, input[2:])}
+	return method(target, **arguments)
+
+
+def replay(recording, stop=None, callback=None):
+	"""
+	Reconstruct a game by performing the inputs of \a recording (the first
+	\a stop inputs if given) on a new game, with logging disabled.
+	If given, \a callback is called with the game after each input.
+	Inputs that raised when they were recorded may raise again; any other
+	exception means the replay diverged from the recorded game and is
+	raised.
+	"""
+	from .game import Game
+	errors = set(recording.errors)
+	with logging.using("headless"):
+		game = Game(seed=recording.seed)
+		for index, input in enumerate(recording.inputs[:stop]):
+			if index in errors:
+				try:
+					perform(game, input)
+				except Exception:
+					pass
+			else:
+				perform(game, input)
+			if callback is not None:
+				callback(game)
+	return game
@@ -0,0 +1,221 @@
+"""
+Seekable replay files.
+
+A replay file stores the state of a game after each of its inputs, as a
+sequence of frames. Every \a keyframe_interval turns a frame holds the
+full state (a keyframe); the others only hold the tags that changed
+since the previous frame (a delta). An index of the keyframes at the end
+of the file lets a reader seek to any turn by decoding the nearest
+keyframe before it and the deltas that follow, which costs O(interval)
+rather than O(length of the game).
+
+  header   magic b"CGRF", format version (uint16), keyframe interval (uint16)
+  frames   per frame a kind (uint8), turn (uint32) and payload size (uint32):
+             keyframe  a snapshot of the full state
+             delta     varint count of removed entities and their varint
+                       ids, then a snapshot of the changed tags
+  index    number of frames (uint32), turn of the last frame (uint32),
+           number of keyframes (uint32), then
+           per keyframe its turn (uint32), frame number (uint32) and
+           file offset (uint64)
+  trailer  offset of the index (uint64), magic b"CGRI"
+
+States are in the {entity_id: {GameTag: value}} form returned by
+Game.serialize_state().
+"""
+import bisect
+import struct
+from . import replay, snapshot
+from .snapshot import _write_varint, _read_varint
+
+MAGIC = b"CGRF"
+INDEX_MAGIC = b"CGRI"
+VERSION = 1
+
+KEYFRAME = 1
+DELTA = 2
+
+_header = struct.Struct("<4sHH")
+_frame = struct.Struct("<BII")
+_index = struct.Struct("<III")
+_keyframe = struct.Struct("<IIQ")
+_trailer = struct.Struct("<Q4s")
+
+
+class ReplayFileError(ValueError):
+	"""Raised when reading data that is not a valid replay file"""
+	pass
+
+
+def diff_states(old, new):
+	"""
+	Return the (removed entity ids, {entity_id: {GameTag: value}} of changed
+	tags) that turn state \a old into \a new
+	"""
+	removed = [entity_id for entity_id in old if entity_id not in new]
+	changed = {}
+	for entity_id, tags in new.items():
+		old_tags = old.get(entity_id)
+		if old_tags is None:
+			changed[entity_id] = tags
+		elif old_tags != tags:
+			changed[entity_id] = {tag: value for tag, value in tags.items()
+				if old_tags.get(tag) != value}
+	return removed, changed
+
+
+class ReplayWriter:
+	"""
+	Writes the frames of a replay file to a binary \a file.
+	Call write() after each input of the game, and close() at the end.
+	"""
+
+	def __init__(self, file, keyframe_interval=10):
+		self.file = file
+		self.keyframe_interval = keyframe_interval
+		self.keyframes = []
+		self.frames = 0
+		self.state = None
+		self.turn = 0
+		self.keyframe_turn = None
+		self.offset = self._write(_header.pack(MAGIC, VERSION, keyframe_interval))
+
+	def _write(self, data):
+		self.file.write(data)
+		return len(data)
+
+	def write(self, game):
+		"""Write a frame with the current state of game"""
+		state = game.serialize_state()
+		turn = game.turn
+		if self.keyframe_turn is None or turn >= self.keyframe_turn + self.keyframe_interval:
+			kind = KEYFRAME
+			payload = snapshot.encode_state(state)
+			self.keyframes.append((turn, self.frames, self.offset))
+			self.keyframe_turn = turn
+		else:
+			kind = DELTA
+			removed, changed = diff_states(self.state, state)
+			payload = bytearray()
+			_write_varint(payload, len(removed))
+			for entity_id in removed:
+				_write_varint(payload, entity_id)
+			payload += snapshot.encode_state(changed)
+		self.offset += self._write(_frame.pack(kind, turn, len(payload)))
+		self.offset += self._write(payload)
+		self.frames += 1
+		self.state = state
+		self.turn = turn
+
+	def close(self):
+		"""Write the index of the keyframes"""
+		index = bytearray(_index.pack(self.frames, self.turn, len(self.keyframes)))
+		for keyframe in self.keyframes:
+			index += _keyframe.pack(*keyframe)
+		index += _trailer.pack(self.offset, INDEX_MAGIC)
+		self._write(index)
+		self.file.flush()
+
+
+class ReplayReader:
+	"""
+	Reads states from a replay file, given as a seekable binary \a file.
+	"""
+
+	def __init__(self, file):
+		self.file = file
+		try:
+			magic, version, self.keyframe_interval = _header.unpack(file.read(_header.size))
+			file.seek(-_trailer.size, 2)
+			index_offset, index_magic = _trailer.unpack(file.read(_trailer.size))
+		except (struct.error, OSError):
+			raise ReplayFileError("Replay file is truncated")
+		if magic != MAGIC:
+			raise ReplayFileError("Not a replay file")
+		if version != VERSION:
+			raise ReplayFileError("Unsupported replay file version %d" % (version))
+		if index_magic != INDEX_MAGIC:
+			raise ReplayFileError("Replay file has no index")
+
+		try:
+			file.seek(index_offset)
+			self.frames, self.last_turn, count = _index.unpack(file.read(_index.size))
+			data = file.read(count * _keyframe.size)
+			self.keyframes = [_keyframe.unpack_from(data, i * _keyframe.size)
+				for i in range(count)]
+		except (struct.error, OSError):
+			raise ReplayFileError("Replay file index is corrupt")
+		self.index_offset = index_offset
+		self._keyframe_turns = [keyframe[0] for keyframe in self.keyframes]
+		self._keyframe_frames = [keyframe[1] for keyframe in self.keyframes]
+
+	def _read_frame(self):
+		header = self.file.read(_frame.size)
+		if len(header) < _frame.size:
+			raise ReplayFileError("Replay file is truncated")
+		kind, turn, size = _frame.unpack(header)
+		payload = self.file.read(size)
+		if len(payload) < size:
+			raise ReplayFileError("Replay file is truncated")
+		return kind, turn, payload
+
+	def _apply(self, state, payload):
+		"""Apply a delta frame to state"""
+		try:
+			count, offset = _read_varint(payload, 0)
+			for i in range(count):
+				entity_id, offset = _read_varint(payload, offset)
+				state.pop(entity_id, None)
+		except IndexError:
+			raise ReplayFileError("Replay file is truncated or corrupt")
+		for entity_id, tags in snapshot.loads(payload, offset).items():
+			if entity_id in state:
+				state[entity_id].update(tags)
+			else:
+				state[entity_id] = tags
+
+	def _seek(self, keyframe, stop):
+		"""
+		Return the state of the last frame for which stop(turn, frame number)
+		is false, reading from keyframe onwards
+		"""
+		turn, frame, offset = keyframe
+		self.file.seek(offset)
+		kind, turn, payload = self._read_frame()
+		state = snapshot.loads(payload)
+		frame += 1
+		while frame < self.frames:
+			kind, turn, payload = self._read_frame()
+			if stop(turn, frame):
+				break
+			if kind == KEYFRAME:
+				state = snapshot.loads(payload)
+			else:
+				self._apply(state, payload)
+			frame += 1
+		return state
+
+	def state_at(self, turn):
+		"""Return the state at the end of \a turn"""
+		i = bisect.bisect_right(self._keyframe_turns, turn) - 1
+		if i < 0:
+			raise ReplayFileError("Replay starts after turn %d" % (turn))
+		return self._seek(self.keyframes[i], lambda frame_turn, frame: frame_turn > turn)
+
+	def state_at_frame(self, number):
+		"""Return the state after the frame at index \a number"""
+		if not 0 <= number < self.frames:
+			raise IndexError("Frame %d out of range" % (number))
+		i = bisect.bisect_right(self._keyframe_frames, number) - 1
+		return self._seek(self.keyframes[i], lambda frame_turn, frame: frame > number)
+
+
+def write_recording(recording, file, keyframe_interval=10):
+	"""
+	Replay a Recording into a replay file, with a frame after each input.
+	Return the number of frames written.
+	"""
+	writer = ReplayWriter(file, keyframe_interval)
+	replay.replay(recording, callback=writer.write)
+	writer.close()
+	return writer.frames
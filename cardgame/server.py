@@ -6,6 +6,7 @@ from .logic import *
 #from . import logic.actions as actions
 from .logic.selector import *
 from .utils import *
+from .decks import test_deck
 from .colors import *
 import sys
 import random
@@ -19,7 +20,7 @@ import json
 import struct
 
 
-server_log = logging.Logger("Server Log")
+server_log = logging.get_logger("Server Log")
 
 
 # This will by default convert things to integers (entities will become entity IDs)
@@ -41,7 +42,7 @@ class ServerManager:
 	def add_to_state(self, entity):
 		state = {}
 		self.game_state[entity.entity_id] = state
-		for tag, value in entity.tags.items():
+		for tag, value in entity.Manager.items(entity):
 			# Value is default to card data.
 			if not value:
 				continue
@@ -98,7 +99,7 @@ class ServerManager:
 	def tag_change(self, entity, tag, value):
 		if tag < 0:
 			return
-		server_log.log("Queueing a tag change for %r: %s -> %r" %(entity, tag, value))
+		server_log.log("Queueing a tag change for %r: %s -> %r", entity, tag, value)
 		payload = {
 			"Type": "TagChange",
 			"TagChange": {
@@ -121,7 +122,7 @@ class ServerManager:
 
 	def refresh_tag(self, entity, tag):
 		state = self.game_state[entity.entity_id]
-		value = entity.tags.get(tag, 0)
+		value = entity.Manager.get(entity, tag, 0)
 		#if tag == GameTag.DAMAGE:
 		#	print("TAG power: %r = %r" %(tag, value))
 		#if isinstance(value, str):
@@ -168,7 +169,7 @@ class ServerManager:
 			entity = self.game.find_removed_entity(entity_id)
 		state = self.game_state[entity.entity_id]
 
-		for tag in entity.tags:
+		for tag in entity.Manager.tags():
 			self.refresh_tag(entity, tag)
 
 	def get_options(self, entity):
@@ -293,36 +294,6 @@ class ClientThread(Thread):
 		self.connection.send(data)
 
 
-test_deck = [
-	# Aard
-	(1, "PackExile"),
-	(1, "RagepackGrowler"),
-	(1, "RedmawBerserker"),
-	(1, "BlackbloodBruiser"),
-	(1, "BonehoarderBrute"),
-	(1, "WarpackChieftan"),
-	(1, "RageheartThug"),
-	(1, "WarlordHeir"),
-	(1, "RipperPack"),
-	(1, "RageheartScreamer"),
-	(1, "WarpackHowler"),
-	#(1, "RaidpackRally"),
-	(1, "Overrun"),
-
-	# Octopi
-	(1, "OctopiExile"),
-	(1, "InfestedWhale"),
-	(1, "EchoingFiend"),
-	(1, "ServantOfElagalth"),
-	(1, "StarvingCephalopod"),
-	(1, "AgileSquirmer"),
-	(1, "NecrolightPriestess"),
-	(1, "NoxiousTentacle"),
-	#(1, "ElegalthsChosen"),
-	#(1, "AbyssalSummoning"),
-	#(1, "PotentAfterlife"),
-	#(1, "ExtremePressure"),
-]
 
 
 class Server:
@@ -337,6 +308,7 @@ class Server:
 		#player2 = Player("Player2")
 		self.game = Game()
 		#self.game = Game(players=[player1, player2])
+		self.game.enable_turn_rollback()
 		self.done = False
 
 		goliath = self.game.player1.give("SunkenGoliath", Zone.PLAY)
@@ -436,17 +408,30 @@ class Server:
 		data = message.pack()
 		for connection in self.connections:
 			if connection.player in players:
-				color_print("Sending to %s: {yellow}%s{}\n" %(connection.player, message))
+				server_log.debug("Sending to %s: %s", connection.player, message)
 				connection.send_data(data)
 
 	def broadcast(self, player, message):
 		"""Send a message to all players"""
-		color_print("Broadcasting message: {yellow}%s{}\n" %(message))
+		server_log.debug("Broadcasting message: %s", message)
 		data = message.pack()
 		self.socket.sendall(data)
 		pass
 
 	def receive_data(self, player, message):
+		"""
+		Handle a message received from the given player. If handling it
+		raises, the recent log records are dumped for the post-mortem.
+		"""
+		try:
+			return self.handle_message(player, message)
+		except Exception:
+			server_log.error("Error handling message from %s: %s", player, message)
+			logging.dump_recent("Error handling message from %s: %s\n%s" %(
+				player, message, traceback.format_exc()))
+			raise
+
+	def handle_message(self, player, message):
 		"""Decode a packet of bytes received from the given player"""
 		server_log.log("Received message from %s: %s", player, message)
 
@@ -460,7 +445,7 @@ class Server:
 			player.connection = None
 
 		if type == "Concede":
-			print("%s concedes!" %(player))
+			server_log.info("%s concedes!", player)
 
 		if type == "Done":
 			self.game.end_step()
@@ -479,7 +464,7 @@ class Server:
 
 			card = self.game.find_entity(entity_id)
 			if not card:
-				print("Card ID '%d' does not exist" %(entity_id))
+				server_log.warning("Card ID '%d' does not exist", entity_id)
 				return False
 			card.play(targets=targets)
 			return True
@@ -488,11 +473,11 @@ class Server:
 			data = message.get("Choose")
 			entity_id = data["EntityID"]
 			if player.choice == None:
-				print("There is no choice for %s" %(player))
+				server_log.warning("There is no choice for %s", player)
 				return False
 			for card in player.choice.cards:
 				if card.entity_id == entity_id:
-					player.choice.choose(card)
+					player.choose([card])
 					return True
 			return False
 
@@ -501,41 +486,41 @@ class Server:
 			attacker = self.game.find_entity(data["Attacker"])
 			defender = self.game.find_entity(data["Defender"])
 			if not attacker:
-				print("Card ID '%s' does not exist" %(data["Attacker"]))
+				server_log.warning("Card ID '%s' does not exist", data["Attacker"])
 				return CommandResponse.INVALID
 				return False
 			if not defender:
-				print("Card ID '%s' does not exist" %(data["Defender"]))
+				server_log.warning("Card ID '%s' does not exist", data["Defender"])
 				return CommandResponse.INVALID
 				return False
-			attacker.declared_attack = defender
-			print("%s declared attack: %r -> %r" %(player, attacker, defender))
+			self.game.declare_attack(attacker, defender)
+			server_log.info("%s declared attack: %r -> %r", player, attacker, defender)
 
 		elif type == "Intercept":
 			data = message.get("Intercept")
 			interceptor = self.game.find_entity(data["Interceptor"])
 			attacker = self.game.find_entity(data["Attacker"])
 			if not interceptor:
-				print("Card ID '%s' does not exist" %(data["Interceptor"]))
+				server_log.warning("Card ID '%s' does not exist", data["Interceptor"])
 				return CommandResponse.INVALID
 				return False
 			if not attacker:
-				print("Card ID '%s' does not exist" %(data["Attacker"]))
+				server_log.warning("Card ID '%s' does not exist", data["Attacker"])
 				return CommandResponse.INVALID
 				return False
-			interceptor.declared_intercept = attacker
-			print("%s declared intercept: %r -> %r" %(player, interceptor, attacker))
+			self.game.declare_intercept(interceptor, attacker)
+			server_log.info("%s declared intercept: %r -> %r", player, interceptor, attacker)
 
 		elif type == "DebugAttack":
 			data = message.get("DebugAttack")
 			attacker = self.game.find_entity(data["Attacker"])
 			defender = self.game.find_entity(data["Defender"])
 			if not attacker:
-				print("Card ID '%s' does not exist" %(data["Attacker"]))
+				server_log.warning("Card ID '%s' does not exist", data["Attacker"])
 				return CommandResponse.INVALID
 				return False
 			if not defender:
-				print("Card ID '%s' does not exist" %(data["Defender"]))
+				server_log.warning("Card ID '%s' does not exist", data["Defender"])
 				return CommandResponse.INVALID
 				return False
 			self.game.action_block(player,
@@ -547,26 +532,34 @@ class Server:
 			player.draw(count)
 
 		elif type == "DebugRestart":
-			print("DEBUG: Restarting the game.")
+			server_log.info("DEBUG: Restarting the game.")
 
 		elif type == "DebugRollback":
-			print("DEBUG: Rolling game state back to the beginning of the current player's turn.")
+			if self.game.journal.turn_savepoint is None:
+				server_log.warning("There is no turn to roll back to")
+				return CommandResponse.INVALID
+			server_log.info("DEBUG: Rolling game state back to the beginning of the current player's turn.")
+			self.game.rollback_turn()
 
 		elif type == "CancelAttack":
 			data = message.get("CancelAttack")
 			attacker = self.game.find_entity(data["Attacker"])
 			if not attacker:
-				print("Card ID '%s' does not exist" %(message.args[0]))
+				server_log.warning("Card ID '%s' does not exist", message.args[0])
 				return CommandResponse.INVALID
 				return False
 
-			attacker.declared_attack = None
-			print("%s canceled attack for %r" %(player, attacker))
+			self.game.declare_attack(attacker, None)
+			server_log.info("%s canceled attack for %r", player, attacker)
 			return True
 
 
 if __name__=="__main__":
 	DEFAULT_PORT = 32764
+	if len(sys.argv) > 1:
+		# Write the logs to the given file instead of the console
+		from .logsink import BackgroundSink
+		logging.set_sink(BackgroundSink(sys.argv[1]))
 	server = Server()
 	server.prepare_game()
 	server.bind(port=DEFAULT_PORT)
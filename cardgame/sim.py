@@ -0,0 +1,364 @@
+"""
+Headless game simulation.
+
+Plays complete games between two policies without a server, sockets or
+console output, optionally spread over a pool of worker processes, and
+reports the throughput of the engine.
+
+Run from the repository root:
+	python -m cardgame.sim --games 1000 --processes 4 --policies random greedy
+"""
+import argparse
+import collections
+import contextlib
+import multiprocessing
+import os
+import random
+import time
+import traceback
+from .decks import test_deck
+from .enums import *
+from . import cards
+from . import logging
+
+
+#------------------------------------------------------------------------------
+# Options
+#------------------------------------------------------------------------------
+
+# An option is a tuple whose first item is its type:
+#	(PLAY, card, targets)
+#	(ATTACK, attacker, defender)
+#	(INTERCEPT, interceptor, attacker)
+#	(CHOOSE, cards)
+#	(DONE, )
+PLAY = "play"
+ATTACK = "attack"
+INTERCEPT = "intercept"
+CHOOSE = "choose"
+DONE = "done"
+
+
+def get_options(game, player, rng):
+	"""
+	Return the options available to \a player, like the server offers them
+	to a client. Play targets and choices are picked at random with \a rng.
+	"""
+	if player.choice:
+		choice = player.choice
+		count = min(choice.min_count, len(choice.cards))
+		return [(CHOOSE, rng.sample(list(choice.cards), count))]
+
+	options = [(DONE, )]
+	for card in player.hand:
+		if card.is_playable():
+			targets = []
+			for candidates in card.play_targets:
+				candidates = list(candidates)
+				if not candidates:
+					break
+				targets.append(rng.choice(candidates))
+			else:
+				options.append((PLAY, card, targets))
+	for unit in player.field:
+		if unit.declared_attack is None and unit.can_attack():
+			for target in unit.attack_targets:
+				options.append((ATTACK, unit, target))
+		elif unit.declared_intercept is None and unit.can_intercept():
+			for attacker in unit.intercept_targets:
+				options.append((INTERCEPT, unit, attacker))
+	return options
+
+
+def perform(game, player, option):
+	"""Perform an option returned by get_options()"""
+	type = option[0]
+	if type == PLAY:
+		option[1].play(targets=option[2])
+	elif type == ATTACK:
+		game.declare_attack(option[1], option[2])
+	elif type == INTERCEPT:
+		game.declare_intercept(option[1], option[2])
+	elif type == CHOOSE:
+		player.choose(option[1])
+	else:
+		game.end_step()
+
+
+#------------------------------------------------------------------------------
+# Policies
+#------------------------------------------------------------------------------
+
+class Policy:
+	"""Decides which option a player takes"""
+	name = "policy"
+
+	def select(self, game, player, options, rng):
+		raise NotImplementedError
+
+
+class RandomPolicy(Policy):
+	"""Takes any of the available options at random"""
+	name = "random"
+
+	def select(self, game, player, options, rng):
+		return rng.choice(options)
+
+
+class GreedyPolicy(Policy):
+	"""
+	Plays the most expensive card it can, attacks with its strongest
+	units and intercepts with its toughest ones, and otherwise ends the step.
+	"""
+	name = "greedy"
+
+	def score(self, option):
+		type = option[0]
+		if type == PLAY:
+			return 100 + option[1].morale + option[1].supply
+		elif type == ATTACK:
+			return 50 + option[1].power - option[2].power
+		elif type == INTERCEPT:
+			return 50 + option[1].health - option[2].power
+		return 0
+
+	def select(self, game, player, options, rng):
+		return max(options, key=self.score)
+
+
+policies = {policy.name: policy for policy in (RandomPolicy, GreedyPolicy)}
+
+
+#------------------------------------------------------------------------------
+# Games
+#------------------------------------------------------------------------------
+
+class GameStats:
+	"""
+	The outcome of a simulated game. \a failures holds the type name and
+	the traceback of each engine error raised by an option.
+	"""
+
+	def __init__(self, seed):
+		self.seed = seed
+		self.turns = 0
+		self.actions = 0
+		self.failures = []
+		self.winner = None
+		self.recording = None
+
+	@property
+	def errors(self):
+		return len(self.failures)
+
+
+def create_game(decks, rng, seed, record=False, deck_size=40, hand_size=5):
+	"""Create a game where each player draws from a deck picked with \a rng"""
+	from .game import Game
+	game = Game(seed=seed, record=record)
+	for player, deck in zip(game.players, decks):
+		card_ids = [id for count, id in deck for i in range(count)]
+		player.prepare_for_game([rng.choice(card_ids) for i in range(deck_size)], hand_size)
+	game.begin_turn(game.player1)
+	return game
+
+
+def play_game(seed, decks=(test_deck, test_deck), policy_names=("random", "random"),
+		max_turns=30, max_actions=3000, territory=20, record=False, strict=False):
+	"""
+	Play a game until a player holds \a territory territory, or until the
+	turn or action limit is reached.
+	Each option is performed in a transaction. If it raises an engine
+	error, the changes it made are rolled back, the error is recorded and
+	the game goes on without offering the card or unit of that option
+	again until another option succeeds; if \a strict is true, the error
+	is raised instead.
+	If \a record is true, the recording of the game is kept in the stats.
+	"""
+	rng = random.Random(seed)
+	stats = GameStats(seed)
+	game = create_game(decks, rng, seed, record)
+	players = {
+		game.player1: policies[policy_names[0]](),
+		game.player2: policies[policy_names[1]](),
+	}
+	first_turn = game.turn
+	# (type, card) of the options that failed since the last one performed
+	failed = set()
+
+	while stats.actions < max_actions and game.turn - first_turn < max_turns:
+		player = game.choosing_player
+		for chooser in game.players:
+			if chooser.choice:
+				player = chooser
+		if player is None:
+			option = (DONE, )
+		else:
+			options = get_options(game, player, rng)
+			if failed:
+				options = [o for o in options if o[0] == DONE or o[:2] not in failed]
+			option = players[player].select(game, player, options, rng)
+		stats.actions += 1
+		game.begin_transaction()
+		try:
+			perform(game, player, option)
+		except Exception as e:
+			if strict:
+				raise
+			stats.failures.append((type(e).__name__, traceback.format_exc()))
+			game.rollback()
+			if option[0] != DONE:
+				if option[0] != CHOOSE:
+					failed.add(option[:2])
+				continue
+			# The step could not be ended; give up on this game.
+			break
+		game.commit()
+		failed.clear()
+		winners = [p for p in game.players if p.territory >= territory]
+		if winners:
+			stats.winner = game.players.index(winners[0])
+			break
+
+	stats.turns = game.turn - first_turn
+	stats.recording = game.recording
+	return stats
+
+
+#------------------------------------------------------------------------------
+# Simulation runs
+#------------------------------------------------------------------------------
+
+class SimulationResult:
+	"""Totals and throughput of a simulation run"""
+
+	def __init__(self):
+		self.games = 0
+		self.turns = 0
+		self.actions = 0
+		self.errors = 0
+		# Number of engine errors of each type
+		self.error_kinds = collections.Counter()
+		self.wins = [0, 0]
+		self.elapsed = 0.0
+
+	def add(self, stats):
+		self.games += 1
+		self.turns += stats.turns
+		self.actions += stats.actions
+		self.errors += stats.errors
+		self.error_kinds.update(kind for kind, tb in stats.failures)
+		if stats.winner is not None:
+			self.wins[stats.winner] += 1
+
+	def rate(self, count):
+		return count / self.elapsed if self.elapsed else 0.0
+
+	@property
+	def games_per_sec(self):
+		return self.rate(self.games)
+
+	@property
+	def turns_per_sec(self):
+		return self.rate(self.turns)
+
+	@property
+	def actions_per_sec(self):
+		return self.rate(self.actions)
+
+	def report(self):
+		lines = [
+			"%d games, %d turns, %d actions, %d errors in %.2fs" % (
+				self.games, self.turns, self.actions, self.errors, self.elapsed),
+			"Wins: %d - %d" % tuple(self.wins),
+			"%.1f games/sec, %.1f turns/sec, %.1f actions/sec" % (
+				self.games_per_sec, self.turns_per_sec, self.actions_per_sec),
+		]
+		for kind, count in self.error_kinds.most_common():
+			lines.append("%6d %s" % (count, kind))
+		return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def headless():
+	"""Silence the engine's console output"""
+	with logging.using("headless"), open(os.devnull, "w") as devnull, \
+			contextlib.redirect_stdout(devnull):
+		yield
+
+
+def _load_cards(compile_scripts):
+	"""Initialize the card database, and compile its scripts if asked to"""
+	with headless():
+		if not cards.db.initialized:
+			cards.db.initialize()
+	if compile_scripts and not cards.db.compiled:
+		cards.db.compile()
+
+
+def _init_worker(compile_scripts):
+	# Workers stay silent for their whole lifetime.
+	logging.configure("headless")
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(devnull, 1)
+	os.close(devnull)
+	_load_cards(compile_scripts)
+
+
+def _play_chunk(args):
+	seeds, kwargs = args
+	with headless():
+		return [play_game(seed, **kwargs) for seed in seeds]
+
+
+def run(games, processes=None, chunksize=8, seed=0, compile_scripts=False, **kwargs):
+	"""
+	Play \a games games, with the seeds seed .. seed + games - 1, on a pool
+	of \a processes worker processes (all CPUs if None, or in this process
+	if 1). Games are handed out to workers in chunks of \a chunksize.
+	If \a compile_scripts is true, card scripts are compiled rather than
+	interpreted (see CardDatabase.compile()).
+	Other keyword arguments are passed to play_game().
+	"""
+	seeds = list(range(seed, seed + games))
+	chunks = [(seeds[i:i + chunksize], kwargs) for i in range(0, games, chunksize)]
+	result = SimulationResult()
+	start = time.perf_counter()
+	if processes == 1:
+		_load_cards(compile_scripts)
+		for chunk in chunks:
+			for stats in _play_chunk(chunk):
+				result.add(stats)
+	else:
+		with multiprocessing.Pool(processes, initializer=_init_worker,
+				initargs=(compile_scripts, )) as pool:
+			for chunk in pool.imap_unordered(_play_chunk, chunks):
+				for stats in chunk:
+					result.add(stats)
+	result.elapsed = time.perf_counter() - start
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run headless game simulations")
+	parser.add_argument("-n", "--games", type=int, default=100)
+	parser.add_argument("-p", "--processes", type=int, default=None)
+	parser.add_argument("-c", "--chunksize", type=int, default=8)
+	parser.add_argument("-s", "--seed", type=int, default=0)
+	parser.add_argument("--policies", nargs=2, default=["random", "random"],
+		choices=sorted(policies))
+	parser.add_argument("--max-turns", type=int, default=30)
+	parser.add_argument("--strict", action="store_true",
+		help="stop at the first engine error and show its traceback")
+	parser.add_argument("--compile-scripts", action="store_true",
+		help="compile card scripts instead of interpreting them")
+	args = parser.parse_args()
+
+	result = run(args.games, processes=args.processes, chunksize=args.chunksize,
+		seed=args.seed, policy_names=tuple(args.policies), max_turns=args.max_turns,
+		strict=args.strict, compile_scripts=args.compile_scripts)
+	print(result.report())
+
+
+if __name__ == "__main__":
+	main()
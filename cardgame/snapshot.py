@@ -0,0 +1,171 @@
+"""
+Compact binary snapshots of a game's state.
+
+A snapshot holds the same information as Game.serialize_state():
+
+  header        magic b"CGSN", format version (uint16)
+  string table  varint count, then per string a varint length and UTF-8 bytes
+  entities      varint count, then per entity:
+                  entity id (uint32) and tag count (uint16)
+                  per tag a varint key and a varint value
+
+The key of a tag is its zigzag-encoded GameTag shifted left by one bit,
+with the low bit set when the value is a string. String values are stored
+as an index into the string table (card ids and names); entity references
+are stored as entity ids (-1 for none); every other value as a
+zigzag-encoded integer.
+"""
+import struct
+from .enums import GameTag, Type
+
+MAGIC = b"CGSN"
+VERSION = 1
+
+_header = struct.Struct("<4sH")
+_entity = struct.Struct("<IH")
+
+
+class SnapshotError(ValueError):
+	"""Raised when decoding data that is not a valid snapshot"""
+	pass
+
+
+def _write_varint(out, value):
+	while value > 0x7f:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+
+def _read_varint(data, offset):
+	result = 0
+	shift = 0
+	while True:
+		byte = data[offset]
+		offset += 1
+		result |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return result, offset
+		shift += 7
+
+
+def _zigzag(value):
+	return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+_references = {tag for tag in GameTag if tag.type in (Type.ENTITY, Type.PLAYER)}
+
+# Tag keys mapped to their (GameTag, is_string) pair, and the encoded keys
+# of each GameTag for integer and string values
+_tag_keys = {}
+_int_keys = {}
+_string_keys = {}
+for tag in GameTag:
+	for is_string, keys in ((False, _int_keys), (True, _string_keys)):
+		key = (_zigzag(tag) << 1) | is_string
+		_tag_keys[key] = (tag, is_string)
+		keys[tag] = bytearray()
+		_write_varint(keys[tag], key)
+		keys[tag] = bytes(keys[tag])
+
+
+def dumps(game):
+	"""Encode the state of a game as a snapshot"""
+	return _encode((entity.entity_id, entity.Manager.items(entity)) for entity in game)
+
+
+def encode_state(state):
+	"""
+	Encode a {entity_id: {GameTag: value}} state, as returned by
+	Game.serialize_state(), as a snapshot
+	"""
+	return _encode((entity_id, tags.items()) for entity_id, tags in state.items())
+
+
+def _encode(entities):
+	strings = {}
+	body = bytearray()
+	count = 0
+	for entity_id, items in entities:
+		count += 1
+		tags = bytearray()
+		num_tags = 0
+		for tag, value in items:
+			num_tags += 1
+			if isinstance(value, str):
+				tags += _string_keys[tag]
+				value = strings.setdefault(value, len(strings))
+			else:
+				tags += _int_keys[tag]
+				if value is None and tag in _references:
+					value = -1
+				value = int(value)
+				value = (value << 1) if value >= 0 else ((-value << 1) - 1)
+			# Most values fit in a single byte.
+			if value < 0x80:
+				tags.append(value)
+			else:
+				_write_varint(tags, value)
+		body += _entity.pack(entity_id, num_tags)
+		body += tags
+
+	out = bytearray(_header.pack(MAGIC, VERSION))
+	_write_varint(out, len(strings))
+	for string in strings:
+		encoded = string.encode("utf-8")
+		_write_varint(out, len(encoded))
+		out += encoded
+	_write_varint(out, count)
+	out += body
+	return bytes(out)
+
+
+def loads(data, offset=0):
+	"""
+	Decode a snapshot, starting at \a offset in data, into the
+	{entity_id: {GameTag: value}} form returned by Game.serialize_state()
+	"""
+	try:
+		magic, version = _header.unpack_from(data, offset)
+	except struct.error:
+		raise SnapshotError("Snapshot is truncated")
+	if magic != MAGIC:
+		raise SnapshotError("Not a game snapshot")
+	if version != VERSION:
+		raise SnapshotError("Unsupported snapshot version %d" % (version))
+
+	try:
+		offset += _header.size
+		count, offset = _read_varint(data, offset)
+		strings = []
+		for i in range(count):
+			length, offset = _read_varint(data, offset)
+			strings.append(bytes(data[offset:offset + length]).decode("utf-8"))
+			offset += length
+
+		state = {}
+		tag_keys = _tag_keys
+		count, offset = _read_varint(data, offset)
+		for i in range(count):
+			entity_id, num_tags = _entity.unpack_from(data, offset)
+			offset += _entity.size
+			tags = {}
+			for j in range(num_tags):
+				key = data[offset]
+				value = data[offset + 1]
+				if key < 0x80 and value < 0x80:
+					offset += 2
+				else:
+					key, offset = _read_varint(data, offset)
+					value, offset = _read_varint(data, offset)
+				tag, is_string = tag_keys[key]
+				if is_string:
+					tags[tag] = strings[value]
+				elif value & 1:
+					tags[tag] = -((value + 1) >> 1)
+				else:
+					tags[tag] = value >> 1
+			state[entity_id] = tags
+	except (IndexError, KeyError, struct.error):
+		raise SnapshotError("Snapshot is truncated or corrupt")
+	return state
@@ -13,6 +13,20 @@ def listify(obj):
 	return []
 
 
+def slots_of(cls):
+	"""
+	Return the (name, member descriptor) pairs of the slots declared by a
+	class and its bases. The descriptors read and write the slots directly,
+	bypassing any property of the same name in a subclass.
+	"""
+	ret = []
+	for base in cls.__mro__:
+		for name in base.__dict__.get("__slots__", ()):
+			if name not in ("__dict__", "__weakref__"):
+				ret.append((name, base.__dict__[name]))
+	return ret
+
+
 def print_in_columns(items, spacing=2, left_padding=2):
 
 	column_widths = [0]
@@ -106,6 +120,25 @@ class CardList(list):
 		return self.__class__(e for k, v in kwargs.items() for e in self if getattr(e, k, 0) == v)
 
 
+class CardView(tuple):
+	"""Read-only snapshot of a list of cards, with the query methods of
+	CardList"""
+
+	__contains__ = CardList.__contains__
+	empty = CardList.empty
+	__int__ = CardList.__int__
+	contains = CardList.contains
+	index = CardList.index
+	exclude = CardList.exclude
+	filter = CardList.filter
+
+	def __getitem__(self, key):
+		ret = super().__getitem__(key)
+		if isinstance(key, slice):
+			return self.__class__(ret)
+		return ret
+
+
 
 if __name__=="__main__":
 	pass
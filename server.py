@@ -1,9 +1,15 @@
 
+import sys
+from cardgame import logging
+from cardgame.logsink import BackgroundSink
 from cardgame.server import Server
 
 
 if __name__=="__main__":
 	DEFAULT_PORT = 32764
+	if len(sys.argv) > 1:
+		# Write the logs to the given file instead of the console
+		logging.set_sink(BackgroundSink(sys.argv[1]))
 	server = Server()
 	server.prepare_game()
 	server.bind(port=DEFAULT_PORT)
@@ -1,5 +1,6 @@
 
 from .utils import *
+import operator
 
 
 def test_lazy_num():
@@ -92,4 +93,182 @@ def test_actions():
 	b.play()
 	a.attack(b)
 
+def test_compiled_selectors():
+	from cardgame.logic import selector
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	game.player1.give("OctopiExile")
+	game.player2.give("OctopiExile", Zone.PLAY)
+	game.player2.give("TomePrinter", Zone.DECK)
+	selectors = [selector.ALLIED_UNITS, selector.ENEMY_HAND, selector.ALL_CHARACTERS,
+		selector.OCTOPI - selector.IN_PLAY, selector.UNITS_WITH_VERDICT,
+		selector.POWER > 1, selector.CONTROLLED_BY(game.player2) | selector.PLAYERS]
+	for s in selectors:
+		expected = s._select(game, heir)
+		expect_eq(s.select(game, heir), expected)
+		# The compiled form is cached
+		expect_true(s.compiled() is s.compiled())
+	expect_eq(selector.ALLIED_UNITS.eval(heir), [heir])
+
+def test_selector_scan_planning():
+	from cardgame.logic import selector
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	game.player1.give("OctopiExile")
+	game.player2.give("OctopiExile", Zone.PLAY)
+	game.player2.give("TomePrinter", Zone.DECK)
+	expect_true(selector.plan_scan(selector.ALLIED_HAND)(game, heir) is game.player1.hand)
+	expect_true(selector.plan_scan(selector.ENEMY_UNITS)(game, heir) is game.player2.field)
+	expect_true(selector.plan_scan(selector.DEAD_ALLIED_UNITS)(game, heir) is game.player1.discarded)
+	expect_eq(selector.plan_scan(selector.IN_DECK)(game, heir), game.decks)
+	expect_eq(selector.plan_scan(selector.ALL_CHARACTERS), None)
+	for s in (selector.ALLIED_HAND, selector.ENEMY_UNITS, selector.ENEMY_DECK,
+			selector.IN_DECK - selector.ALLIED, selector.ALLIED_UNITS):
+		expect_eq(s.select(game, heir), s._select(game, heir))
+
+def test_count_pushdown():
+	from cardgame.logic import selector
+	from cardgame.logic.lazynum import Attr, Count, LazyNum
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	exile = game.player1.give("OctopiExile", Zone.PLAY)
+	game.player1.give("OctopiExile")
+	game.player2.give("OctopiExile", Zone.PLAY)
+	counts = [Count(selector.ALLIED_UNITS - selector.SELF), Count(selector.ALLIED_HAND),
+		Count(selector.ENEMY_UNITS), Count(selector.IN_PLAY & selector.UNITS)]
+	expect_true(selector.CONDUIT._args[0].group_plan() is not None)
+	expect_eq([count.eval(heir) for count in counts], [1, 1, 1, 3])
+	for count in counts:
+		expect_eq(count.eval(heir), LazyNum.eval(count, heir))
+	expect_eq(Attr(selector.ALLIED_UNITS, GameTag.POWER).eval(heir), heir.power + exile.power)
+
+	# The registry follows controller changes
+	exile.controller = game.player2
+	expect_eq(game.registry.count(Zone.PLAY, game.player2, CardType.UNIT), 2)
+	expect_true(exile in game.registry.group(Zone.PLAY, game.player2))
+
+def test_bitset_selectors():
+	from cardgame.logic import selector
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	for i in range(3):
+		game.player1.give("OctopiExile", Zone.PLAY)
+		game.player2.give("OctopiExile", Zone.PLAY)
+		game.player2.give("TomePrinter", Zone.DECK)
+	game.player1.give("OctopiExile")
+	game.player1.field[1].zone = Zone.DISCARD
+	selectors = [selector.ALL_CHARACTERS, selector.ENEMY_UNITS, selector.ALLIED_HAND,
+		selector.DEAD_ALLIED_UNITS, selector.OPPONENT, selector.UNITS_WITH_VERDICT,
+		selector.ENEMY_UNITS & (selector.POWER < 100), selector.OCTOPI | selector.IN_DECK]
+	expected = [s.eval(heir) for s in selectors]
+	selector.set_engine("bitset")
+	try:
+		expect_eq([s.eval(heir) for s in selectors], expected)
+		# Slots are reused after an entity stops being tracked
+		unit = game.player2.field[0]
+		slot = game.registry.slot(unit)
+		game.registry.discard(unit)
+		game.registry.add(unit)
+		expect_eq(game.registry.slot(unit), slot)
+		expect_eq([s.eval(heir) for s in selectors], expected)
+		# and after it is removed from the game
+		game.remove_entity(unit)
+		expect_true(unit in game.registry.zone(Zone.REMOVED_FROM_GAME))
+		expect_eq(game.registry.bits("type", CardType.UNIT) >> slot & 1, 0)
+		expect_eq(game.registry.slot(game.player2.give("TomePrinter")), slot)
+	finally:
+		selector.set_engine("predicate")
+
+def test_lazynum_compilation():
+	from cardgame.logic import lazynum, selector
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	game.player1.give("OctopiExile")
+	game.player1.give("OctopiExile")
+	value = (selector.CONDUIT + 1) * 2
+	expect_eq(value.eval(heir), 6)
+	expect_true(value.evaluator() is value.evaluator())
+	# Constant subtrees are folded
+	fn, constant = lazynum.compile_lazy(lazynum.LazyUnaryOperation(operator.neg,
+		lazynum.LazyBinaryOperation(operator.add, 1, 2)))
+	expect_true(constant)
+	expect_eq(fn(heir, None), -3)
+	expect_eq(lazynum.compile_lazy(value)[1], False)
+	# Inverting a comparison leaves the expressions compiled from it alone
+	condition = selector.CONDUIT >= 2
+	parent = condition & (selector.CONDUIT > 0)
+	expect_eq(parent.eval(heir), True)
+	expect_eq((~condition).eval(heir), False)
+	expect_eq(condition.eval(heir), True)
+	expect_eq(parent.eval(heir), True)
+
+def test_evaluation_cache():
+	from cardgame import aura
+	from cardgame.logic import selector
+	from cardgame.logic.lazynum import fingerprint
+	expect_eq(fingerprint(selector.IN_PLAY & selector.ENEMY & selector.UNITS),
+		fingerprint(selector.ENEMY_UNITS))
+	expect_true(fingerprint(selector.ENEMY_UNITS) != fingerprint(selector.ALLIED_UNITS))
+
+	game = Game()
+	basher1 = game.player1.give("JusticarBasher", Zone.PLAY)
+	basher2 = game.player1.give("JusticarBasher", Zone.PLAY)
+	game.player2.give("OctopiExile", Zone.PLAY)
+	cache = game.auras.cache = aura.EvaluationCache(game.registry)
+	try:
+		units = selector.ENEMY_UNITS.eval(basher1)
+		expect_eq(selector.ENEMY_UNITS.eval(basher2), units)
+		expect_eq((cache.hits, cache.misses), (1, 1))
+		# Selections for another controller are not shared
+		expect_eq(len(selector.ENEMY_UNITS.eval(game.player2.field[0])), 2)
+		expect_eq(cache.misses, 2)
+		# Nor are selections that changed since they were cached
+		game.player2.give("OctopiExile", Zone.PLAY)
+		expect_eq(len(selector.ENEMY_UNITS.eval(basher1)), 2)
+		expect_eq(cache.misses, 3)
+	finally:
+		game.auras.cache = None
+
+def test_selector_contains():
+	from cardgame.logic import selector
+	game = Game()
+	heir = game.player1.give("WarlordHeir", Zone.PLAY)
+	game.player1.give("OctopiExile", Zone.PLAY)
+	game.player2.give("OctopiExile", Zone.PLAY)
+	game.player2.give("TomePrinter")
+	selectors = [selector.SELF, selector.OWNER, selector.ENEMY_UNITS,
+		selector.ALLIED_UNITS - selector.SELF, selector.OCTOPI | selector.IN_HAND,
+		selector.ENEMY_UNITS & (selector.POWER < 100), selector.OPPONENT]
+	for s in selectors:
+		for entity in game:
+			res = s.select([entity], heir)
+			expect_eq(s.contains(entity, heir), bool(res) and res[0] is entity)
+	heir.targets = [game.player2.field[0]]
+	expect_true(selector.TARGET.contains(game.player2.field[0], heir))
+	expect_true(not selector.TARGET.contains(heir, heir))
 
+def test_action_compilation():
+	from cardgame.logic import actions, lazynum, selector
+	def run(compile):
+		game = Game()
+		heir = game.player1.give("WarlordHeir", Zone.PLAY)
+		for i in range(3):
+			game.player2.give("OctopiExile", Zone.PLAY)
+		game.player1.give("OctopiExile", Zone.DECK)
+		script = [
+			(actions.Damage(selector.ENEMY_UNITS, 1) * 2).then(
+				actions.Toxic(actions.Damage.TARGET)),
+			actions.Summon(selector.CONTROLLER, "OctopiExile") * 2,
+			actions.IfThen(lazynum.Count(selector.ALLIED_UNITS) >= 3,
+				actions.Draw(selector.CONTROLLER)),
+		]
+		actions.precompile(script, actions=compile)
+		expect_eq(script[0].callback[0].compiled is not None, compile)
+		results = game.run_actions(heir, script)
+		return [len(results[1])] + [(entity.id, int(entity.zone), getattr(entity, "damage", 0))
+			for entity in game] + [game.player1.morale]
+	expect_eq(run(True), run(False))
+	# Actions that evaluate their arguments themselves are interpreted
+	expect_true(actions.compile_action(actions.ChooseAndDiscard(selector.CONTROLLER)) is None)
+	compiled = actions.compile_action(actions.Draw(selector.CONTROLLER))
+	expect_true(compiled.targets is not None and compiled.target_args is None)
@@ -1,5 +1,10 @@
 
 from .utils import *
+import io
+import os
+import shutil
+import tempfile
+from cardgame import logging, logsink, replay, replayfile, snapshot, sim
 
 
 def test_serialize():
@@ -26,4 +31,534 @@ def test_serialize():
 				print(state1[id][GameTag.CARD_ID])
 				print(state2[id][GameTag.CARD_ID])
 
-	expect_eq(str(state2), str(state1))
\ No newline at end of file
+	expect_eq(str(state2), str(state1))
+
+
+def test_snapshot():
+	game1 = Game()
+	game1.player1.give("OctopiExile")
+	c1 = game1.player1.give("OctopiExile").play()
+	c2 = game1.player2.give("OctopiExile").play()
+	c1.attack(c2)
+
+	data = game1.dump_snapshot()
+	state1 = game1.serialize_state()
+	expect_eq(snapshot.loads(data), state1)
+
+	game2 = Game()
+	game2.load_snapshot(data)
+	expect_eq(str(game2.serialize_state()), str(state1))
+
+	try:
+		snapshot.loads(data[:-1])
+		expect_true(False)
+	except snapshot.SnapshotError:
+		pass
+
+def test_find_entity():
+	game = Game()
+	unit = game.player1.give("OctopiExile", Zone.PLAY)
+	card = game.player1.give("OctopiExile")
+	set_aside = game.player1.card("OctopiExile")
+
+	expect_eq(game.find_entity(game.player1.entity_id), game.player1)
+	expect_eq(game.find_entity(unit.entity_id), unit)
+	expect_eq(game.find_entity(card.entity_id), card)
+	expect_eq(game.find_entity(set_aside.entity_id), None)
+	expect_eq(game.find_removed_entity(unit.entity_id), None)
+
+	# Removed entities can only be found with find_removed_entity
+	game.remove_entity(unit)
+	expect_eq(game.find_entity(unit.entity_id), None)
+	expect_eq(game.find_removed_entity(unit.entity_id), unit)
+
+	# Every entity in the game can be found by its ID
+	for entity in game:
+		expect_eq(game.find_entity(entity.entity_id), entity)
+
+
+def test_entity_registry():
+	game = Game()
+	unit = game.player1.give("OctopiExile", Zone.PLAY)
+	card = game.player2.give("OctopiExile")
+
+	# Views are cached until an entity changes zones
+	board = game.board
+	expect_true(game.board is board)
+	expect_eq(list(board), [unit])
+	expect_true(unit in game.registry.zone(Zone.PLAY))
+	expect_true(card in game.registry.zone(Zone.HAND))
+	expect_true(card in game.registry.controlled_by(game.player2))
+	expect_true(card in game.registry.of_type(CardType.UNIT))
+
+	card.zone = Zone.PLAY
+	expect_false(game.board is board)
+	expect_eq(list(game.board), [unit, card])
+	expect_eq(list(game.hands), [])
+	expect_false(card in game.registry.zone(Zone.HAND))
+	expect_true(card in game.registry.zone(Zone.PLAY))
+	expect_eq(list(game.player2.entities), [card, game.player2])
+
+
+def test_listener_index():
+	game = Game()
+	whale = game.player1.give("InfestedWhale")
+	expect_eq(game.listeners.get(BeginTurn, EventListener.ON), None)
+
+	# Listeners are indexed when their entity enters play
+	whale.play()
+	listeners = game.listeners.get(BeginTurn, EventListener.ON)
+	expect_eq(list(listeners), [whale])
+	expect_eq(game.listeners.get(BeginTurn, EventListener.AFTER), None)
+
+	# ... and removed when it leaves play
+	whale.zone = Zone.HAND
+	expect_eq(list(listeners), [])
+
+
+def test_incremental_auras():
+	game = Game()
+	heir = game.player1.give("WarlordHeir").play()
+	record = game.auras.records[heir]
+	expect_eq(len(heir.buffs), 1)
+
+	# Unrelated changes do not re-evaluate the aura
+	game.player2.morale += 1
+	game.player1.give("OctopiExile")
+	game.refresh_auras()
+	expect_true(game.auras.records[heir] is record)
+	expect_eq(len(heir.buffs), 1)
+
+	# Another allied unit entering play does
+	game.player1.give("OctopiExile").play()
+	expect_false(game.auras.records[heir] is record)
+	expect_eq(len(heir.buffs), 0)
+	expect_eq(heir.power, 0)
+
+
+def test_pending_deaths():
+	game = Game()
+	heir = game.player1.give("WarlordHeir").play()
+	heir.damage = 3
+	game.process_deaths()
+	expect_eq(heir.zone, Zone.PLAY)
+	expect_eq(len(game.pending_deaths), 0)
+
+	# Losing the heroic buff drops the damaged unit's health to zero
+	game.player1.give("OctopiExile").play()
+	expect_eq(heir.zone, Zone.DISCARD)
+	expect_eq(len(game.pending_deaths), 0)
+
+
+def test_stat_cache():
+	game = Game()
+	heir = game.player1.give("WarlordHeir").play()
+	buff = heir.buffs[0]
+	expect_eq(heir.power, 5)
+
+	# Writing to a buff or the entity itself updates the computed value
+	buff.power += 2
+	expect_eq(heir.power, 7)
+	heir.power = 1
+	expect_eq(heir.power, 8)
+
+	# So does a buff leaving play
+	buff.remove()
+	expect_eq(heir.power, 1)
+	expect_eq(heir.max_health, heir._max_health)
+
+
+def test_fork():
+	game = Game()
+	heir = game.player1.give("WarlordHeir").play()
+	fork = game.fork()
+	copy = fork.find_entity(heir.entity_id)
+	expect_false(copy is heir)
+	expect_true(copy.data is heir.data)
+	expect_true(copy.controller is fork.player1)
+	expect_eq(copy.power, heir.power)
+	expect_eq(len(fork.active_aura_buffs), len(game.active_aura_buffs))
+
+	# Changes to the fork do not affect the original
+	fork.player1.give("OctopiExile").play()
+	expect_eq(len(copy.buffs), 0)
+	expect_eq(len(heir.buffs), 1)
+	expect_eq(len(game.player1.field), 1)
+	expect_eq(len(fork.player1.field), 2)
+
+	# The history of the game is not copied
+	game = Game(seed=1, record=True)
+	game.begin_transaction()
+	game.player1.give("WarlordHeir").play()
+	fork = game.fork()
+	expect_eq(len(fork.journal.entries), 0)
+	expect_eq(fork.journal.savepoints, [])
+	expect_true(fork.recording is None)
+	expect_true(game.recording is not None)
+	fork.player1.give("OctopiExile").play()
+	game.rollback()
+	expect_eq(len(game.player1.field), 0)
+	expect_eq(len(fork.player1.field), 2)
+
+
+def test_transactions():
+	game = Game()
+	heir = game.player1.give("WarlordHeir")
+	exile = game.player1.give("OctopiExile")
+
+	game.begin_transaction()
+	heir.play()
+	expect_eq(heir.power, 5)
+
+	game.begin_transaction()
+	exile.play()
+	expect_eq(heir.power, 0)
+	game.rollback()
+	expect_eq(exile.zone, Zone.HAND)
+	expect_eq(len(game.player1.field), 1)
+	expect_eq(heir.power, 5)
+
+	game.rollback()
+	expect_eq(heir.zone, Zone.HAND)
+	expect_eq(len(game.player1.field), 0)
+	expect_eq(len(game.active_aura_buffs), 0)
+	expect_true(game.find_entity(heir.entity_id) is heir)
+
+	# Changes that were committed are kept
+	game.begin_transaction()
+	exile.play()
+	game.commit()
+	expect_eq(exile.zone, Zone.PLAY)
+	expect_eq(len(game.journal.entries), 0)
+
+	# A seeded game draws the same random numbers again after a rollback
+	game = Game(seed=1)
+	game.begin_transaction()
+	numbers = [game.random.random() for i in range(3)]
+	game.rollback()
+	expect_eq([game.random.random() for i in range(3)], numbers)
+
+	# Nothing is recorded outside of transactions by default
+	game = Game()
+	game.begin_turn(game.player1)
+	game.player1.morale += 1
+	expect_eq(game.journal.entries, [])
+
+	# A transaction is rolled back to where it began, even across turns
+	game.enable_turn_rollback()
+	game.begin_transaction()
+	while game.current_player is game.player1:
+		game.end_step()
+	game.rollback()
+	expect_true(game.current_player is game.player1)
+	expect_eq(game.journal.savepoints, [])
+
+	# Turns are rolled back to their beginning once enabled
+	while game.current_player is game.player1:
+		game.end_step()
+	morale = game.player2.morale
+	game.player2.morale += 5
+	game.player2.give("OctopiExile").play()
+	game.rollback_turn()
+	expect_eq(game.player2.morale, morale)
+	expect_eq(len(game.player2.field), 0)
+	expect_true(game.journal.turn_savepoint is not None)
+
+def test_simulation():
+	with sim.headless():
+		first = sim.play_game(1, policy_names=("random", "greedy"), max_turns=4)
+		second = sim.play_game(1, policy_names=("random", "greedy"), max_turns=4)
+	expect_eq(first.turns, 4)
+	expect_true(first.actions > 0)
+	expect_eq(first.errors, 0)
+	# Games are reproducible from their seed
+	expect_eq(first.actions, second.actions)
+
+	# An option that fails is rolled back and recorded
+	class FaultyOption:
+		def __init__(self, player):
+			self.player = player
+		def play(self, targets):
+			self.player.morale += 5
+			raise ValueError("faulty option")
+
+	class FaultyPolicy(sim.Policy):
+		name = "faulty"
+		morale = []
+		def select(self, game, player, options, rng):
+			self.morale.append(player.morale)
+			if len(self.morale) == 1:
+				return (sim.PLAY, FaultyOption(player), [])
+			return (sim.DONE, )
+
+	sim.policies["faulty"] = FaultyPolicy
+	try:
+		with sim.headless():
+			stats = sim.play_game(1, policy_names=("faulty", "faulty"), max_turns=1)
+		expect_eq([kind for kind, tb in stats.failures], ["ValueError"])
+		expect_true("faulty option" in stats.failures[0][1])
+		expect_eq(FaultyPolicy.morale[1], FaultyPolicy.morale[0])
+		# Strict games raise the error
+		del FaultyPolicy.morale[:]
+		try:
+			with sim.headless():
+				sim.play_game(1, policy_names=("faulty", "faulty"), max_turns=1, strict=True)
+			expect_true(False)
+		except ValueError:
+			pass
+	finally:
+		del sim.policies["faulty"]
+
+	result = sim.SimulationResult()
+	result.add(first)
+	result.add(second)
+	result.elapsed = 2.0
+	expect_eq(result.games_per_sec, 1.0)
+	expect_eq(result.turns_per_sec, 4.0)
+
+def test_log_levels():
+	class Unprintable:
+		def __repr__(self):
+			raise AssertionError("formatted a disabled message")
+
+	log = logging.Logger("Test Log", logging.WARNING)
+	expect_false(log.enabled)
+	expect_false(log.is_enabled_for(logging.INFO))
+	expect_true(log.is_enabled_for(logging.ERROR))
+	# Disabled levels never format their arguments
+	log.log("%r", Unprintable())
+	log.info("%r", Unprintable())
+
+	log.set_level(logging.TRACE)
+	expect_true(log.enabled)
+	log.disable()
+	log.log("%r", Unprintable())
+	del logging.loggers["Test Log"]
+
+def test_background_log_sink():
+	directory = tempfile.mkdtemp()
+	path = os.path.join(directory, "game.log")
+	sink = logsink.BackgroundSink(path, capacity=3, max_bytes=200, backup_count=1)
+	previous = logging.set_sink(sink)
+	log = logging.Logger("Test Log")
+	try:
+		for i in range(10):
+			log.log("Record %d", i)
+		# Mutable arguments are formatted as they were when logged
+		cards = ["Octopi Exile"]
+		log.log("Hand %r", cards)
+		cards.append("Warlord Heir")
+		expect_eq(sink.recent[-1][3:], ("Hand ['Octopi Exile']", ()))
+		sink.flush()
+	finally:
+		logging.set_sink(previous)
+		sink.close()
+		del logging.loggers["Test Log"]
+
+	# The log was rotated once it grew too big
+	expect_true(os.path.exists(path + ".1"))
+	expect_false(os.path.exists(path + ".2"))
+	with open(path) as file:
+		expect_true("Test Log: Record 9" in file.read())
+
+	# Only the most recent records are dumped
+	with open(sink.dump("Crashed")) as file:
+		dump = file.read()
+	expect_true(dump.startswith("Crashed"))
+	expect_true("Record 9" in dump)
+	expect_true("Hand ['Octopi Exile']\n" in dump)
+	expect_false("Record 6" in dump)
+	shutil.rmtree(directory)
+
+def test_replay():
+	game = Game(record=True)
+	heir = game.player1.give("WarlordHeir")
+	exile = game.player2.give("OctopiExile", Zone.PLAY)
+	game.player1.give("TomePrinter", Zone.DECK)
+	game.player1.shuffle_deck()
+	game.begin_turn(game.player1)
+	heir.play()
+	game.end_step()
+	# Calls made while performing an input are not recorded
+	expect_eq([input[0] for input in game.recording.inputs],
+		["give", "give", "give", "shuffle_deck", "begin_turn", "play_card", "end_step"])
+
+	recording = replay.Recording.loads(game.recording.dumps())
+	replayed = replay.replay(recording)
+	expect_eq(replayed.seed, game.seed)
+	expect_eq(len(replayed.player1.field), 1)
+	expect_eq(replayed.player1.field[0].entity_id, heir.entity_id)
+	expect_eq(replayed.player1.field[0].power, heir.power)
+	expect_eq(replayed.player2.field[0].entity_id, exile.entity_id)
+	expect_eq(replayed.step, game.step)
+
+	# Replaying part of a recording
+	replayed = replay.replay(recording, stop=5)
+	expect_eq(replayed.find_entity(heir.entity_id).zone, Zone.HAND)
+
+def test_replay_file():
+	game = Game(record=True)
+	game.player1.give("WarlordHeir")
+	game.player1.give("OctopiExile")
+	game.begin_turn(game.player1)
+	# The state at the end of each turn
+	states = {}
+	for card in list(game.player1.hand):
+		card.play()
+		for i in range(4):
+			states[game.turn] = game.serialize_state()
+			game.end_step()
+	states[game.turn] = game.serialize_state()
+
+	file = io.BytesIO()
+	frames = replayfile.write_recording(game.recording, file, keyframe_interval=2)
+	expect_eq(frames, len(game.recording.inputs))
+	file.seek(0)
+	reader = replayfile.ReplayReader(file)
+	expect_eq(reader.frames, frames)
+	expect_eq(reader.last_turn, game.turn)
+	expect_true(0 < len(reader.keyframes) < frames)
+	for turn, state in states.items():
+		expect_eq(reader.state_at(turn), state)
+	expect_eq(reader.state_at_frame(frames - 1), game.serialize_state())
+
+	try:
+		replayfile.ReplayReader(io.BytesIO(file.getvalue()[:-4]))
+		expect_true(False)
+	except replayfile.ReplayFileError:
+		pass
+
+def test_choice_suspends_actions():
+	from cardgame.logic import actions, selector
+	game = Game()
+	player = game.player1
+	card = player.give("OctopiExile")
+	morale = player.morale
+	choose = actions.Choose(selector.CONTROLLER, selector.ALLIED_HAND).then(
+		actions.Discard(actions.Choose.CHOICE))
+	game.queue_actions(player, [choose, actions.GiveMorale(selector.CONTROLLER, 5)])
+	# The rest of the queue waits for the choice
+	expect_eq(player.morale, morale)
+	expect_eq(len(game.suspended_actions), 1)
+	fork = game.fork()
+	player.choose(card)
+	expect_eq(card.zone, Zone.DISCARD)
+	expect_eq(player.morale, morale + 5)
+	expect_eq(game.suspended_actions, [])
+	# The fork resumes its own copy of the queue
+	fork.player1.choose(fork.player1.hand[0])
+	expect_eq(fork.player1.morale, morale + 5)
+	expect_eq(player.morale, morale + 5)
+
+	# A nested choice suspends the frames it was triggered from too
+	card = player.give("OctopiExile")
+	morale = player.morale
+	game.queue_actions(player, [
+		actions.IfThen(True, [
+			actions.Choose(selector.CONTROLLER, selector.ALLIED_HAND),
+			actions.GiveMorale(selector.CONTROLLER, 5),
+			actions.GiveMorale(selector.CONTROLLER, 5)]),
+		actions.GiveMorale(selector.CONTROLLER, 100)])
+	expect_eq(player.morale, morale)
+	# The innermost frame is resumed first
+	expect_eq([len(frame.actions) - frame.index for frame in game.suspended_actions], [1, 2])
+	player.choose(card)
+	expect_eq(player.morale, morale + 110)
+	expect_eq(game.suspended_actions, [])
+
+	# So are the targets and iterations left of a targeted action
+	for i in range(2):
+		player.give("OctopiExile")
+		player.card("OctopiExile", zone=Zone.DECK)
+	hand = len(player.hand)
+	draw = (actions.Draw(selector.CONTROLLER) * 2).then(
+		actions.Choose(selector.CONTROLLER, selector.ALLIED_HAND))
+	game.queue_actions(player, [draw])
+	expect_eq(len(player.hand), hand + 1)
+	player.choose(player.hand[0])
+	expect_eq(len(player.hand), hand + 2)
+	expect_true(game.choice is not None)
+	player.choose(player.hand[0])
+	expect_eq(game.choice, None)
+
+	# And the rest of an attack: muddle makes the defender discard first
+	game = Game()
+	matriarch = game.player1.give("ContaminantMatriarch", Zone.PLAY)
+	card = game.player2.give("OctopiExile")
+	territory = game.player1.territory
+	matriarch.attack(game.player2)
+	expect_eq(game.player1.territory, territory)
+	expect_true(matriarch.defender is game.player2)
+	game.player2.choose(card)
+	expect_eq(card.zone, Zone.DISCARD)
+	expect_eq(game.player1.territory, territory + matriarch.power)
+	expect_eq(matriarch.defender, None)
+
+def test_execution_context():
+	from cardgame.logic import actions, selector
+	game = Game()
+	player = game.player1
+	card = player.give("OctopiExile", Zone.PLAY)
+	# Event arguments are kept by the frames of the actions, not the source
+	summon = actions.Summon(selector.CONTROLLER, "OctopiExile").then(
+		actions.Buff(actions.Summon.CARD, "Buff_Fury"))
+	game.queue_actions(card, [summon])
+	expect_true(not hasattr(card, "event_args"))
+	expect_eq(game.action_stack, [])
+	expect_eq(len(player.field[-1].buffs), 1)
+
+	# Games that share a Choose from a card script have their own choices
+	choose = actions.Choose(selector.CONTROLLER, selector.ALLIED_HAND)
+	games = [Game(), Game()]
+	for g in games:
+		g.player1.give("OctopiExile")
+		g.queue_actions(g.player1, [choose])
+	expect_true(games[0].choice is not games[1].choice)
+	expect_true(games[0].choice.player is games[0].player1)
+	expect_true(games[1].choice.player is games[1].player1)
+
+	# Action arguments are read from the context passed to the action, and
+	# the shared action scripts are not written to
+	context = actions.ActionContext(card, event_args=[player, card])
+	expect_eq(actions.Summon.CARD.eval(card, context), card)
+	expect_eq(actions.ActionContext(card).derive(card).event_args, None)
+	expect_eq(context.derive(card).event_args, [player, card])
+	expect_eq(context.derive(player).event_args, None)
+	expect_true(not hasattr(summon, "trigger_index"))
+	expect_true(not hasattr(summon, "event_queue"))
+
+	# Selectors compared to a lazy value evaluate it
+	game = Game()
+	clergy = game.player1.give("VoltitheClergy")
+	game.player1.give("OctopiExile")
+	game.player1.supply += 10
+	clergy.play()
+	expect_true(game.choice is not None)
+
+def test_compact_entities():
+	from cardgame.logic import actions, selector
+	game = Game()
+	unit = game.player1.give("OctopiExile", Zone.PLAY)
+	# Entities, aura slots and actions are slotted
+	for obj in (unit, game.player1, actions.Damage(selector.SELF, 1)):
+		expect_true(not hasattr(obj, "__dict__"))
+	expect_eq(unit.uuid, unit.uuid)
+	# Tags are read and written through the class-level manager
+	expect_eq(unit.Manager.get(unit, GameTag.POWER), unit.power)
+	unit.Manager.set(unit, GameTag.DAMAGE, 1)
+	expect_eq(unit.damage, 1)
+	unit.refresh_tags(game.player1, {GameTag.POWER: 2})
+	slot = unit.slots[0]
+	expect_true(not hasattr(slot, "__dict__"))
+	expect_eq(slot.power, 2)
+	# The journal restores slots, and unsets those that were not set
+	game.begin_transaction()
+	unit.creator = game.player2
+	slot.power = 3
+	game.rollback()
+	expect_true(not hasattr(unit, "creator"))
+	expect_eq(slot.power, 2)
+	fork = game.fork()
+	expect_eq(fork.player1.field[0].slots[0].power, 2)
+	expect_true(fork.player1.field[0].slots[0].entity is fork.player1.field[0])
+	expect_eq(fork.player1.field[0].damage, 1)